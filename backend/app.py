@@ -2,19 +2,27 @@ import os
 import json
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from typing import List
 import asyncio
+import shutil
+import tempfile
+import time
 import httpx
-from openai import OpenAI
 
 from steve.config import settings
-from steve.models import KBCreate, KBItem, IngestURL, SearchQuery, ChatRequest, ChatResponse
+from steve.models import KBCreate, KBItem, IngestURL, SearchQuery, SearchBatch, SearchFilters, ChatRequest, ChatResponse
 from steve import ingest
-from steve.embedding import embed_texts
-from steve.service import create_kb, list_kb, add_document, upsert_embeddings, semantic_search, list_documents, delete_document, delete_kb, hybrid_search, get_document, get_documents_by_ids
+from steve.pipeline import ingest_text, ingest_stream, ingest_batch
+from steve import batch
+from steve.embedding import embed_texts, close_client as close_embedding_client
+from steve.service import create_kb, list_kb, add_document, upsert_embeddings, semantic_search, list_documents, delete_document, delete_kb, hybrid_search, get_document, get_documents_by_ids, search_many
 from steve.service import list_documents as list_documents_by_kb
-from steve.db import get_conn
+from steve.db import read_conn
+from steve import vector_index, retrieval_cache, embedding_cache, doc_cache, rerank, history as chat_history, llm, offload, metrics
+from steve.fusion import FUSION_MODES
+from steve.context import build_context, count_message_tokens
+from steve.jobs import manager as jobs, QueueFull, FINISHED
 
 app = FastAPI(title="STEVE RAG Backend")
 
@@ -24,7 +32,16 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
+app.add_middleware(metrics.MetricsMiddleware)
+
+@app.on_event("shutdown")
+async def shutdown():
+    await jobs.shutdown()
+    await close_embedding_client()
+    await llm.close_client()
+    offload.shutdown()
 
 @app.get("/health")
 async def health():
@@ -62,149 +79,402 @@ async def config():
         "chat_model": settings.chat_model,
         "top_k": settings.top_k,
     "retrieval_alpha": settings.retrieval_alpha,
+        "fusion_mode": settings.fusion_mode,
     }
 
 @app.post("/kb", response_model=KBItem)
 async def kb_create(item: KBCreate):
-    kb_id = create_kb(item.name)
+    kb_id = await offload.db_write(create_kb, item.name)
     return KBItem(id=kb_id, name=item.name)
 
 @app.get("/kb", response_model=List[KBItem])
 async def kb_list():
     # include document counts
-    with get_conn() as conn:
-        rows = conn.execute(
-            "SELECT k.id, k.name, COUNT(d.id) AS doc_count FROM knowledgebase k LEFT JOIN document d ON d.kb_id = k.id GROUP BY k.id ORDER BY k.created_at DESC"
-        ).fetchall()
-        items = [KBItem(id=r["id"], name=r["name"], doc_count=r["doc_count"]) for r in rows]
-    return items
+    def rows():
+        with read_conn() as conn:
+            return conn.execute(
+                "SELECT k.id, k.name, COUNT(d.id) AS doc_count FROM knowledgebase k LEFT JOIN document d ON d.kb_id = k.id GROUP BY k.id ORDER BY k.created_at DESC"
+            ).fetchall()
+    return [KBItem(id=r["id"], name=r["name"], doc_count=r["doc_count"]) for r in await offload.db_read(rows)]
 
 @app.get("/kb/{kb_id}/docs")
 async def kb_docs_list(kb_id: int):
-    return {"documents": list_documents(kb_id)}
+    return {"documents": await offload.db_read(list_documents, kb_id)}
 
 @app.get("/documents")
 async def docs_list():
     # list all documents with KB name
-    with get_conn() as conn:
-        rows = conn.execute(
-            "SELECT d.id, d.source, d.title, d.type, d.created_at, k.id AS kb_id, k.name AS kb_name FROM document d JOIN knowledgebase k ON d.kb_id=k.id ORDER BY d.created_at DESC"
-        ).fetchall()
-        data = [
-            dict(id=r["id"], source=r["source"], title=r["title"], type=r["type"], created_at=r["created_at"], kb_id=r["kb_id"], kb_name=r["kb_name"]) for r in rows
-        ]
+    def rows():
+        with read_conn() as conn:
+            return conn.execute(
+                "SELECT d.id, d.source, d.title, d.type, d.created_at, k.id AS kb_id, k.name AS kb_name FROM document d JOIN knowledgebase k ON d.kb_id=k.id ORDER BY d.created_at DESC"
+            ).fetchall()
+    data = [
+        dict(id=r["id"], source=r["source"], title=r["title"], type=r["type"], created_at=r["created_at"], kb_id=r["kb_id"], kb_name=r["kb_name"]) for r in await offload.db_read(rows)
+    ]
     return {"documents": data}
 
 @app.get("/doc/{doc_id}")
 async def doc_get(doc_id: int):
-    doc = get_document(doc_id)
+    doc = await offload.db_read(get_document, doc_id)
     if not doc:
         raise HTTPException(status_code=404, detail="Document not found")
     return doc
 
 @app.delete("/kb/{kb_id}")
 async def kb_delete(kb_id: int):
-    delete_kb(kb_id)
+    await offload.db_write(delete_kb, kb_id)
     return {"status": "deleted"}
 
+@app.post("/kb/{kb_id}/vectors/compact")
+async def kb_vectors_compact(kb_id: int):
+    return {"reclaimed_rows": await offload.db_write(vector_index.compact, kb_id)}
+
+@app.post("/kb/{kb_id}/vectors/rebuild")
+async def kb_vectors_rebuild(kb_id: int):
+    return {"rows": await offload.db_write(vector_index.rebuild, kb_id)}
+
 @app.delete("/doc/{doc_id}")
 async def doc_delete(doc_id: int):
-    delete_document(doc_id)
+    await offload.db_write(delete_document, doc_id)
     return {"status": "deleted"}
 
 @app.post("/ingest/url")
 async def ingest_url(payload: IngestURL):
-    title, text = ingest.read_url(payload.url)
-    doc_id = add_document(payload.kb_id, payload.url, title, "url", text)
-    chunks = ingest.chunk_text(text, settings.max_chunk_tokens, settings.chunk_overlap_tokens)
-    vectors = await embed_texts(chunks)
-    upsert_embeddings(doc_id, chunks, vectors)
-    return {"document_id": doc_id, "chunks": len(chunks)}
+    title, text = await ingest.read_url(payload.url)
+    return await ingest_text(payload.kb_id, payload.url, title, "url", text, run_db=offload.db_write)
+
+def _copy_upload(file: UploadFile, path: str):
+    with open(path, "wb") as out:
+        shutil.copyfileobj(file.file, out)
+
+def _spool_upload(file: UploadFile, name: str) -> str:
+    # copy the upload to a named temp file in blocks instead of reading it into memory
+    suffix = "." + name.split(".")[-1] if "." in name else ""
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
+        shutil.copyfileobj(file.file, tmp)
+        return tmp.name
 
 @app.post("/ingest/file")
 async def ingest_file(kb_id: int = Form(...), file: UploadFile = File(...), file_path: str | None = Form(None)):
-    data = await file.read()
     name = file.filename or "file"
-    ext = (name.split(".")[-1] or "").lower()
+    spooled = await asyncio.to_thread(_spool_upload, file, name)
+    text_path = spooled + ".txt"
     try:
-        if ext in ["pdf"]:
-            text = ingest.read_pdf(data)
-            typ = "pdf"
-        elif ext in ["docx"]:
-            text = ingest.read_docx(data)
-            typ = "docx"
-            
-        elif ext in ["doc"]:
-            # unsupported by python-docx; fallback to best-effort decode
-            text = data.decode(errors="ignore")
-            typ = "doc"
-        elif ext in ["xlsx", "xls"]:
-            text = ingest.read_xlsx(data)
-            typ = "xlsx"
-        elif ext in ["csv"]:
-            text = ingest.read_csv(data)
-            typ = "csv"
-        elif ext in ["pptx"]:
-            text = ingest.read_pptx(data)
-            typ = "pptx"
-        elif ext in ["ppt"]:
-            # python-pptx doesn't support legacy .ppt; fallback
-            text = data.decode(errors="ignore")
-            typ = "ppt"
-        else:
-            text = data.decode(errors="ignore")
-            typ = "text"
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Failed to parse file: {e}")
+        try:
+            # the parsed text goes to disk too; chunks are streamed from it
+            typ, digest, _ = await offload.parse(ingest.extract_to_file, spooled, name, text_path)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Failed to parse file: {e}")
 
-    # Store original file path (if provided by Electron) for later opening
+        # Store original file path (if provided by Electron) for later opening
+        meta = {"file_path": file_path} if file_path else None
+        # re-uploads of the same path (or file name) update the existing document incrementally
+        return await ingest_stream(kb_id, name, name, typ, text_path, digest, meta=meta, source_key=file_path or name,
+                                   run_db=offload.db_write)
+    finally:
+        for path in (spooled, text_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+def _submit_job(kind: str, kb_id: int, source: str, run, on_finish=None):
+    try:
+        return jobs.submit(kind, kb_id, source, run, on_finish).to_dict()
+    except QueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+
+@app.post("/jobs/ingest/file", status_code=202)
+async def job_ingest_file(kb_id: int = Form(...), file: UploadFile = File(...), file_path: str | None = Form(None)):
+    """Queue a file for background ingestion; poll /jobs/{id} or follow /jobs/{id}/events."""
+    name = file.filename or "file"
+    # spool the upload to disk so the parser process can read it and the request can return
+    spooled = await asyncio.to_thread(_spool_upload, file, name)
+    text_path = spooled + ".txt"
     meta = {"file_path": file_path} if file_path else None
-    doc_id = add_document(kb_id, name, name, typ, text, meta=meta)
-    chunks = ingest.chunk_text(text, settings.max_chunk_tokens, settings.chunk_overlap_tokens)
-    vectors = await embed_texts(chunks)
-    upsert_embeddings(doc_id, chunks, vectors)
-    return {"document_id": doc_id, "chunks": len(chunks)}
+
+    async def run(job):
+        job.update(status="parsing", stage="parsing")
+        try:
+            typ, digest, _ = await jobs.extract(spooled, name, text_path)
+        except Exception as e:
+            raise RuntimeError(f"Failed to parse file: {e}")
+        return await ingest_stream(kb_id, name, name, typ, text_path, digest, meta=meta, source_key=file_path or name,
+                                   run_db=jobs.run_db, progress=lambda **p: job.update(status=p.get("stage"), **p))
+
+    def cleanup():
+        # also runs for jobs cancelled while queued or dropped at shutdown, which never start
+        for path in (spooled, text_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    try:
+        return _submit_job("file", kb_id, file_path or name, run, cleanup)
+    except HTTPException:
+        os.remove(spooled)
+        raise
+
+@app.post("/jobs/ingest/url", status_code=202)
+async def job_ingest_url(payload: IngestURL):
+    async def run(job):
+        job.update(status="parsing", stage="fetching")
+        title, text = await ingest.read_url(payload.url)
+        return await ingest_text(payload.kb_id, payload.url, title, "url", text,
+                                 run_db=jobs.run_db, progress=lambda **p: job.update(status=p.get("stage"), **p))
+
+    return _submit_job("url", payload.kb_id, payload.url, run)
+
+@app.post("/ingest/batch", status_code=202)
+async def ingest_batch_job(
+    kb_id: int = Form(...),
+    files: List[UploadFile] = File([]),
+    directory: str | None = Form(None),
+    recursive: bool = Form(True),
+):
+    """Queue many files at once: uploads (zip archives are expanded) and/or a local folder.
+
+    Files are parsed in worker processes, their chunks embedded in shared batches and written
+    in large transactions. The job result reports docs/sec and chunks/sec.
+    """
+    if not files and not directory:
+        raise HTTPException(status_code=400, detail="Provide files and/or a directory")
+    if directory and not os.path.isdir(directory):
+        raise HTTPException(status_code=400, detail=f"Not a directory: {directory}")
+    spool = tempfile.mkdtemp(prefix="steve-batch-")
+    uploads = []
+    for i, f in enumerate(files or []):
+        name = f.filename or f"file{i}"
+        path = os.path.join(spool, f"u{i}")
+        await asyncio.to_thread(_copy_upload, f, path)
+        uploads.append((path, name))
+
+    async def run(job):
+        job.update(status="parsing", stage="scanning")
+        items = []
+        for path, name in uploads:
+            if name.lower().endswith(".zip"):
+                dest = tempfile.mkdtemp(dir=spool)
+                items += await asyncio.to_thread(batch.zip_items, path, name, dest)
+            else:
+                items.append({"path": path, "name": name, "source": name, "source_key": name, "meta": None})
+        if directory:
+            items += await asyncio.to_thread(batch.directory_items, directory, recursive)
+        job.update(status="parsing", stage="parsing", files_total=len(items))
+        docs = batch.parse_many(items, jobs.extract, spool, window=2 * max(1, settings.job_parse_workers))
+        return await ingest_batch(kb_id, docs, run_db=jobs.run_db,
+                                  progress=lambda **p: job.update(status=p.get("stage"), **p))
+
+    try:
+        # the spool goes when the job ends, including a cancel while queued or a shutdown
+        return _submit_job("batch", kb_id, directory or f"{len(uploads)} files", run,
+                           lambda: shutil.rmtree(spool, ignore_errors=True))
+    except HTTPException:
+        shutil.rmtree(spool, ignore_errors=True)
+        raise
+
+@app.get("/jobs")
+async def jobs_list(status: str | None = None):
+    return {"jobs": [j.to_dict() for j in jobs.list() if status is None or j.status == status]}
+
+def _job_or_404(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/jobs/{job_id}")
+async def job_get(job_id: str):
+    return _job_or_404(job_id).to_dict()
+
+@app.post("/jobs/{job_id}/cancel")
+async def job_cancel(job_id: str):
+    _job_or_404(job_id)
+    return jobs.cancel(job_id).to_dict()
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, request: Request):
+    """SSE stream of job snapshots: one `progress` event per change, then `done`."""
+    job = _job_or_404(job_id)
+
+    async def iterator():
+        while True:
+            yield f"event: progress\ndata: {json.dumps(job.to_dict())}\n\n"
+            if job.status in FINISHED or await request.is_disconnected():
+                break
+            await job.wait_change(15)
+        yield "event: done\ndata: {}\n\n"
+
+    headers = {
+        "Cache-Control": "no-cache, no-transform",
+        "Connection": "keep-alive",
+        "X-Accel-Buffering": "no",
+    }
+    return StreamingResponse(iterator(), headers=headers, media_type="text/event-stream")
+
+def _filters(filters: SearchFilters | None) -> dict | None:
+    """Search filters as the plain dict the service layer takes (None when there are none)."""
+    if filters is None:
+        return None
+    return filters.model_dump(exclude_none=True) or None
+
+def _retrieval_key(kb_ids: List[int], query: str, top_k: int, alpha: float | None, fusion: str, filters: dict | None = None):
+    variant = f"{fusion}:{settings.rrf_k}:{settings.semantic_candidates}:{settings.keyword_candidates}"
+    if filters:
+        variant += ":" + json.dumps(filters, sort_keys=True, default=str)
+    return retrieval_cache.make_key(kb_ids, query, top_k, alpha, settings.embedding_model, variant)
+
+async def _retrieve(kb_ids: List[int], query: str, top_k: int, alpha: float | None, fusion: str | None = None,
+                    filters: dict | None = None) -> List[dict]:
+    """Hybrid search (semantic only when alpha is None), served from the retrieval cache when possible."""
+    fusion = fusion or settings.fusion_mode
+    key = _retrieval_key(kb_ids, query, top_k, alpha, fusion, filters)
+    cached = retrieval_cache.get(key)
+    if cached is not None:
+        return cached
+    gens = retrieval_cache.stamp(key[0])
+    with metrics.span("embed_query"):
+        qvec = (await embed_texts([query]))[0]
+    with metrics.span("search"):
+        if alpha is None:
+            results = await offload.db_read(semantic_search, kb_ids, qvec, top_k, filters)
+        else:
+            results = await offload.db_read(hybrid_search, kb_ids, query, qvec, top_k, alpha, fusion, filters)
+    retrieval_cache.put(key, gens, results)
+    return results
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {"retrieval": retrieval_cache.stats(), "embedding": dict(embedding_cache.counters), "rerank": rerank.stats(), "history": chat_history.stats(), "chat": llm.stats(), "offload": offload.stats(), "documents": doc_cache.stats()}
+
+def _collect():
+    """The modules' own counters (as in /cache/stats) as Prometheus samples."""
+    r, e, rr, h, c, d = retrieval_cache.stats(), embedding_cache.counters, rerank.stats(), chat_history.stats(), llm.stats(), doc_cache.stats()
+    hits, misses = "steve_cache_hits_total", "steve_cache_misses_total"
+    yield hits, "counter", "Cache hits by cache.", {"cache": "retrieval"}, r["hits"]
+    yield hits, "counter", "Cache hits by cache.", {"cache": "embedding_hot"}, e["hot_hits"]
+    yield hits, "counter", "Cache hits by cache.", {"cache": "embedding_disk"}, e["disk_hits"]
+    yield hits, "counter", "Cache hits by cache.", {"cache": "rerank"}, rr["cache_hits"]
+    yield hits, "counter", "Cache hits by cache.", {"cache": "history_summary"}, h["summary_hits"]
+    yield hits, "counter", "Cache hits by cache.", {"cache": "documents"}, d["hits"]
+    yield misses, "counter", "Cache misses by cache.", {"cache": "retrieval"}, r["misses"] + r["expired"] + r["stale"]
+    yield misses, "counter", "Cache misses by cache.", {"cache": "embedding"}, e["misses"]
+    yield misses, "counter", "Cache misses by cache.", {"cache": "documents"}, d["misses"]
+    yield "steve_cache_items", "gauge", "Entries held by each cache.", {"cache": "retrieval"}, r["items"]
+    yield "steve_cache_items", "gauge", "Entries held by each cache.", {"cache": "rerank"}, rr["cached_scores"]
+    yield "steve_cache_items", "gauge", "Entries held by each cache.", {"cache": "history_summary"}, h["cached_summaries"]
+    yield "steve_cache_items", "gauge", "Entries held by each cache.", {"cache": "documents"}, d["items"]
+    for event in ("requests", "rejected", "fallbacks", "cancelled"):
+        yield "steve_chat_events_total", "counter", "Chat upstream requests, rejections, API fallbacks and cancellations.", {"event": event}, c[event]
+    for state in ("active", "waiting"):
+        yield "steve_chat_slots", "gauge", "Chat requests holding or waiting for an upstream slot.", {"state": state}, c[state]
+    for pool, n in offload.counters.items():
+        yield "steve_offload_calls_total", "counter", "Calls handed to the read, write and parse pools.", {"pool": pool}, n
+    states = {}
+    for job in jobs.list():
+        states[job.status] = states.get(job.status, 0) + 1
+    for status, n in states.items():
+        yield "steve_jobs", "gauge", "Ingestion jobs held by the job manager, by status.", {"status": status}, n
+
+metrics.register_collector(_collect)
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+async def _chat_contexts(kb_ids: List[int], query: str, top_k: int, filters: dict | None = None) -> List[dict]:
+    """Contexts for a chat turn: fused retrieval, reranked down to top_k when a reranker is set."""
+    if not rerank.enabled():
+        return await _retrieve(kb_ids, query, top_k, settings.retrieval_alpha, filters=filters)
+    candidates = await _retrieve(kb_ids, query, max(top_k, int(settings.rerank_candidates)), settings.retrieval_alpha, filters=filters)
+    with metrics.span("rerank"):
+        return await rerank.rerank(query, candidates, top_k)
 
 @app.post("/search")
 async def search(payload: SearchQuery):
     top_k = payload.top_k or settings.top_k
-    qvec = (await embed_texts([payload.query]))[0]
+    alpha = None
     if getattr(payload, "hybrid", True):
         alpha = getattr(payload, "alpha", None)
         if alpha is None:
             alpha = settings.retrieval_alpha
-        results = hybrid_search(payload.kb_ids, payload.query, qvec, top_k, alpha)
-    else:
-        results = semantic_search(payload.kb_ids, qvec, top_k)
+    if payload.fusion is not None and payload.fusion not in FUSION_MODES:
+        raise HTTPException(status_code=400, detail=f"fusion must be one of {', '.join(FUSION_MODES)}")
+    results = await _retrieve(payload.kb_ids, payload.query, top_k, alpha, payload.fusion, _filters(payload.filters))
+    if payload.timings:
+        return {"results": results, "timings": metrics.timings() or {}}
     return {"results": results}
 
+@app.post("/search/batch")
+async def search_batch(payload: SearchBatch):
+    """Many /search queries in one call: one embedding request and one scoring pass for all of them."""
+    if len(payload.queries) > int(settings.search_batch_max):
+        raise HTTPException(status_code=400, detail=f"At most {settings.search_batch_max} queries per batch")
+    if payload.fusion is not None and payload.fusion not in FUSION_MODES:
+        raise HTTPException(status_code=400, detail=f"fusion must be one of {', '.join(FUSION_MODES)}")
+    top_k = payload.top_k or settings.top_k
+    alpha = (payload.alpha if payload.alpha is not None else settings.retrieval_alpha) if payload.hybrid else None
+    fusion = payload.fusion or settings.fusion_mode
+    filters = _filters(payload.filters)
+    keys = [_retrieval_key(payload.kb_ids, q, top_k, alpha, fusion, filters) for q in payload.queries]
+    results = [retrieval_cache.get(key) for key in keys]
+    # repeated queries are searched once
+    todo = {q: key for q, key, r in zip(payload.queries, keys, results) if r is None}
+    if todo:
+        gens = retrieval_cache.stamp(keys[0][0])
+        with metrics.span("embed_query"):
+            qvecs = await embed_texts(list(todo))
+        with metrics.span("search"):
+            found = dict(zip(todo, await offload.db_read(search_many, payload.kb_ids, list(todo), qvecs, top_k, alpha, fusion, filters)))
+        for q, key in todo.items():
+            retrieval_cache.put(key, gens, found[q])
+        results = [found[q] if r is None else r for q, r in zip(payload.queries, results)]
+    out = {"results": [{"query": q, "results": r} for q, r in zip(payload.queries, results)]}
+    if payload.timings:
+        out["timings"] = metrics.timings() or {}
+    return out
+
+SYSTEM_PROMPT = "You are a helpful assistant. Use the provided context to answer. If unsure, say you don't know."
+
+def _chat_messages(history: List[dict], contexts: List[dict]) -> tuple[List[dict], List[dict]]:
+    """(messages, passages used): system prompt, context packed into the token budget, history."""
+    used = count_message_tokens([{"content": SYSTEM_PROMPT}, {"content": "Context to use:\n"}] + history)
+    context_text, passages = build_context(contexts, used)
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "system", "content": f"Context to use:\n{context_text}"},
+    ] + history, passages
+
+async def _unless_disconnected(request: Request, coro):
+    """Await coro, cancelling it (and the upstream call) if the client goes away first."""
+    task = asyncio.create_task(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=0.5)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                raise HTTPException(status_code=499, detail="Client disconnected")
+    finally:
+        task.cancel()
+
 @app.post("/chat", response_model=ChatResponse)
-async def chat(payload: ChatRequest):
+async def chat(payload: ChatRequest, request: Request):
     # Build system prompt with top-k contexts
-    q = payload.messages[-1].content if payload.messages else ""
-    qvec = (await embed_texts([q]))[0]
-    contexts = hybrid_search(payload.kb_ids, q, qvec, payload.top_k or settings.top_k, settings.retrieval_alpha)
-    context_text = "\n\n".join([f"[Source: {c['title'] or c['source']}]\n{c['text']}" for c in contexts])
-    messages = [
-        {"role": "system", "content": "You are a helpful assistant. Use the provided context to answer. If unsure, say you don't know."},
-        {"role": "system", "content": f"Context to use:\n{context_text}"},
-    ] + [m.model_dump() for m in payload.messages]
+    raw = [m.model_dump() for m in payload.messages]
+    with metrics.span("history"):
+        history = await chat_history.compact(payload.conversation_id, raw)
+        q = await chat_history.retrieval_query(raw, history)
+    contexts = await _chat_contexts(payload.kb_ids, q, payload.top_k or settings.top_k, _filters(payload.filters))
+    with metrics.span("prompt"):
+        messages, contexts = _chat_messages(history, contexts)
 
     try:
-        client = OpenAI(base_url=settings.openai_base_url, api_key=settings.openai_api_key)
-        # Primary: chat.completions
-        resp = client.chat.completions.create(
-            model=settings.chat_model,
-            messages=messages,
-            temperature=0.2,
-        )
-        reply = resp.choices[0].message.content if getattr(resp, "choices", None) else ""
-        if not reply:
-            # Fallback to legacy completions with prompt
-            prompt = "\n".join([f"{m['role'].upper()}: {m['content']}" for m in messages])
-            resp2 = client.completions.create(model=settings.chat_model, prompt=prompt, temperature=0.2)
-            reply = resp2.choices[0].text if getattr(resp2, "choices", None) else ""
+        with metrics.span("llm"):
+            reply = await _unless_disconnected(request, llm.complete(messages))
         return ChatResponse(reply=reply or "", sources=contexts)
+    except HTTPException:
+        raise
+    except llm.ChatBusy as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"Upstream chat error: {str(e)}")
 
@@ -230,75 +500,33 @@ async def chat_stream(request: Request, payload: ChatRequest | None = None, p: s
         raise HTTPException(status_code=400, detail="'messages' cannot be empty")
 
     # ---- build augmented messages with context ----
-    q = payload.messages[-1].content
-    qvec = (await embed_texts([q]))[0]
+    raw = [m.model_dump() for m in payload.messages]
+    with metrics.span("history"):
+        history = await chat_history.compact(payload.conversation_id, raw)
+        q = await chat_history.retrieval_query(raw, history)
     ctx_k = payload.top_k or settings.top_k
-    contexts = hybrid_search(payload.kb_ids, q, qvec, ctx_k, settings.retrieval_alpha)
-    context_text = "\n\n".join([f"[Source: {c['title'] or c['source']}]\n{c['text']}" for c in contexts])
-
-    messages = [
-        {"role": "system", "content": "You are a helpful assistant. Use the provided context to answer. If unsure, say you don't know."},
-        {"role": "system", "content": f"Context to use:\n{context_text}"},
-    ] + [m.model_dump() for m in payload.messages]
-
-    # ---- utilities ----
-    def _v1(path: str) -> str:
-        base = (settings.openai_base_url or "").rstrip("/")
-        if not base.endswith("/v1"):
-            base += "/v1"
-        return f"{base}{path}"
+    contexts = await _chat_contexts(payload.kb_ids, q, ctx_k, _filters(payload.filters))
+    with metrics.span("prompt"):
+        messages, contexts = _chat_messages(history, contexts)
 
-    def messages_to_prompt(msgs: list[dict]) -> str:
-        lines = []
-        for m in msgs:
-            role = (m.get("role") or "").lower()
-            if role == "system": prefix = "SYSTEM"
-            elif role == "user": prefix = "USER"
-            elif role == "assistant": prefix = "ASSISTANT"
-            else: prefix = role.upper() or "USER"
-            lines.append(f"{prefix}: {m.get('content','')}")
-        # Optional: prime the assistant role
-        lines.append("ASSISTANT:")
-        return "\n".join(lines)
-
-    def iterator():
+    async def iterator():
         # send sources up-front
         yield f"event: sources\ndata: {json.dumps(contexts)}\n\n"
+        # a client disconnect cancels this generator, and with it the upstream stream
+        tokens = llm.stream(messages)
+        t0 = time.perf_counter()
+        first = True
         try:
-            client = OpenAI(base_url=settings.openai_base_url, api_key=settings.openai_api_key)
-            # Preferred: chat.completions streaming
-            try:
-                stream = client.chat.completions.create(
-                    model=settings.chat_model,
-                    messages=messages,
-                    temperature=0.2,
-                    stream=True,
-                )
-                for chunk in stream:
-                    try:
-                        delta = getattr(chunk.choices[0].delta, 'content', None)
-                    except Exception:
-                        delta = None
-                    if delta:
-                        yield f"event: token\ndata: {json.dumps(delta)}\n\n"
-            except Exception:
-                # Fallback: legacy /completions streaming with synthesized prompt
-                prompt = messages_to_prompt(messages)
-                stream2 = client.completions.create(
-                    model=settings.chat_model,
-                    prompt=prompt,
-                    temperature=0.2,
-                    stream=True,
-                )
-                for chunk in stream2:
-                    try:
-                        delta = chunk.choices[0].text
-                    except Exception:
-                        delta = None
-                    if delta:
-                        yield f"event: token\ndata: {json.dumps(delta)}\n\n"
+            async for delta in tokens:
+                if first:
+                    # headers are already out, so this one only reaches the histogram
+                    metrics.stage_seconds.observe(time.perf_counter() - t0, stage="llm_first_token")
+                    first = False
+                yield f"event: token\ndata: {json.dumps(delta)}\n\n"
         except Exception as e:
             yield f"event: error\ndata: {json.dumps(str(e))}\n\n"
+        finally:
+            await tokens.aclose()
         yield "event: done\ndata: {}\n\n"
 
     headers = {
@@ -320,11 +548,13 @@ async def update_config(payload: dict):
         if not u.endswith('/v1'):
             u += '/v1'
         return u
-    for key in ("openai_base_url", "openai_api_key", "embedding_model", "chat_model", "top_k", "retrieval_alpha"):
+    for key in ("openai_base_url", "openai_api_key", "embedding_model", "chat_model", "top_k", "retrieval_alpha", "fusion_mode"):
         if key in payload and payload[key] is not None and payload[key] != "":
             val = payload[key]
             if key == "openai_base_url":
                 val = _norm_base(val)
+            if key == "fusion_mode" and val not in FUSION_MODES:
+                continue
             setattr(settings, key, val)
             updated[key] = val
     return {"updated": updated, "current": {
@@ -334,8 +564,13 @@ async def update_config(payload: dict):
         "chat_model": settings.chat_model,
         "top_k": settings.top_k,
         "retrieval_alpha": settings.retrieval_alpha,
+        "fusion_mode": settings.fusion_mode,
     }}
 
 if __name__ == "__main__":
+    import multiprocessing
+    # in the frozen exe, parse workers (offload.parse) start by re-running this entry point;
+    # this hands them to multiprocessing instead of starting another server
+    multiprocessing.freeze_support()
     import uvicorn
     uvicorn.run("app:app", host="127.0.0.1", port=8000, reload=False)
@@ -0,0 +1,91 @@
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Tuple
+import asyncio
+import os
+import zipfile
+
+from . import ingest
+
+# Batch ingest sources: uploaded files, zip archives and local folders, each turned into
+# a list of items {path, name, source, source_key, meta} that parse_many feeds to the readers.
+
+
+def _ext(name: str) -> str:
+    return (name.rsplit(".", 1)[-1] if "." in name else "").lower()
+
+
+def directory_items(root: str, recursive: bool = True) -> List[Dict]:
+    """Supported files under a local folder, keyed by absolute path like /ingest/file from Electron."""
+    root = os.path.abspath(root)
+    items: List[Dict] = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        if not recursive:
+            dirnames[:] = []
+        for name in sorted(filenames):
+            if name.startswith(".") or _ext(name) not in ingest.SUPPORTED_EXTENSIONS:
+                continue
+            path = os.path.join(dirpath, name)
+            items.append({"path": path, "name": name, "source": name, "source_key": path, "meta": {"file_path": path}})
+    return items
+
+
+def zip_items(zip_path: str, archive_name: str, dest: str) -> List[Dict]:
+    """Extract supported members of a zip into dest; sources are keyed as <archive>/<member>."""
+    items: List[Dict] = []
+    with zipfile.ZipFile(zip_path) as zf:
+        for i, info in enumerate(zf.infolist()):
+            member = info.filename
+            name = member.rstrip("/").split("/")[-1]
+            if info.is_dir() or not name or name.startswith(".") or member.startswith("__MACOSX/"):
+                continue
+            if _ext(name) not in ingest.SUPPORTED_EXTENSIONS:
+                continue
+            # member names are never used as paths on disk (zip slip)
+            path = os.path.join(dest, f"z{i}.{_ext(name)}")
+            with zf.open(info) as src, open(path, "wb") as out:
+                while True:
+                    block = src.read(1 << 20)
+                    if not block:
+                        break
+                    out.write(block)
+            items.append({"path": path, "name": name, "source": name, "source_key": f"{archive_name}/{member}", "meta": None})
+    return items
+
+
+async def parse_many(items: List[Dict], extract: Callable[[str, str, str], Awaitable[Tuple[str, str, int]]],
+                     spool: str, window: int) -> AsyncIterator[Dict]:
+    """Extract items' text into files under spool with up to `window` in flight.
+
+    Yields documents (see pipeline.ingest_batch) as they finish; each spooled text file is
+    removed once the consumer asks for the next document.
+    """
+    todo = iter(enumerate(items))
+    running: Dict[asyncio.Task, Tuple[Dict, str]] = {}
+
+    def fill():
+        while len(running) < max(1, window):
+            n, item = next(todo, (None, None))
+            if item is None:
+                return
+            out = os.path.join(spool, f"t{n}.txt")
+            running[asyncio.create_task(extract(item["path"], item["name"], out))] = (item, out)
+
+    fill()
+    try:
+        while running:
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                item, out = running.pop(task)
+                doc = {"source": item["source"], "title": item["name"], "source_key": item["source_key"], "meta": item["meta"]}
+                try:
+                    doc["type"], doc["digest"], doc["chars"] = task.result()
+                    doc["text_path"] = out
+                except Exception as e:
+                    doc["error"] = f"Failed to parse file: {e}"
+                yield doc
+                if os.path.exists(out):
+                    os.remove(out)
+            fill()
+    finally:
+        for task in running:
+            task.cancel()
@@ -0,0 +1,343 @@
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+import logging
+import re
+import numpy as np
+
+from .config import settings
+
+# Chunkers turn a document's text (whole, or streamed as pieces) into Chunks that carry
+# their character span in that text, so results can cite exactly where they came from.
+#
+#   "structured" (default): packs paragraphs up to max_chunk_tokens real tokens. Readers
+#       mark structure in the text: blank lines end paragraphs, "\f" ends a page, sheet
+#       or slide, and "#" lines are headings; chunks never cross a page break and a
+#       heading always starts a new chunk. Oversized paragraphs are split by lines, then
+#       sentences, then words, then token windows. Chunk text is the exact span.
+#   "words": the original whitespace-word windows (chunk_text), the fast path. Chunk
+#       text is the words joined by single spaces; the span covers them in the source.
+
+
+class Chunk(NamedTuple):
+    text: str
+    start: int  # character offsets into the document text
+    end: int
+
+
+# ---- tokenizers ----------------------------------------------------------------------
+
+class RegexTokenizer:
+    """Dependency-free estimate: ~4 characters per word token, punctuation counts one."""
+
+    name = "regex"
+    _piece = re.compile(r"\w+|[^\w\s]")
+
+    def count(self, text: str) -> int:
+        return sum((len(p) + 3) // 4 for p in self._piece.findall(text))
+
+    def windows(self, text: str, size: int, overlap: int) -> List[Tuple[int, int]]:
+        bounds: List[Tuple[int, int]] = []  # (start, end) per token
+        for m in self._piece.finditer(text):
+            s, e = m.span()
+            for k in range(s, e, 4):
+                bounds.append((k, min(k + 4, e)))
+        return _token_windows(bounds, len(text), size, overlap)
+
+
+class TiktokenTokenizer:
+    def __init__(self, encoding: str):
+        import tiktoken  # optional dependency
+        self.name = f"tiktoken:{encoding}"
+        self._enc = tiktoken.get_encoding(encoding)
+
+    def count(self, text: str) -> int:
+        return len(self._enc.encode_ordinary(text))
+
+    def windows(self, text: str, size: int, overlap: int) -> List[Tuple[int, int]]:
+        tokens = self._enc.encode_ordinary(text)
+        _, starts = self._enc.decode_with_offsets(tokens)
+        bounds = [(s, starts[i + 1] if i + 1 < len(starts) else len(text)) for i, s in enumerate(starts)]
+        return _token_windows(bounds, len(text), size, overlap)
+
+
+class HFTokenizer:
+    """A local tokenizer.json (Hugging Face tokenizers), e.g. the embedding model's own."""
+
+    def __init__(self, path: str):
+        from tokenizers import Tokenizer  # optional dependency
+        self.name = path
+        self._tok = Tokenizer.from_file(path)
+
+    def count(self, text: str) -> int:
+        return len(self._tok.encode(text, add_special_tokens=False).ids)
+
+    def windows(self, text: str, size: int, overlap: int) -> List[Tuple[int, int]]:
+        offsets = self._tok.encode(text, add_special_tokens=False).offsets
+        return _token_windows([tuple(o) for o in offsets], len(text), size, overlap)
+
+
+def _token_windows(bounds: List[Tuple[int, int]], length: int, size: int, overlap: int) -> List[Tuple[int, int]]:
+    if not bounds:
+        return [(0, length)] if length else []
+    step = size - overlap if size > overlap else size
+    out = []
+    for i in range(0, len(bounds), step):
+        j = min(i + size, len(bounds)) - 1
+        out.append((bounds[i][0], bounds[j][1]))
+        if j == len(bounds) - 1:
+            break
+    return out
+
+
+def load_tokenizer(spec: str):
+    """"auto" | "regex" | "tiktoken:<encoding>" | path to a tokenizer.json."""
+    spec = (spec or "auto").strip()
+    if spec == "regex":
+        return RegexTokenizer()
+    try:
+        if spec == "auto":
+            return TiktokenTokenizer("cl100k_base")
+        if spec.startswith("tiktoken:"):
+            return TiktokenTokenizer(spec.split(":", 1)[1])
+        return HFTokenizer(spec)
+    except Exception as e:
+        # tiktoken/tokenizers not installed, or the encoding file can't be loaded offline
+        if spec != "auto":
+            logging.warning(f"Tokenizer {spec!r} unavailable ({e}); estimating tokens instead")
+        return RegexTokenizer()
+
+
+# ---- word chunker (fast path) ------------------------------------------------------
+
+# Characters str.split() treats as whitespace
+_WHITESPACE = np.array(
+    [9, 10, 11, 12, 13, 28, 29, 30, 31, 32, 0x85, 0xA0, 0x1680, *range(0x2000, 0x200B),
+     0x2028, 0x2029, 0x202F, 0x205F, 0x3000],
+    dtype=np.uint32,
+)
+
+
+def _word_spans(text: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Start/end offsets of the words text.split() returns."""
+    codes = np.frombuffer(text.encode("utf-32-le", errors="surrogatepass"), dtype=np.uint32)
+    word = (~np.isin(codes, _WHITESPACE)).astype(np.int8)
+    edges = np.diff(np.concatenate(([0], word, [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+class WordChunker:
+    name = "words"
+
+    def __init__(self, max_tokens: int, overlap: int):
+        self.max_tokens = max_tokens
+        self.step = max_tokens - overlap if max_tokens > overlap else max_tokens
+
+    def chunk(self, text: str) -> List[Chunk]:
+        return list(self.iter_chunks([text]))
+
+    def iter_chunks(self, pieces: Iterable[str]) -> Iterator[Chunk]:
+        """Same chunks as ingest.chunk_text("".join(pieces)), holding about one chunk of words."""
+        size, step = self.max_tokens, self.step
+        words: List[str] = []
+        starts: List[int] = []
+        ends: List[int] = []
+        tail, base = "", 0  # carried partial word and the offset where it starts
+        for piece in pieces:
+            if not piece:
+                continue
+            text = tail + piece
+            parts = text.split()
+            s, e = _word_spans(text)
+            if parts and not text[-1].isspace():
+                # the last word may continue in the next piece
+                parts.pop()
+                tail, tail_at = text[s[-1]:], int(s[-1])
+                s, e = s[:-1], e[:-1]
+            else:
+                tail, tail_at = "", len(text)
+            words.extend(parts)
+            starts.extend((s + base).tolist())
+            ends.extend((e + base).tolist())
+            base += tail_at
+            i = 0
+            while len(words) - i >= size:
+                yield Chunk(" ".join(words[i:i + size]), starts[i], ends[i + size - 1])
+                # the next chunk starts `step` words later; the overlap stays buffered
+                i += step
+            del words[:i], starts[:i], ends[:i]
+        if tail:
+            words.append(tail)
+            starts.append(base)
+            ends.append(base + len(tail))
+        for i in range(0, len(words), step):
+            j = min(i + size, len(words))
+            yield Chunk(" ".join(words[i:j]), starts[i], ends[j - 1])
+
+
+# ---- structured chunker ----------------------------------------------------------------
+
+class _Unit(NamedTuple):
+    start: int  # global offset of text
+    text: str
+    lead: str  # exact text between the previous unit and this one
+    tokens: int
+
+
+# blank line(s) end a paragraph; a form feed ends a page/sheet/slide
+_BLOCK_SEP = re.compile(r"\n[ \t\r]*\n\s*|\f\s*")
+_HEADING = re.compile(r"#{1,6}\s")
+# finer separators for paragraphs over the token limit: lines, sentences, words
+_SPLITS = [re.compile(r"\n+"), re.compile(r"(?<=[.!?;:])\s+"), re.compile(r"\s+")]
+
+
+class StructuredChunker:
+    name = "structured"
+
+    def __init__(self, max_tokens: int, overlap: int, tokenizer):
+        self.max_tokens = max(1, max_tokens)
+        self.overlap = max(0, min(overlap, self.max_tokens - 1))
+        self.tokenizer = tokenizer
+        # longest paragraph buffered while streaming before it is cut at a line break
+        self.max_block_chars = max(65536, 32 * self.max_tokens)
+
+    def chunk(self, text: str) -> List[Chunk]:
+        return list(self.iter_chunks([text]))
+
+    def iter_chunks(self, pieces: Iterable[str]) -> Iterator[Chunk]:
+        group: List[_Unit] = []
+        used = 0
+        for unit in self._units(self._blocks(pieces)):
+            if unit is None:
+                if group:
+                    yield _join(group)
+                group, used = [], 0
+                continue
+            if group and used + unit.tokens + 1 > self.max_tokens:
+                yield _join(group)
+                group, used = self._carry(group, unit.tokens)
+            group.append(unit)
+            used += unit.tokens + (1 if len(group) > 1 else 0)
+        if group:
+            yield _join(group)
+
+    def _carry(self, group: List[_Unit], incoming: int) -> Tuple[List[_Unit], int]:
+        # trailing units worth up to `overlap` tokens start the next chunk
+        carried: List[_Unit] = []
+        used = 0
+        for unit in reversed(group[1:]):
+            if used + unit.tokens + 1 > self.overlap or used + unit.tokens + incoming + 2 > self.max_tokens:
+                break
+            carried.insert(0, unit)
+            used += unit.tokens + 1
+        return carried, max(0, used - 1)
+
+    def _blocks(self, pieces: Iterable[str]) -> Iterator[Optional[Tuple[int, str, str]]]:
+        """(offset, text, lead) per paragraph, None at page breaks, from a stream of pieces."""
+        buf, at, lead = "", 0, ""
+        for piece in pieces:
+            buf += piece
+            pos = 0
+            for m in _BLOCK_SEP.finditer(buf):
+                if m.end() >= len(buf):
+                    break  # the separator may continue in the next piece
+                segment = buf[pos:m.start()]
+                body = segment.rstrip()
+                if body.strip():
+                    yield at + pos, body, lead
+                    lead = ""
+                # trailing whitespace belongs with the separator
+                lead += segment[len(body):] if body.strip() else segment
+                lead += m.group()
+                if "\f" in m.group():
+                    yield None
+                pos = m.end()
+            if len(buf) - pos > self.max_block_chars:
+                # no paragraph break in sight: hand over a slice ending at a line break or space
+                limit = pos + self.max_block_chars
+                cut = buf.rfind("\n", pos, limit)
+                if cut <= pos:
+                    cut = buf.rfind(" ", pos, limit)
+                cut = cut + 1 if cut > pos else limit
+                body = buf[pos:cut].rstrip()
+                if body.strip():
+                    yield at + pos, body, lead
+                    lead = buf[pos + len(body):cut]
+                else:
+                    lead += buf[pos:cut]
+                pos = cut
+            buf, at = buf[pos:], at + pos
+        if buf.strip():
+            yield at, buf.rstrip(), lead
+
+    def _units(self, blocks) -> Iterator[Optional[_Unit]]:
+        for block in blocks:
+            if block is None:
+                yield None
+                continue
+            start, text, lead = block
+            if _HEADING.match(text.lstrip()):
+                yield None
+            yield from self._split(start, text, lead, 0)
+
+    def _split(self, start: int, text: str, lead: str, level: int) -> Iterator[Optional[_Unit]]:
+        n = self.tokenizer.count(text)
+        if n <= self.max_tokens:
+            yield _Unit(start, text, lead, n)
+            return
+        if level == len(_SPLITS):
+            # a single "word" over the limit: fixed token windows, each its own chunk
+            yield None
+            for s, e in self.tokenizer.windows(text, self.max_tokens, self.overlap):
+                yield _Unit(start + s, text[s:e], "", self.max_tokens)
+                yield None
+            return
+        parts: List[Tuple[int, int]] = []
+        pos = 0
+        for m in _SPLITS[level].finditer(text):
+            if m.start() > pos:
+                parts.append((pos, m.start()))
+            pos = m.end()
+        if pos < len(text):
+            parts.append((pos, len(text)))
+        if len(parts) == 1:
+            yield from self._split(start, text, lead, level + 1)
+            return
+        prev_end = 0
+        for k, (s, e) in enumerate(parts):
+            gap = lead + text[:s] if k == 0 else text[prev_end:s]
+            yield from self._split(start + s, text[s:e], gap, level + 1)
+            prev_end = e
+
+
+def _join(group: List[_Unit]) -> Chunk:
+    text = group[0].text + "".join(u.lead + u.text for u in group[1:])
+    return Chunk(text, group[0].start, group[0].start + len(text))
+
+
+_tokenizer = None
+_tokenizer_spec = None
+
+
+def get_tokenizer():
+    """The tokenizer selected by chunk_tokenizer, also used to budget chat prompts."""
+    global _tokenizer, _tokenizer_spec
+    if _tokenizer is None or _tokenizer_spec != settings.chunk_tokenizer:
+        _tokenizer = load_tokenizer(settings.chunk_tokenizer)
+        _tokenizer_spec = settings.chunk_tokenizer
+    return _tokenizer
+
+
+_chunker = None
+_chunker_key = None
+
+
+def get_chunker():
+    """The chunker selected by settings (rebuilt when they change)."""
+    global _chunker, _chunker_key
+    key = (settings.chunker, settings.chunk_tokenizer, int(settings.max_chunk_tokens), int(settings.chunk_overlap_tokens))
+    if _chunker is None or key != _chunker_key:
+        if settings.chunker == "words":
+            _chunker = WordChunker(key[2], key[3])
+        else:
+            _chunker = StructuredChunker(key[2], key[3], get_tokenizer())
+        _chunker_key = key
+    return _chunker
@@ -8,22 +8,126 @@ class Settings(BaseModel):
     data_dir: str = os.path.join(os.getenv("LOCALAPPDATA", os.path.expanduser("~")), "RAG-CHAT", "data")
     db_path: str = os.path.join(data_dir, "knowledge.db")
 
+    # SQLite connection pool pragmas (applied to every pooled connection)
+    sqlite_synchronous: str = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")  # NORMAL is durable enough under WAL
+    sqlite_cache_size_kb: int = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+    sqlite_mmap_size_mb: int = int(os.getenv("SQLITE_MMAP_SIZE_MB", "256"))
+    sqlite_temp_store: str = os.getenv("SQLITE_TEMP_STORE", "MEMORY")
+    sqlite_busy_timeout_ms: int = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+    # Server-Timing response header with the request's per-stage milliseconds
+    server_timing: bool = os.getenv("SERVER_TIMING", "1") not in ("0", "false", "False")
+    # Threads serving DB reads and searches for the async handlers (writes use one thread);
+    # 0 runs reads on the event loop
+    db_read_threads: int = int(os.getenv("DB_READ_THREADS", str(min(8, os.cpu_count() or 1))))
+    # upsert_embeddings writes a document in one transaction, committing every this many rows (0 = never split)
+    upsert_commit_rows: int = int(os.getenv("UPSERT_COMMIT_ROWS", "10000"))
+
     # LM Studio / OpenAI-compatible endpoints
     openai_base_url: str = os.getenv("OPENAI_BASE_URL", "http://127.0.0.1:1234/v1")
     openai_api_key: str = os.getenv("OPENAI_API_KEY", "lm-studio")
     embedding_model: str = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
     chat_model: str = os.getenv("CHAT_MODEL", "gpt-3.5-turbo")
+    # Chat model calls share one pooled client; at most chat_concurrency run upstream at once,
+    # chat_queue_max more may wait up to chat_queue_timeout_seconds, the rest get a 503
+    chat_concurrency: int = int(os.getenv("CHAT_CONCURRENCY", "4"))
+    chat_queue_max: int = int(os.getenv("CHAT_QUEUE_MAX", "32"))
+    chat_queue_timeout_seconds: float = float(os.getenv("CHAT_QUEUE_TIMEOUT_SECONDS", "30"))
+    chat_timeout_seconds: float = float(os.getenv("CHAT_TIMEOUT_SECONDS", "300"))
+    chat_max_connections: int = int(os.getenv("CHAT_MAX_CONNECTIONS", "16"))
 
     # RAG params
     top_k: int = int(os.getenv("TOP_K", "5"))
     max_chunk_tokens: int = int(os.getenv("MAX_CHUNK_TOKENS", "512"))
     chunk_overlap_tokens: int = int(os.getenv("CHUNK_OVERLAP_TOKENS", "64"))
+    # "structured" packs paragraphs by real token counts; "words" is the fast whitespace-word path
+    chunker: str = os.getenv("CHUNKER", "structured")
+    # "auto" (tiktoken cl100k_base if installed and cached, else an estimate), "regex",
+    # "tiktoken:<encoding>" or a path to the embedding model's tokenizer.json
+    chunk_tokenizer: str = os.getenv("CHUNK_TOKENIZER", "auto")
     # Retrieval blending alpha (0..1). Higher favors semantic over keyword.
     retrieval_alpha: float = float(os.getenv("RETRIEVAL_ALPHA", "0.6"))
+    # Hybrid fusion: "normalized" (min-max scores, alpha blend; 0..1 scores as the UI shows them)
+    # or "rrf" (reciprocal rank fusion, opt-in; scores are small rank sums around 1/rrf_k).
+    # Each retriever contributes up to its candidate depth (at least top_k) before fusion.
+    fusion_mode: str = os.getenv("FUSION_MODE", "normalized")
+    rrf_k: int = int(os.getenv("RRF_K", "60"))
+    semantic_candidates: int = int(os.getenv("SEMANTIC_CANDIDATES", "50"))
+    keyword_candidates: int = int(os.getenv("KEYWORD_CANDIDATES", "50"))
+    # Optional rerank stage for /chat: "off", "onnx" (local cross-encoder folder with model.onnx
+    # and tokenizer.json) or "endpoint" (POST /v1/rerank on the OpenAI-compatible server).
+    # rerank_candidates fused hits are scored and the best top_k kept; past the latency
+    # budget the fused order is used instead.
+    reranker: str = os.getenv("RERANKER", "off")
+    rerank_model: str = os.getenv("RERANK_MODEL", "")
+    rerank_onnx_path: str = os.getenv("RERANK_ONNX_PATH", "")
+    rerank_candidates: int = int(os.getenv("RERANK_CANDIDATES", "20"))
+    rerank_batch_size: int = int(os.getenv("RERANK_BATCH_SIZE", "16"))
+    rerank_budget_ms: float = float(os.getenv("RERANK_BUDGET_MS", "800"))
+    rerank_cache_items: int = int(os.getenv("RERANK_CACHE_ITEMS", "20000"))
+    # Chat prompt packing: retrieved passages get at most context_max_tokens, and less when
+    # the prompt, history and chat_answer_tokens would overflow the model's chat_context_tokens.
+    # Passages with word 3-gram overlap >= context_dedup_threshold of a better one are dropped.
+    chat_context_tokens: int = int(os.getenv("CHAT_CONTEXT_TOKENS", "8192"))
+    chat_answer_tokens: int = int(os.getenv("CHAT_ANSWER_TOKENS", "1024"))
+    context_max_tokens: int = int(os.getenv("CONTEXT_MAX_TOKENS", "3000"))
+    context_dedup_threshold: float = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.8"))
+    # Chat history: once it exceeds history_max_tokens, all but the last history_keep_messages
+    # are replaced by a rolling summary (cached per conversation). Retrieval query rewriting:
+    # "context" (prepend the previous question to follow-ups), "llm" (standalone query) or "off".
+    history_keep_messages: int = int(os.getenv("HISTORY_KEEP_MESSAGES", "6"))
+    history_max_tokens: int = int(os.getenv("HISTORY_MAX_TOKENS", "2048"))
+    history_summary_tokens: int = int(os.getenv("HISTORY_SUMMARY_TOKENS", "400"))
+    history_cache_items: int = int(os.getenv("HISTORY_CACHE_ITEMS", "1000"))
+    query_rewrite: str = os.getenv("QUERY_REWRITE", "context")
+    # Cached /search and /chat retrievals (0 items disables); entries also expire after the TTL
+    retrieval_cache_items: int = int(os.getenv("RETRIEVAL_CACHE_ITEMS", "512"))
+    retrieval_cache_ttl: float = float(os.getenv("RETRIEVAL_CACHE_TTL", "300"))
+    # Per-document fields (source, title, file path) kept for hydrating search results
+    doc_cache_items: int = int(os.getenv("DOC_CACHE_ITEMS", "4096"))
+    # Most queries accepted by one /search/batch request
+    search_batch_max: int = int(os.getenv("SEARCH_BATCH_MAX", "512"))
+
+    # Resident vector index: "exact" (full matrix product) or "ivf" (approximate, clustered).
+    # In IVF mode only the ivf_nprobe nearest of ivf_nlist clusters are scored; raise nprobe for recall.
+    vector_index_mode: str = os.getenv("VECTOR_INDEX_MODE", "exact")
+    ivf_nlist: int = int(os.getenv("IVF_NLIST", "0"))  # 0 = ~sqrt(rows)
+    ivf_nprobe: int = int(os.getenv("IVF_NPROBE", "8"))
+    ivf_min_rows: int = int(os.getenv("IVF_MIN_ROWS", "20000"))  # below this, exact search is used
+    # Memory-mapped sidecar vector files next to the DB: "off", "float32" or "float16"
+    vector_store: str = os.getenv("VECTOR_STORE", "off")
+    # Quantized resident index: "none", "int8" (scalar) or "pq" (product quantization).
+    # Codes pick quant_rerank_factor * top_k candidates that are re-scored with the float32
+    # vectors from SQLite. When enabled it replaces the vector_store index.
+    vector_codec: str = os.getenv("VECTOR_CODEC", "none")
+    pq_subvectors: int = int(os.getenv("PQ_SUBVECTORS", "0"))  # 0 = dim/8 (rounded to a divisor of dim)
+    quant_rerank_factor: int = int(os.getenv("QUANT_RERANK_FACTOR", "10"))
 
     # Embedding client
     embedding_batch_size: int = int(os.getenv("EMBEDDING_BATCH_SIZE", "128"))
     embedding_timeout_seconds: float = float(os.getenv("EMBEDDING_TIMEOUT_SECONDS", "120"))
     embedding_max_retries: int = int(os.getenv("EMBEDDING_MAX_RETRIES", "3"))
+    # Batches in flight per embed call, pooled connections, and adaptive batch sizing bounds
+    # (embedding_batch_size is the upper limit on texts per request)
+    embedding_concurrency: int = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+    embedding_max_connections: int = int(os.getenv("EMBEDDING_MAX_CONNECTIONS", "8"))
+    embedding_target_batch_seconds: float = float(os.getenv("EMBEDDING_TARGET_BATCH_SECONDS", "2.0"))
+    embedding_max_batch_chars: int = int(os.getenv("EMBEDDING_MAX_BATCH_CHARS", "200000"))
+    # Embedding cache keyed by (model, sha256(text)): in-process LRU plus a size-bounded table
+    embedding_cache: bool = os.getenv("EMBEDDING_CACHE", "1") not in ("0", "false", "False")
+    embedding_cache_hot_items: int = int(os.getenv("EMBEDDING_CACHE_HOT_ITEMS", "20000"))
+    embedding_cache_max_mb: int = int(os.getenv("EMBEDDING_CACHE_MAX_MB", "1024"))
+
+    # Background ingestion jobs: queued jobs beyond job_queue_max are rejected (HTTP 429);
+    # job_workers run concurrently and file parsing uses job_parse_workers processes
+    job_queue_max: int = int(os.getenv("JOB_QUEUE_MAX", "256"))
+    job_workers: int = int(os.getenv("JOB_WORKERS", "2"))
+    job_parse_workers: int = int(os.getenv("JOB_PARSE_WORKERS", "2"))
+    # Batch ingest: documents are grouped until this many new chunks are pending, then
+    # embedded together and written in one transaction
+    ingest_batch_chunks: int = int(os.getenv("INGEST_BATCH_CHUNKS", "2048"))
+    # Memory budget for streamed file ingestion: chunks and vectors in flight per document
+    # (larger documents are embedded and written in windows of about this size)
+    ingest_memory_mb: int = int(os.getenv("INGEST_MEMORY_MB", "256"))
+    job_history: int = int(os.getenv("JOB_HISTORY", "200"))  # finished jobs kept for GET /jobs
 
 settings = Settings()
@@ -0,0 +1,136 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+import re
+
+from .config import settings
+from .chunking import get_tokenizer
+
+# Builds the "Context to use" system message from ranked retrieval results:
+#   1. hits from the same document that are adjacent or overlap (chunks share
+#      chunk_overlap_tokens of text) are merged into one passage, the overlap kept once;
+#   2. passages that are near-duplicates of a better-ranked one (same text ingested
+#      twice, boilerplate) are dropped;
+#   3. passages are packed best first until the token budget is spent, the last one
+#      truncated if enough room is left for it to be useful.
+# The budget is context_max_tokens, further capped so the prompt, the history and
+# chat_answer_tokens of answer fit in chat_context_tokens.
+
+_WORD = re.compile(r"\w+")
+MIN_PASSAGE_TOKENS = 48
+
+
+def _verbatim(item: Dict) -> bool:
+    # structured chunks are exact spans of the document text; word chunks are re-spaced
+    s, e = item.get("char_start"), item.get("char_end")
+    return s is not None and e is not None and e - s == len(item["text"])
+
+
+def _join(a: Dict, b: Dict) -> str:
+    """a's text followed by b's (which overlaps or directly follows it) without the shared part."""
+    if _verbatim(a) and _verbatim(b):
+        if b["char_start"] >= a["char_end"]:
+            # consecutive chunks with a paragraph (or page) break between them
+            return a["text"] + "\n" + b["text"]
+        return a["text"] + b["text"][a["char_end"] - b["char_start"]:]
+    # word chunks: b repeats a tail of a's words (the configured overlap) or continues it
+    wa, wb = a["text"].split(), b["text"].split()
+    for n in range(min(len(wa), len(wb)), 0, -1):
+        if wa[-n:] == wb[:n]:
+            return " ".join(wa + wb[n:])
+    return a["text"] + " " + b["text"]
+
+
+def _touches(current: Dict, item: Dict) -> bool:
+    if item["chunk_index"] == current["chunk_indices"][-1] + 1:
+        return True
+    spans = current.get("char_end") is not None and item.get("char_start") is not None
+    return spans and item["char_start"] <= current["char_end"]
+
+
+def merge_adjacent(contexts: Sequence[Dict]) -> List[Dict]:
+    """Merge hits of the same document that touch; a passage keeps the rank of its best hit."""
+    by_doc: Dict[int, List[Tuple[int, Dict]]] = {}
+    for rank, item in enumerate(contexts):
+        by_doc.setdefault(item["document_id"], []).append((rank, item))
+    passages: List[Tuple[int, Dict]] = []
+    for hits in by_doc.values():
+        hits.sort(key=lambda h: (h[1].get("char_start") is None, h[1].get("char_start") or 0, h[1]["chunk_index"]))
+        current: Optional[Dict] = None
+        best = 0
+        for rank, item in hits:
+            if current is not None and _touches(current, item):
+                current["text"] = _join(current, item)
+                current["chunk_indices"].append(item["chunk_index"])
+                if item.get("char_end") is not None and current.get("char_end") is not None:
+                    current["char_end"] = max(current["char_end"], item["char_end"])
+                best = min(best, rank)
+                continue
+            if current is not None:
+                passages.append((best, current))
+            current, best = {**item, "chunk_indices": [item["chunk_index"]]}, rank
+        if current is not None:
+            passages.append((best, current))
+    passages.sort(key=lambda p: p[0])
+    return [p for _, p in passages]
+
+
+def _shingles(text: str) -> set:
+    words = _WORD.findall(text.lower())
+    return {" ".join(words[i:i + 3]) for i in range(max(1, len(words) - 2))}
+
+
+def drop_near_duplicates(passages: Sequence[Dict], threshold: Optional[float] = None) -> List[Dict]:
+    """Drop passages whose word 3-grams mostly (Jaccard >= threshold) repeat a better-ranked one."""
+    threshold = float(settings.context_dedup_threshold if threshold is None else threshold)
+    kept: List[Tuple[Dict, set]] = []
+    for p in passages:
+        sh = _shingles(p["text"])
+        if any(len(sh & other) >= threshold * len(sh | other) for _, other in kept):
+            continue
+        kept.append((p, sh))
+    return [p for p, _ in kept]
+
+
+def context_budget(history_tokens: int, overhead_tokens: int = 0) -> int:
+    room = int(settings.chat_context_tokens) - int(settings.chat_answer_tokens) - history_tokens - overhead_tokens
+    return max(0, min(int(settings.context_max_tokens), room))
+
+
+def _header(p: Dict) -> str:
+    return f"[Source: {p.get('title') or p.get('source')}]\n"
+
+
+def pack(passages: Sequence[Dict], budget: int) -> List[Dict]:
+    """Best passages that fit in ``budget`` tokens (headers included), the last possibly cut short."""
+    tok = get_tokenizer()
+    packed: List[Dict] = []
+    used = 0
+    for p in passages:
+        header = tok.count(_header(p)) + 1
+        cost = header + tok.count(p["text"])
+        if used + cost <= budget:
+            packed.append(p)
+            used += cost
+            continue
+        room = budget - used - header - 2  # the " ..." marker
+        if room < MIN_PASSAGE_TOKENS:
+            continue  # a smaller passage further down may still fit
+        s, e = tok.windows(p["text"], room, 0)[0]
+        cut = {**p, "text": p["text"][s:e].rstrip() + " ...", "truncated": True}
+        if _verbatim(p):
+            cut["char_start"], cut["char_end"] = p["char_start"] + s, p["char_start"] + e
+        packed.append(cut)
+        break
+    return packed
+
+
+def build_context(contexts: Sequence[Dict], history_tokens: int = 0) -> Tuple[str, List[Dict]]:
+    """(context text, passages used) for the chat prompt."""
+    passages = drop_near_duplicates(merge_adjacent(contexts))
+    packed = pack(passages, context_budget(history_tokens))
+    return "\n\n".join(_header(p) + p["text"] for p in packed), packed
+
+
+def count_message_tokens(messages: Sequence[Dict]) -> int:
+    tok = get_tokenizer()
+    # ~4 tokens of chat-template framing per message
+    return sum(tok.count(m.get("content") or "") + 4 for m in messages)
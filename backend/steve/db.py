@@ -1,5 +1,6 @@
 import os
 import sqlite3
+import threading
 from contextlib import contextmanager
 
 from .config import settings
@@ -13,40 +14,6 @@ try:
 except Exception as e:
     logging.error(f"Failed to create DB directory: {e}")
 
-# Ensure the DB file exists and is initialized
-def ensure_db():
-    try:
-        with get_conn() as conn:
-            conn.executescript(SCHEMA_SQL)
-            # Lightweight migrations for existing DBs: add columns if missing
-            try:
-                cols = {r[1] for r in conn.execute("PRAGMA table_info(embedding)").fetchall()}
-                if "model" not in cols:
-                    conn.execute("ALTER TABLE embedding ADD COLUMN model TEXT")
-                if "dim" not in cols:
-                    conn.execute("ALTER TABLE embedding ADD COLUMN dim INTEGER")
-                if "is_normalized" not in cols:
-                    conn.execute("ALTER TABLE embedding ADD COLUMN is_normalized INTEGER NOT NULL DEFAULT 0")
-            except Exception:
-                pass
-            # Ensure indexes exist (idempotent in SQLite with IF NOT EXISTS above)
-            # Backfill chunk_fts from existing embeddings if empty
-            try:
-                cnt = conn.execute("SELECT COUNT(*) AS c FROM chunk_fts").fetchone()["c"]
-                if cnt == 0:
-                    rows = conn.execute("SELECT document_id, chunk_index, text FROM embedding").fetchall()
-                    for r in rows:
-                        conn.execute(
-                            "INSERT INTO chunk_fts(content, document_id, chunk_index) VALUES(?,?,?)",
-                            (r["text"], r["document_id"], r["chunk_index"]),
-                        )
-            except Exception:
-                pass
-    except Exception as e:
-        logging.error(f"Failed to initialize DB: {e}")
-
-ensure_db()
-
 SCHEMA_SQL = """
 PRAGMA journal_mode=WAL;
 
@@ -64,6 +31,8 @@ CREATE TABLE IF NOT EXISTS document (
     type TEXT NOT NULL,
     content TEXT NOT NULL,
     meta TEXT,
+    source_key TEXT,  -- file path or URL identifying re-ingests of the same source
+    content_hash TEXT,  -- sha256 of content, to skip unchanged re-ingests
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY(kb_id) REFERENCES knowledgebase(id)
 );
@@ -77,17 +46,25 @@ CREATE VIRTUAL TABLE IF NOT EXISTS doc_fts USING fts5(
 CREATE TABLE IF NOT EXISTS embedding (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     document_id INTEGER NOT NULL,
+    kb_id INTEGER,  -- denormalized from document so KB scoping needs no join
     chunk_index INTEGER NOT NULL,
     vector BLOB NOT NULL,
     text TEXT NOT NULL,
     model TEXT,
     dim INTEGER,
     is_normalized INTEGER NOT NULL DEFAULT 0,
+    codec TEXT,  -- encoding of `code`: NULL or 'int8' (float32 scale + int8 values)
+    code BLOB,
+    char_start INTEGER,  -- span of the chunk in document.content
+    char_end INTEGER,
     FOREIGN KEY(document_id) REFERENCES document(id)
 );
 
 CREATE INDEX IF NOT EXISTS idx_embedding_doc ON embedding(document_id);
 CREATE INDEX IF NOT EXISTS idx_doc_kb ON document(kb_id);
+-- search filters on document type and ingest time
+CREATE INDEX IF NOT EXISTS idx_doc_type ON document(kb_id, type);
+CREATE INDEX IF NOT EXISTS idx_doc_created ON document(kb_id, created_at);
 CREATE UNIQUE INDEX IF NOT EXISTS ux_embedding_doc_chunk ON embedding(document_id, chunk_index);
 
 -- Chunk-level FTS for hybrid alignment
@@ -95,44 +72,182 @@ CREATE VIRTUAL TABLE IF NOT EXISTS chunk_fts USING fts5(
     content,
     document_id UNINDEXED,
     chunk_index UNINDEXED,
+    kb_id UNINDEXED,
     tokenize = 'porter'
 );
+
+-- Content-addressed embedding cache (see steve.embedding_cache)
+CREATE TABLE IF NOT EXISTS embedding_cache (
+    model TEXT NOT NULL,
+    hash BLOB NOT NULL,
+    vector BLOB NOT NULL,
+    bytes INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY(model, hash)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_embedding_cache_lru ON embedding_cache(last_used);
 """
 
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(settings.db_path, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    # Per-connection tuning; journal_mode=WAL is persistent and set by the schema
+    conn.execute(f"PRAGMA busy_timeout={int(settings.sqlite_busy_timeout_ms)}")
+    conn.execute(f"PRAGMA synchronous={settings.sqlite_synchronous}")
+    conn.execute(f"PRAGMA cache_size={-int(settings.sqlite_cache_size_kb)}")
+    conn.execute(f"PRAGMA mmap_size={int(settings.sqlite_mmap_size_mb) * 1024 * 1024}")
+    conn.execute(f"PRAGMA temp_store={settings.sqlite_temp_store}")
+    return conn
+
+
+class ConnectionPool:
+    """Long-lived connections: one reader per thread and a single serialized writer.
+
+    WAL lets readers run alongside the writer, so reads never wait on the write lock.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._writer = None
+        self._write_lock = threading.RLock()
+        self._write_depth = 0
+        self._after_commit = []
+
+    @contextmanager
+    def read(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = _connect()
+        yield conn
+
+    @contextmanager
+    def write(self):
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = _connect()
+            conn = self._writer
+            # nested write blocks on the same thread share the outer transaction
+            self._write_depth += 1
+            try:
+                yield conn
+                if self._write_depth == 1:
+                    conn.commit()
+                    hooks, self._after_commit = self._after_commit, []
+                    for fn in hooks:
+                        try:
+                            fn()
+                        except Exception as e:
+                            logging.warning(f"after-commit hook failed: {e}")
+            except BaseException:
+                if self._write_depth == 1:
+                    conn.rollback()
+                    self._after_commit = []
+                raise
+            finally:
+                self._write_depth -= 1
+
+    def after_commit(self, fn):
+        """Run fn once the enclosing write transaction commits; dropped if it rolls back.
+
+        Hooks run in order, still under the write lock, so in-memory state (vector index,
+        caches) follows commits in commit order. Outside a write block fn runs at once.
+        """
+        with self._write_lock:
+            if self._write_depth:
+                self._after_commit.append(fn)
+                return
+        fn()
+
+
+pool = ConnectionPool()
+
+
 @contextmanager
 def get_conn():
-    conn = sqlite3.connect(settings.db_path)
-    conn.row_factory = sqlite3.Row
-    try:
+    """Writer connection; commits on success, rolls back on error."""
+    with pool.write() as conn:
         yield conn
-        conn.commit()
-    finally:
-        conn.close()
 
-with get_conn() as conn:
-    conn.executescript(SCHEMA_SQL)
-    # Lightweight migrations for existing DBs: add columns if missing
-    try:
-        cols = {r[1] for r in conn.execute("PRAGMA table_info(embedding)").fetchall()}
-        if "model" not in cols:
-            conn.execute("ALTER TABLE embedding ADD COLUMN model TEXT")
-        if "dim" not in cols:
-            conn.execute("ALTER TABLE embedding ADD COLUMN dim INTEGER")
-        if "is_normalized" not in cols:
-            conn.execute("ALTER TABLE embedding ADD COLUMN is_normalized INTEGER NOT NULL DEFAULT 0")
-    except Exception:
-        pass
-    # Ensure indexes exist (idempotent in SQLite with IF NOT EXISTS above)
-    # Backfill chunk_fts from existing embeddings if empty
+
+def after_commit(fn):
+    """Defer fn until the current get_conn() transaction commits (see ConnectionPool.after_commit)."""
+    pool.after_commit(fn)
+
+
+@contextmanager
+def read_conn():
+    """This thread's read-only connection (sees the latest committed data)."""
+    with pool.read() as conn:
+        yield conn
+
+
+# Ensure the DB file exists and is initialized
+def ensure_db():
     try:
-        cnt = conn.execute("SELECT COUNT(*) AS c FROM chunk_fts").fetchone()["c"]
-        if cnt == 0:
-            rows = conn.execute("SELECT document_id, chunk_index, text FROM embedding").fetchall()
-            for r in rows:
-                conn.execute(
-                    "INSERT INTO chunk_fts(content, document_id, chunk_index) VALUES(?,?,?)",
-                    (r["text"], r["document_id"], r["chunk_index"]),
-                )
-    except Exception:
-        # ignore if table not present or other issues
-        pass
+        with get_conn() as conn:
+            conn.executescript(SCHEMA_SQL)
+            # Lightweight migrations for existing DBs: add columns if missing
+            try:
+                cols = {r[1] for r in conn.execute("PRAGMA table_info(embedding)").fetchall()}
+                if "model" not in cols:
+                    conn.execute("ALTER TABLE embedding ADD COLUMN model TEXT")
+                if "dim" not in cols:
+                    conn.execute("ALTER TABLE embedding ADD COLUMN dim INTEGER")
+                if "is_normalized" not in cols:
+                    conn.execute("ALTER TABLE embedding ADD COLUMN is_normalized INTEGER NOT NULL DEFAULT 0")
+                if "codec" not in cols:
+                    conn.execute("ALTER TABLE embedding ADD COLUMN codec TEXT")
+                if "code" not in cols:
+                    conn.execute("ALTER TABLE embedding ADD COLUMN code BLOB")
+                if "char_start" not in cols:
+                    conn.execute("ALTER TABLE embedding ADD COLUMN char_start INTEGER")
+                    conn.execute("ALTER TABLE embedding ADD COLUMN char_end INTEGER")
+                if "kb_id" not in cols:
+                    conn.execute("ALTER TABLE embedding ADD COLUMN kb_id INTEGER")
+                    conn.execute("UPDATE embedding SET kb_id=(SELECT kb_id FROM document WHERE document.id=embedding.document_id)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_embedding_kb ON embedding(kb_id)")
+            except Exception:
+                pass
+            try:
+                doc_cols = {r[1] for r in conn.execute("PRAGMA table_info(document)").fetchall()}
+                if "content_hash" not in doc_cols:
+                    conn.execute("ALTER TABLE document ADD COLUMN content_hash TEXT")
+                if "source_key" not in doc_cols:
+                    conn.execute("ALTER TABLE document ADD COLUMN source_key TEXT")
+                    conn.execute("UPDATE document SET source_key=source")
+                    try:
+                        # uploads from Electron are identified by their original path
+                        conn.execute("UPDATE document SET source_key=json_extract(meta, '$.file_path') WHERE json_extract(meta, '$.file_path') IS NOT NULL")
+                    except Exception:
+                        pass
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_doc_source ON document(kb_id, source_key)")
+            except Exception:
+                pass
+            # chunk_fts predates its kb_id column: recreate it (FTS5 tables cannot add columns)
+            try:
+                fts_cols = {r[1] for r in conn.execute("PRAGMA table_info(chunk_fts)").fetchall()}
+                if "kb_id" not in fts_cols:
+                    conn.execute("DROP TABLE chunk_fts")
+                    conn.executescript(SCHEMA_SQL)
+            except Exception:
+                pass
+            # Backfill chunk_fts from existing embeddings if empty; its rowid is the embedding id.
+            # user_version 1 marks a DB whose chunk_fts is keyed that way (older rows get rebuilt).
+            try:
+                cnt = conn.execute("SELECT COUNT(*) AS c FROM chunk_fts").fetchone()["c"]
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if cnt == 0 or version < 1:
+                    conn.execute("DELETE FROM chunk_fts")
+                    conn.execute(
+                        "INSERT INTO chunk_fts(rowid, content, document_id, chunk_index, kb_id) SELECT id, text, document_id, chunk_index, kb_id FROM embedding"
+                    )
+                    conn.execute("PRAGMA user_version=1")
+            except Exception:
+                # ignore if table not present or other issues
+                pass
+    except Exception as e:
+        logging.error(f"Failed to initialize DB: {e}")
+
+ensure_db()
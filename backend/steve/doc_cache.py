@@ -0,0 +1,80 @@
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+import json
+import threading
+
+from .config import settings
+from .db import read_conn
+
+# The document fields every search result carries (source, title, kb_id, file_path),
+# keyed by document id, so hydrating results neither re-reads document rows nor
+# re-parses their meta JSON per hit. The least recently used are evicted past
+# doc_cache_items; a document's entry is dropped whenever the document is written.
+
+_entries: "OrderedDict[int, Dict]" = OrderedDict()
+_generation = 0  # bumped by invalidate(); loads that started before it are not cached
+_lock = threading.Lock()
+counters: Dict[str, int] = {"hits": 0, "misses": 0, "evicted": 0, "invalidations": 0}
+
+
+def _load(doc_ids: list) -> Dict[int, Dict]:
+    out: Dict[int, Dict] = {}
+    with read_conn() as conn:
+        for start in range(0, len(doc_ids), 900):
+            part = doc_ids[start:start + 900]
+            qmarks = ",".join(["?"] * len(part))
+            for r in conn.execute(f"SELECT id, kb_id, source, title, meta FROM document WHERE id IN ({qmarks})", part):
+                try:
+                    meta = json.loads(r["meta"]) if r["meta"] else {}
+                except Exception:
+                    meta = {}
+                out[r["id"]] = {"source": r["source"], "title": r["title"], "kb_id": r["kb_id"],
+                                "file_path": meta.get("file_path")}
+    return out
+
+
+def fields(doc_ids: Iterable[int]) -> Dict[int, Dict]:
+    """{doc_id: fields} for the documents that exist."""
+    out: Dict[int, Dict] = {}
+    missing = []
+    with _lock:
+        generation = _generation
+        for doc_id in dict.fromkeys(doc_ids):
+            entry = _entries.get(doc_id)
+            if entry is None:
+                missing.append(doc_id)
+                continue
+            _entries.move_to_end(doc_id)
+            out[doc_id] = entry
+        counters["hits"] += len(out)
+        counters["misses"] += len(missing)
+    if not missing:
+        return out
+    loaded = _load(missing)
+    out.update(loaded)
+    limit = int(settings.doc_cache_items)
+    if limit > 0:
+        with _lock:
+            if generation == _generation:
+                _entries.update(loaded)
+                while len(_entries) > limit:
+                    _entries.popitem(last=False)
+                    counters["evicted"] += 1
+    return out
+
+
+def invalidate(doc_id: Optional[int] = None):
+    """Drop one document's entry (every entry when doc_id is None)."""
+    global _generation
+    with _lock:
+        _generation += 1
+        counters["invalidations"] += 1
+        if doc_id is None:
+            _entries.clear()
+        else:
+            _entries.pop(doc_id, None)
+
+
+def stats() -> Dict:
+    with _lock:
+        return {**counters, "items": len(_entries), "max_items": int(settings.doc_cache_items)}
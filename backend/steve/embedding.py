@@ -1,14 +1,129 @@
-from typing import List, Optional
+from typing import Dict, List, Optional, Set
 import asyncio
+import logging
 import os
+import time
 import numpy as np
 import httpx
 from .config import settings
+from . import embedding_cache, metrics, offload
 
-# Simple OpenAI-compatible embedding client to LM Studio with batching and retries
-async def embed_texts(texts: List[str], model: Optional[str] = None) -> List[List[float]]:
+# Shared HTTP client: keeps connections to the embedding server alive across calls.
+# httpx clients are bound to the event loop they were created on, so it is recreated
+# if a different loop (e.g. asyncio.run in a tool script) asks for it.
+_client: Optional[httpx.AsyncClient] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        limits = httpx.Limits(
+            max_connections=int(settings.embedding_max_connections),
+            max_keepalive_connections=int(settings.embedding_max_connections),
+        )
+        _client = httpx.AsyncClient(timeout=settings.embedding_timeout_seconds, limits=limits)
+        _client_loop = loop
+    return _client
+
+
+_flushes: Set[asyncio.Task] = set()
+
+
+def _flush_cache():
+    # queued cache writes go to the writer thread; nobody waits for them
+    if not embedding_cache.claim_flush():
+        return
+    task = asyncio.ensure_future(offload.db_write(embedding_cache.flush))
+    _flushes.add(task)
+    task.add_done_callback(_flushed)
+
+
+def _flushed(task: asyncio.Task):
+    _flushes.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.warning(f"Embedding cache write failed: {task.exception()}")
+
+
+async def close_client():
+    global _client
+    # land queued cache writes before the writer thread stops
+    try:
+        await offload.db_write(embedding_cache.flush)
+    except Exception as e:
+        logging.warning(f"Embedding cache write failed: {e}")
+    if _client is not None and not _client.is_closed and _client_loop is asyncio.get_running_loop():
+        await _client.aclose()
+    _client = None
+
+
+class _BatchSizer:
+    """Adapts texts-per-request so one request takes about embedding_target_batch_seconds."""
+
+    def __init__(self):
+        self.size = int(settings.embedding_batch_size)
+        self._sec_per_char: Optional[float] = None
+
+    def limit(self) -> int:
+        return max(1, min(self.size, int(settings.embedding_batch_size)))
+
+    def observe(self, n: int, chars: int, elapsed: float):
+        rate = elapsed / max(1, chars)
+        # EWMA so one slow round trip doesn't collapse the batch size
+        self._sec_per_char = rate if self._sec_per_char is None else 0.7 * self._sec_per_char + 0.3 * rate
+        avg_chars = max(1.0, chars / max(1, n))
+        target_chars = float(settings.embedding_target_batch_seconds) / max(self._sec_per_char, 1e-9)
+        self.size = max(1, int(target_chars / avg_chars))
+
+    def failed(self):
+        self.size = max(1, self.limit() // 2)
+
+
+_sizers: Dict[str, _BatchSizer] = {}
+
+
+def _next_batch_end(texts: List[str], start: int, sizer: _BatchSizer) -> int:
+    limit = sizer.limit()
+    max_chars = int(settings.embedding_max_batch_chars)
+    end, chars = start, 0
+    while end < len(texts) and end - start < limit:
+        chars += len(texts[end])
+        if end > start and chars > max_chars:
+            break
+        end += 1
+    return end
+
+
+async def embed_texts(texts: List[str], model: Optional[str] = None, use_cache: Optional[bool] = None) -> List[List[float]]:
+    """Embed texts, serving repeats from the content-addressed cache."""
     if not texts:
         return []
+    model_name = model or settings.embedding_model
+    if not (settings.embedding_cache if use_cache is None else use_cache):
+        return await _embed_uncached(texts, model_name)
+    out = await offload.db_read(embedding_cache.get_many, model_name, texts)
+    # embed each distinct missing text once
+    missing: Dict[str, List[int]] = {}
+    for i, vec in enumerate(out):
+        if vec is None:
+            missing.setdefault(texts[i], []).append(i)
+    if missing:
+        todo = list(missing)
+        vectors = await _embed_uncached(todo, model_name)
+        embedding_cache.put_many(model_name, todo, vectors)
+        for text, vec in zip(todo, vectors):
+            for i in missing[text]:
+                out[i] = vec
+    _flush_cache()
+    # cached vectors may fix the dimension for texts that failed upstream
+    dims = [len(r) for r in out if r]
+    dim = dims[0] if dims else 0
+    return [r if r else ([0.0] * dim if dim else []) for r in out]
+
+
+# OpenAI-compatible embedding client to LM Studio: adaptive batches, several in flight, per-batch retries
+async def _embed_uncached(texts: List[str], model_name: str) -> List[List[float]]:
     base = (settings.openai_base_url or "").rstrip("/")
     if not base.endswith("/v1"):
         base += "/v1"
@@ -17,26 +132,30 @@ async def embed_texts(texts: List[str], model: Optional[str] = None) -> List[Lis
         "Authorization": f"Bearer {settings.openai_api_key}",
         "Content-Type": "application/json",
     }
-    model_name = model or settings.embedding_model
 
     results: List[Optional[List[float]]] = [None] * len(texts)
-    batch = max(1, int(settings.embedding_batch_size))
+    client = _get_client()
+    sizer = _sizers.setdefault(model_name, _BatchSizer())
+    in_flight = asyncio.Semaphore(max(1, int(settings.embedding_concurrency)))
 
-    async with httpx.AsyncClient(timeout=settings.embedding_timeout_seconds) as client:
-        for start in range(0, len(texts), batch):
-            chunk = texts[start:start + batch]
-            payload = {"input": chunk, "model": model_name}
-            attempt = 0
+    async def run_batch(start: int, end: int):
+        chunk = texts[start:end]
+        payload = {"input": chunk, "model": model_name}
+        attempt = 0
+        try:
             while True:
                 try:
+                    t0 = time.perf_counter()
                     resp = await client.post(url, headers=headers, json=payload)
                     resp.raise_for_status()
                     data = resp.json()
+                    metrics.embedding_requests.observe(time.perf_counter() - t0)
+                    sizer.observe(len(chunk), sum(len(t) for t in chunk), time.perf_counter() - t0)
                     items = data.get("data") or []
                     if len(items) != len(chunk):
                         # preserve order by best-effort mapping
                         emb_list = [None] * len(chunk)
-                        for i, it in enumerate(items):
+                        for i, it in enumerate(items[: len(chunk)]):
                             try:
                                 emb_list[i] = it["embedding"]
                             except Exception:
@@ -48,13 +167,30 @@ async def embed_texts(texts: List[str], model: Optional[str] = None) -> List[Lis
                     break
                 except Exception:
                     attempt += 1
+                    sizer.failed()
+                    metrics.upstream_errors.inc(api="embeddings")
                     if attempt >= int(settings.embedding_max_retries):
+                        metrics.embedding_errors.inc()
                         # mark failures as empty embedding to avoid crash; caller may skip
                         for i in range(len(chunk)):
                             if results[start + i] is None:
                                 results[start + i] = []
                         break
+                    # only this batch backs off; the others keep going
+                    metrics.embedding_retries.inc()
                     await asyncio.sleep(min(2 ** attempt, 10))
+        finally:
+            in_flight.release()
+
+    tasks = []
+    start = 0
+    while start < len(texts):
+        await in_flight.acquire()
+        # size each batch from the latest observed latency
+        end = _next_batch_end(texts, start, sizer)
+        tasks.append(asyncio.create_task(run_batch(start, end)))
+        start = end
+    await asyncio.gather(*tasks)
 
     # Replace any empty entries with zeros of median dimension (best-effort)
     dims = [len(r) for r in results if r]
@@ -0,0 +1,153 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import threading
+import time
+import numpy as np
+
+from .db import get_conn, read_conn
+from .config import settings
+
+# Content-addressed cache of embeddings keyed by (model, sha256(text)).
+# Hot tier: in-process LRU of recent vectors. Cold tier: the embedding_cache table,
+# bounded by embedding_cache_max_mb with least-recently-used eviction.
+# Lookups only read. New vectors and last_used touches are queued and written
+# together by flush(), which callers run on the writer thread (offload.db_write) without
+# waiting for it, so a lookup never queues behind an open write transaction.
+
+_hot: "OrderedDict[Tuple[str, bytes], np.ndarray]" = OrderedDict()
+_lock = threading.Lock()
+_disk_bytes: Optional[int] = None
+_pending: Dict[Tuple[str, bytes], Tuple[bytes, int]] = {}  # rows to insert: key -> (vector, bytes)
+_touched: Dict[Tuple[str, bytes], float] = {}  # disk hits: key -> last_used
+_flush_scheduled = False
+counters: Dict[str, int] = {"hot_hits": 0, "disk_hits": 0, "misses": 0, "evicted": 0}
+
+
+def _key(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8", errors="surrogatepass")).digest()
+
+
+def _hot_put(key: Tuple[str, bytes], vec: np.ndarray):
+    _hot[key] = vec
+    _hot.move_to_end(key)
+    limit = int(settings.embedding_cache_hot_items)
+    while len(_hot) > limit:
+        _hot.popitem(last=False)
+
+
+def get_many(model: str, texts: List[str]) -> List[Optional[List[float]]]:
+    """Cached vectors aligned with texts; None where the text has not been embedded yet."""
+    out: List[Optional[List[float]]] = [None] * len(texts)
+    keys = [_key(t) for t in texts]
+    cold: Dict[bytes, List[int]] = {}
+    with _lock:
+        for i, k in enumerate(keys):
+            vec = _hot.get((model, k))
+            if vec is not None:
+                _hot.move_to_end((model, k))
+                out[i] = vec.tolist()
+                counters["hot_hits"] += 1
+            else:
+                cold.setdefault(k, []).append(i)
+    if not cold:
+        return out
+    found: Dict[bytes, np.ndarray] = {}
+    hashes = list(cold)
+    with read_conn() as conn:
+        for start in range(0, len(hashes), 900):
+            part = hashes[start:start + 900]
+            qmarks = ",".join(["?"] * len(part))
+            for r in conn.execute(
+                f"SELECT hash, vector FROM embedding_cache WHERE model=? AND hash IN ({qmarks})", (model, *part)
+            ):
+                found[bytes(r["hash"])] = np.frombuffer(r["vector"], dtype=np.float32)
+    with _lock:
+        for k, idxs in cold.items():
+            vec = found.get(k)
+            if vec is None:
+                counters["misses"] += len(idxs)
+                continue
+            _hot_put((model, k), vec)
+            counters["disk_hits"] += len(idxs)
+            for i in idxs:
+                out[i] = vec.tolist()
+        now = time.time()
+        for k in found:
+            _touched[(model, k)] = now
+    return out
+
+
+def put_many(model: str, texts: List[str], vectors: List[List[float]]):
+    """Add vectors to the hot tier and queue them for the table (see flush)."""
+    with _lock:
+        for text, vec in zip(texts, vectors):
+            # never cache failed (empty or zero-filled) embeddings
+            if not vec or not any(vec):
+                continue
+            k = _key(text)
+            arr = np.asarray(vec, dtype=np.float32)
+            _hot_put((model, k), arr)
+            _pending[(model, k)] = (arr.tobytes(), arr.nbytes)
+
+
+def claim_flush() -> bool:
+    """True if writes are queued and no flush is already scheduled; the caller then runs flush()."""
+    global _flush_scheduled
+    with _lock:
+        if _flush_scheduled or not (_pending or _touched):
+            return False
+        _flush_scheduled = True
+        return True
+
+
+def flush():
+    """Write queued vectors and last_used touches in one transaction, evicting past the size cap."""
+    global _disk_bytes, _flush_scheduled
+    with _lock:
+        _flush_scheduled = False
+        pending, touched = dict(_pending), dict(_touched)
+        _pending.clear()
+        _touched.clear()
+    if not (pending or touched):
+        return
+    now = time.time()
+    rows = [(model, k, vec, nbytes, now) for (model, k), (vec, nbytes) in pending.items()]
+    with get_conn() as conn:
+        conn.executemany(
+            "UPDATE embedding_cache SET last_used=? WHERE model=? AND hash=?",
+            [(ts, model, k) for (model, k), ts in touched.items()],
+        )
+        if not rows:
+            return
+        conn.executemany(
+            "INSERT OR REPLACE INTO embedding_cache(model, hash, vector, bytes, last_used) VALUES(?,?,?,?,?)",
+            rows,
+        )
+        if _disk_bytes is None:
+            _disk_bytes = int(conn.execute("SELECT COALESCE(SUM(bytes), 0) AS b FROM embedding_cache").fetchone()["b"])
+        else:
+            _disk_bytes += sum(r[3] for r in rows)
+        limit = int(settings.embedding_cache_max_mb) * 1024 * 1024
+        if _disk_bytes > limit:
+            _evict(conn, _disk_bytes - int(limit * 0.9))
+
+
+def _evict(conn, need: int):
+    global _disk_bytes
+    # drop least-recently-used entries until `need` bytes are freed
+    freed, victims = 0, []
+    for r in conn.execute("SELECT model, hash, bytes FROM embedding_cache ORDER BY last_used"):
+        victims.append((r["model"], r["hash"]))
+        freed += r["bytes"]
+        if freed >= need:
+            break
+    conn.executemany("DELETE FROM embedding_cache WHERE model=? AND hash=?", victims)
+    # resync: INSERT OR REPLACE of an existing key was counted twice
+    _disk_bytes = int(conn.execute("SELECT COALESCE(SUM(bytes), 0) AS b FROM embedding_cache").fetchone()["b"])
+    counters["evicted"] += len(victims)
+
+
+def stats() -> Dict[str, int]:
+    with _lock:
+        return {**counters, "hot_items": len(_hot), "disk_bytes": _disk_bytes or 0, "pending": len(_pending)}
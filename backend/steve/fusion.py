@@ -0,0 +1,65 @@
+from typing import Dict, List, Sequence, Tuple
+
+# Fusion of ranked result lists (semantic, keyword) into one ranking, per chunk
+# (document_id, chunk_index). Inputs are each retriever's results, best first, with
+# "score" higher-is-better; every fused result keeps its per-retriever raw scores and
+# ranks under "<name>" and "<name>_rank" (0.0 / None when that retriever missed it).
+#
+#   rrf:        sum of weight / (rrf_k + rank); ignores score scales entirely.
+#   normalized: min-max normalize each list's scores to 0..1, then a weighted sum.
+
+FUSION_MODES = ("rrf", "normalized")
+
+
+def _key(item: Dict) -> Tuple[int, int]:
+    return item["document_id"], item["chunk_index"]
+
+
+def _merge(lists: Sequence[Tuple[str, List[Dict]]]) -> Dict[Tuple[int, int], Dict]:
+    merged: Dict[Tuple[int, int], Dict] = {}
+    for name, items in lists:
+        for rank, item in enumerate(items, start=1):
+            key = _key(item)
+            entry = merged.get(key)
+            if entry is None:
+                entry = merged[key] = {**item}
+                for other, _ in lists:
+                    entry[other], entry[f"{other}_rank"] = 0.0, None
+            if entry[f"{name}_rank"] is None:  # a retriever may repeat a chunk; keep its best
+                entry[name], entry[f"{name}_rank"] = float(item["score"]), rank
+    return merged
+
+
+def rrf(lists: Sequence[Tuple[str, List[Dict]]], weights: Dict[str, float], k: int = 60) -> List[Dict]:
+    merged = _merge(lists)
+    for entry in merged.values():
+        entry["score"] = sum(
+            weights.get(name, 1.0) / (k + entry[f"{name}_rank"])
+            for name, _ in lists if entry[f"{name}_rank"] is not None
+        )
+    return sorted(merged.values(), key=lambda e: e["score"], reverse=True)
+
+
+def normalized(lists: Sequence[Tuple[str, List[Dict]]], weights: Dict[str, float]) -> List[Dict]:
+    merged = _merge(lists)
+    bounds = {}
+    for name, items in lists:
+        scores = [float(i["score"]) for i in items]
+        bounds[name] = (min(scores), max(scores)) if scores else (0.0, 0.0)
+    for entry in merged.values():
+        total = 0.0
+        for name, _ in lists:
+            if entry[f"{name}_rank"] is None:
+                continue
+            lo, hi = bounds[name]
+            # a list with one distinct score counts every hit as a full match
+            norm = (entry[name] - lo) / (hi - lo) if hi > lo else 1.0
+            total += weights.get(name, 1.0) * norm
+        entry["score"] = total
+    return sorted(merged.values(), key=lambda e: e["score"], reverse=True)
+
+
+def fuse(mode: str, lists: Sequence[Tuple[str, List[Dict]]], weights: Dict[str, float], rrf_k: int = 60) -> List[Dict]:
+    if mode == "normalized":
+        return normalized(lists, weights)
+    return rrf(lists, weights, rrf_k)
@@ -0,0 +1,175 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+import hashlib
+import json
+import logging
+import re
+import threading
+
+from .config import settings
+from .context import count_message_tokens
+from . import llm
+
+# Conversation history for the chat endpoints. The last history_keep_messages messages are
+# sent verbatim; once the whole history exceeds history_max_tokens, everything older is
+# replaced by a rolling summary. Summaries are cached per conversation (conversation_id,
+# or the first message when the client sends none) together with a digest of the
+# messages they cover. Later turns reuse the summary and send the messages after it
+# verbatim until another history_keep_messages have aged out; those are then folded
+# into the previous summary, so the summary call runs every few turns, not every turn.
+#
+# The retrieval query is the last user message rewritten with conversation context:
+# "context" prepends the previous user question to short or referential follow-ups,
+# "llm" asks the chat model for a standalone question, "off" uses the message as is.
+
+_summaries: "OrderedDict[str, Tuple[int, str, str]]" = OrderedDict()  # key -> (covered, digest, summary)
+_rewrites: "OrderedDict[str, str]" = OrderedDict()
+_lock = threading.Lock()
+counters: Dict[str, int] = {"compacted": 0, "summary_hits": 0, "summarized_messages": 0, "summary_failures": 0}
+
+_FOLLOW_UP = re.compile(
+    r"\b(it|its|this|that|these|those|they|them|their|he|she|him|her|there|same|also|more|else|why|how about|what about)\b",
+    re.IGNORECASE,
+)
+
+
+def _digest(messages: Sequence[Dict]) -> str:
+    data = json.dumps([(m.get("role"), m.get("content")) for m in messages], ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+
+def _conversation_key(conversation_id: Optional[str], messages: Sequence[Dict]) -> str:
+    return f"id:{conversation_id}" if conversation_id else f"first:{_digest(messages[:1])}"
+
+
+def _remember(cache: OrderedDict, key: str, value):
+    with _lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > int(settings.history_cache_items):
+            cache.popitem(last=False)
+
+
+def _transcript(messages: Sequence[Dict]) -> str:
+    return "\n".join(f"{(m.get('role') or 'user').upper()}: {m.get('content') or ''}" for m in messages)
+
+
+async def _fold(summary: Optional[str], messages: Sequence[Dict]) -> str:
+    prompt = (
+        "Summarize this conversation so it can replace the messages in a chat history. Keep facts, "
+        "names, numbers, decisions, open questions and what the user is trying to do. Be concise."
+    )
+    parts = [f"Summary so far:\n{summary}"] if summary else []
+    parts.append(f"Messages:\n{_transcript(messages)}")
+    return (await llm.complete(
+        [{"role": "system", "content": prompt}, {"role": "user", "content": "\n\n".join(parts)}],
+        max_tokens=int(settings.history_summary_tokens),
+    )).strip()
+
+
+def _cached_summary(key: str, older: List[Dict]) -> Optional[Tuple[int, str]]:
+    """(messages covered, summary) if the cached summary covers a prefix of older."""
+    with _lock:
+        cached = _summaries.get(key)
+        if cached is not None:
+            _summaries.move_to_end(key)
+    if cached is None:
+        return None
+    covered, digest, summary = cached
+    if covered <= len(older) and digest == _digest(older[:covered]):
+        return covered, summary
+    return None
+
+
+async def _summarize(key: str, older: List[Dict], cached: Optional[Tuple[int, str]]) -> str:
+    start, summary = cached if cached is not None else (0, None)
+    # fold in slices that fit comfortably in the model's context
+    limit = max(256, int(settings.chat_context_tokens) // 2)
+    i = start
+    while i < len(older):
+        j = i + 1
+        while j < len(older) and count_message_tokens(older[i:j + 1]) <= limit:
+            j += 1
+        summary = await _fold(summary, older[i:j])
+        counters["summarized_messages"] += j - i
+        i = j
+    _remember(_summaries, key, (len(older), _digest(older), summary))
+    return summary
+
+
+def _summary_message(summary: str) -> Dict:
+    return {"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"}
+
+
+async def compact(conversation_id: Optional[str], messages: List[Dict]) -> List[Dict]:
+    """History to send: recent messages verbatim, older ones as one summary message."""
+    keep = max(1, int(settings.history_keep_messages))
+    if len(messages) <= keep or count_message_tokens(messages) <= int(settings.history_max_tokens):
+        return messages
+    older = messages[:-keep]
+    key = _conversation_key(conversation_id, messages)
+    cached = _cached_summary(key, older)
+    if cached is not None and len(older) - cached[0] < keep:
+        # the summary is refreshed once another `keep` messages have aged out, not every turn
+        counters["summary_hits"] += 1
+        counters["compacted"] += 1
+        return [_summary_message(cached[1])] + messages[cached[0]:]
+    try:
+        summary = await _summarize(key, older, cached)
+    except Exception as e:
+        # no summary: keep as many recent messages as fit
+        logging.warning(f"History summary failed, dropping older messages: {e}")
+        counters["summary_failures"] += 1
+        kept: List[Dict] = []
+        for m in reversed(messages):
+            if kept and count_message_tokens(kept + [m]) > int(settings.history_max_tokens):
+                break
+            kept.insert(0, m)
+        return kept
+    counters["compacted"] += 1
+    return [_summary_message(summary)] + messages[-keep:]
+
+
+def _previous_user_message(messages: Sequence[Dict]) -> Optional[str]:
+    for m in reversed(messages[:-1]):
+        if m.get("role") == "user" and (m.get("content") or "").strip():
+            return m["content"]
+    return None
+
+
+async def retrieval_query(messages: List[Dict], history: List[Dict]) -> str:
+    """Search query for the last message; ``history`` is the (compacted) history sent to the model."""
+    query = (messages[-1].get("content") or "") if messages else ""
+    previous = _previous_user_message(messages)
+    mode = settings.query_rewrite
+    if mode == "off" or previous is None or not query.strip():
+        return query
+    if mode == "llm":
+        key = _digest(messages)
+        with _lock:
+            cached = _rewrites.get(key)
+        if cached is not None:
+            return cached
+        try:
+            prompt = (
+                "Rewrite the user's last message as a standalone search query for a document search, "
+                "resolving references to earlier turns. Reply with the query only."
+            )
+            rewritten = (await llm.complete(
+                [{"role": "system", "content": prompt}, {"role": "user", "content": _transcript(history[-8:])}],
+                max_tokens=64, temperature=0.0,
+            )).strip().strip('"')
+            if rewritten:
+                _remember(_rewrites, key, rewritten)
+                return rewritten
+        except Exception as e:
+            logging.warning(f"Query rewrite failed, using context instead: {e}")
+    # short or referential follow-ups carry the previous question along
+    if len(query.split()) <= 8 or _FOLLOW_UP.search(query):
+        return f"{previous}\n{query}"
+    return query
+
+
+def stats() -> Dict:
+    with _lock:
+        return {**counters, "cached_summaries": len(_summaries), "cached_rewrites": len(_rewrites)}
@@ -1,17 +1,26 @@
-from typing import List, Tuple
+from typing import BinaryIO, Iterable, Iterator, List, Tuple, Union
+import codecs
+import contextlib
+import hashlib
 import io
 import re
 import json
-import requests
+import httpx
 from bs4 import BeautifulSoup
 from urllib.parse import urlparse
 
 from pypdf import PdfReader
-from pdfminer.high_level import extract_text as pdfminer_extract
+from pdfminer.high_level import extract_pages as pdfminer_extract_pages
+from pdfminer.layout import LTTextContainer
 from docx import Document as DocxDocument
 from openpyxl import load_workbook
 from pptx import Presentation
 
+from . import offload
+
+# a path on disk or an open binary file
+Source = Union[str, BinaryIO]
+
 
 def clean_text(text: str) -> str:
     text = re.sub(r"\s+", " ", text)
@@ -30,75 +39,254 @@ def chunk_text(text: str, max_tokens: int = 512, overlap: int = 64) -> List[str]
     return chunks
 
 
-def read_pdf(file_bytes: bytes) -> str:
-    # Try PyPDF first
+# Streaming readers take a path or binary file object and yield pieces of the document
+# text, separators included, so the text is simply "".join(pieces). Structure is kept
+# for the chunker: a blank line ends a paragraph, "\f" on its own line ends a page,
+# sheet or slide, and headings (docx heading styles, sheet names, slide titles) are
+# written as "# " lines. Whitespace is collapsed within lines only.
+
+PAGE_BREAK = "\n\f\n"
+
+
+def clean_block(text: str) -> str:
+    """Collapse whitespace within each line and drop blank lines, keeping line breaks."""
+    lines = (re.sub(r"\s+", " ", line).strip() for line in (text or "").splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def _joined(blocks: Iterable[str], sep: str) -> Iterator[str]:
+    # non-empty blocks with `sep` in between
+    first = True
+    for block in blocks:
+        if not block:
+            continue
+        yield block if first else sep + block
+        first = False
+
+
+def _decoded_blocks(src: Source, block: int = 1 << 20) -> Iterator[str]:
+    # invalid utf-8 is dropped, like bytes.decode(errors="ignore")
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    with open(src, "rb") if isinstance(src, str) else contextlib.nullcontext(src) as f:
+        while True:
+            data = f.read(block)
+            if not data:
+                break
+            text = decoder.decode(data)
+            if text:
+                yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def _pdf_pages(src: Source) -> Iterator[str]:
+    # Try PyPDF first, page by page
+    yielded = False
     try:
-        reader = PdfReader(io.BytesIO(file_bytes))
-        texts = []
+        reader = PdfReader(src)
         for page in reader.pages:
-            texts.append(page.extract_text() or "")
-        text = "\n".join(texts)
-        if text and text.strip():
-            return clean_text(text)
+            try:
+                text = clean_block(page.extract_text() or "")
+            except Exception:
+                continue
+            if text:
+                yielded = True
+                yield text
     except Exception:
         pass
+    if yielded:
+        return
     # Fallback to pdfminer.six
     try:
-        text = pdfminer_extract(io.BytesIO(file_bytes))
-        return clean_text(text)
+        if hasattr(src, "seek"):
+            src.seek(0)
+        for layout in pdfminer_extract_pages(src):
+            yield clean_block("".join(el.get_text() for el in layout if isinstance(el, LTTextContainer)))
     except Exception:
-        return ""
+        return
 
 
-def read_docx(file_bytes: bytes) -> str:
-    bio = io.BytesIO(file_bytes)
-    doc = DocxDocument(bio)
-    texts = [p.text for p in doc.paragraphs]
-    # include table texts
+def iter_pdf(src: Source) -> Iterator[str]:
+    return _joined(_pdf_pages(src), PAGE_BREAK)
+
+
+def _heading_level(paragraph) -> int:
+    try:
+        name = paragraph.style.name or ""
+    except Exception:
+        return 0
+    if name == "Title":
+        return 1
+    m = re.match(r"Heading (\d)", name)
+    return min(6, int(m.group(1))) if m else 0
+
+
+def _docx_blocks(doc) -> Iterator[str]:
+    for p in doc.paragraphs:
+        text = clean_block(p.text)
+        level = _heading_level(p) if text else 0
+        yield "#" * level + " " + text.replace("\n", " ") if level else text
+    # include table texts, one row per line
     for table in doc.tables:
-        for row in table.rows:
-            texts.append("\t".join([cell.text for cell in row.cells]))
-    return clean_text("\n".join(texts))
+        yield "\n".join(filter(None, (clean_block("\t".join([cell.text for cell in row.cells])).replace("\n", " ")
+                                      for row in table.rows)))
+
+
+def iter_docx(src: Source) -> Iterator[str]:
+    return _joined(_docx_blocks(DocxDocument(src)), "\n\n")
+
+
+def iter_xlsx(src: Source) -> Iterator[str]:
+    # read-only mode streams rows instead of materializing every cell
+    wb = load_workbook(src, read_only=True, data_only=True)
+    try:
+        for n, ws in enumerate(wb.worksheets):
+            yield (PAGE_BREAK if n else "") + f"# {ws.title}\n"
+            for row in ws.iter_rows(values_only=True):
+                line = clean_text("\t".join([str(c) if c is not None else "" for c in row]))
+                if line:
+                    yield "\n" + line
+    finally:
+        wb.close()
+
+
+def _slide_text(slide) -> str:
+    title = slide.shapes.title
+    blocks = []
+    for shape in slide.shapes:
+        if not hasattr(shape, "text"):
+            continue
+        text = clean_block(shape.text)
+        if text and title is not None and shape.shape_id == title.shape_id:
+            text = "# " + text.replace("\n", " ")
+        blocks.append(text)
+    return "\n\n".join(b for b in blocks if b)
+
+
+def iter_pptx(src: Source) -> Iterator[str]:
+    return _joined((_slide_text(slide) for slide in Presentation(src).slides), PAGE_BREAK)
+
+
+def _csv_lines(src: Source) -> Iterator[str]:
+    # one cleaned line at a time (empty lines included)
+    pending = ""
+    for block in _decoded_blocks(src):
+        lines = (pending + block).splitlines(keepends=True)
+        # the last line may continue in the next block (or be a lone \r before \n)
+        pending = lines.pop() if lines else ""
+        for line in lines:
+            yield clean_text(line)
+    if pending:
+        yield clean_text(pending)
+
+
+def iter_csv(src: Source) -> Iterator[str]:
+    first = True
+    for line in _csv_lines(src):
+        yield line if first else "\n" + line
+        first = False
+
+
+def read_pdf(file_bytes: bytes) -> str:
+    return "".join(iter_pdf(io.BytesIO(file_bytes)))
+
+
+def read_docx(file_bytes: bytes) -> str:
+    return "".join(iter_docx(io.BytesIO(file_bytes)))
 
 
 def read_xlsx(file_bytes: bytes) -> str:
-    bio = io.BytesIO(file_bytes)
-    wb = load_workbook(bio, data_only=True)
-    texts = []
-    for ws in wb.worksheets:
-        for row in ws.iter_rows(values_only=True):
-            texts.append("\t".join([str(c) if c is not None else "" for c in row]))
-    return clean_text("\n".join(texts))
+    return "".join(iter_xlsx(io.BytesIO(file_bytes)))
 
 
 def read_pptx(file_bytes: bytes) -> str:
-    bio = io.BytesIO(file_bytes)
-    prs = Presentation(bio)
-    texts = []
-    for slide in prs.slides:
-        for shape in slide.shapes:
-            if hasattr(shape, "text"):
-                texts.append(shape.text)
-    return clean_text("\n".join(texts))
+    return "".join(iter_pptx(io.BytesIO(file_bytes)))
+
 
 def read_csv(file_bytes: bytes) -> str:
-        # decode bytes as utf-8 with fallback
-        try:
-            raw = file_bytes.decode('utf-8')
-        except Exception:
-            raw = file_bytes.decode(errors='ignore')
-        # Normalize line endings and compress whitespace
-        lines = [clean_text(line) for line in raw.splitlines()]
-        return "\n".join(lines)
-
-
-def read_url(url: str) -> Tuple[str, str]:
-    resp = requests.get(url, timeout=30)
-    resp.raise_for_status()
-    soup = BeautifulSoup(resp.text, "lxml")
+    return "".join(iter_csv(io.BytesIO(file_bytes)))
+
+
+# Extensions picked up when scanning folders and archives for batch ingest
+SUPPORTED_EXTENSIONS = {"pdf", "docx", "xlsx", "xls", "csv", "pptx", "txt", "md", "markdown", "rst", "log"}
+
+
+def iter_file(src: Source, name: str) -> Tuple[str, Iterator[str]]:
+    """Pick a streaming reader by file extension; returns (type, pieces)."""
+    ext = (name.split(".")[-1] or "").lower()
+    if ext in ["pdf"]:
+        return "pdf", iter_pdf(src)
+    if ext in ["docx"]:
+        return "docx", iter_docx(src)
+    if ext in ["doc"]:
+        # unsupported by python-docx; fallback to best-effort decode
+        return "doc", _decoded_blocks(src)
+    if ext in ["xlsx", "xls"]:
+        return "xlsx", iter_xlsx(src)
+    if ext in ["csv"]:
+        return "csv", iter_csv(src)
+    if ext in ["pptx"]:
+        return "pptx", iter_pptx(src)
+    if ext in ["ppt"]:
+        # python-pptx doesn't support legacy .ppt; fallback
+        return "ppt", _decoded_blocks(src)
+    return "text", _decoded_blocks(src)
+
+
+def parse_file(name: str, data: bytes) -> Tuple[str, str]:
+    """Parse an in-memory file by extension; returns (type, text)."""
+    typ, pieces = iter_file(io.BytesIO(data), name)
+    return typ, "".join(pieces)
+
+
+def extract_to_file(path: str, name: str, out_path: str) -> Tuple[str, str, int]:
+    """Stream a file's text into out_path (utf-8) without holding it in memory.
+
+    Returns (type, sha256 of the text, length in characters); the text is exactly what
+    parse_file would return. Runs in worker processes for background ingestion.
+    """
+    typ, pieces = iter_file(path, name)
+    digest = hashlib.sha256()
+    chars = 0
+    with open(out_path, "w", encoding="utf-8", errors="surrogatepass", newline="") as out:
+        for piece in pieces:
+            out.write(piece)
+            digest.update(piece.encode("utf-8", errors="surrogatepass"))
+            chars += len(piece)
+    return typ, digest.hexdigest(), chars
+
+
+def iter_text_file(path: str, block: int = 1 << 20) -> Iterator[str]:
+    """Read back a file written by extract_to_file in blocks of characters."""
+    with open(path, encoding="utf-8", errors="surrogatepass", newline="") as f:
+        while True:
+            text = f.read(block)
+            if not text:
+                break
+            yield text
+
+
+def parse_html(html: str, url: str) -> Tuple[str, str]:
+    """(title, text) of an HTML page, one block per paragraph-level element."""
+    soup = BeautifulSoup(html, "lxml")
     title = soup.title.string.strip() if soup.title and soup.title.string else url
     # remove script/style
     for tag in soup(["script", "style", "noscript"]):
         tag.decompose()
-    text = soup.get_text(separator=" ")
-    return title, clean_text(text)
+    # mark block boundaries (and headings) before flattening each block's whitespace
+    for tag in soup.find_all(["h1", "h2", "h3", "h4", "h5", "h6"]):
+        tag.insert_before("\x1e" + "#" * int(tag.name[1]) + " ")
+        tag.insert_after("\x1e")
+    for tag in soup.find_all(["p", "li", "tr", "pre", "blockquote", "div", "section", "article", "table", "br"]):
+        tag.insert_after("\x1e")
+    blocks = (clean_text(b) for b in soup.get_text(separator=" ").split("\x1e"))
+    return title, "\n\n".join(b for b in blocks if b)
+
+
+async def read_url(url: str) -> Tuple[str, str]:
+    async with httpx.AsyncClient(timeout=30, follow_redirects=True) as client:
+        resp = await client.get(url)
+        resp.raise_for_status()
+    # lxml parsing of a large page is CPU work; keep it off the event loop
+    return await offload.parse(parse_html, resp.text, url)
@@ -0,0 +1,190 @@
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+import asyncio
+import logging
+import time
+import uuid
+
+from .config import settings
+from . import ingest, offload
+
+# In-process background ingestion. Jobs sit in a bounded asyncio queue and are run by a
+# few worker coroutines: file parsing goes to the offload process pool, embedding stays on
+# the event loop, and all DB writes go through the offload writer thread.
+
+FINISHED = ("done", "failed", "cancelled")
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, kind: str, kb_id: int, source: str, run: Callable[["Job"], Awaitable[Dict]],
+                 on_finish: Optional[Callable[[], None]] = None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.kb_id = kb_id
+        self.source = source
+        self.status = "queued"
+        self.progress: Dict[str, Any] = {}
+        self.result: Optional[Dict] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._run = run
+        # called once the job ends, however it ends (e.g. to delete its spooled files)
+        self._on_finish = on_finish
+        self._task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def update(self, status: Optional[str] = None, **progress):
+        if self.status in FINISHED:
+            return
+        if status:
+            self.status = status
+        self.progress.update(progress)
+        self._notify()
+
+    def finish(self, status: str, result: Optional[Dict] = None, error: Optional[str] = None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished_at = time.time()
+        self._notify()
+        fn, self._on_finish = self._on_finish, None
+        if fn is None:
+            return
+        if self._task is not None and not self._task.done():
+            # cancelled but still unwinding; its files may be in use until it stops
+            self._task.add_done_callback(lambda _: self._call(fn))
+        else:
+            self._call(fn)
+
+    def _call(self, fn: Callable[[], None]):
+        try:
+            fn()
+        except Exception as e:
+            logging.warning(f"Cleanup for job {self.id} failed: {e}")
+
+    def _notify(self):
+        # wake everyone waiting on the current event, then arm a fresh one
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_change(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "kb_id": self.kb_id,
+            "source": self.source,
+            "status": self.status,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobManager:
+    def __init__(self):
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+
+    def _start(self):
+        # started lazily from the first submit so it binds to the server's event loop
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=max(1, int(settings.job_queue_max)))
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(max(1, int(settings.job_workers)))]
+
+    async def run_db(self, fn, *args, **kwargs):
+        return await offload.db_write(fn, *args, **kwargs)
+
+    async def extract(self, path: str, name: str, out_path: str):
+        """ingest.extract_to_file in a worker process (in a thread if job_parse_workers is 0)."""
+        return await offload.parse(ingest.extract_to_file, path, name, out_path)
+
+    def submit(self, kind: str, kb_id: int, source: str, run: Callable[[Job], Awaitable[Dict]],
+               on_finish: Optional[Callable[[], None]] = None) -> Job:
+        """Queue a job; on_finish runs when it ends: done, failed, cancelled (queued or not) or shutdown."""
+        self._start()
+        job = Job(kind, kb_id, source, run, on_finish)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFull(f"Ingestion queue is full ({self._queue.maxsize} jobs)")
+        self._jobs[job.id] = job
+        self._prune()
+        return job
+
+    def _prune(self):
+        done = [j for j in self._jobs.values() if j.status in FINISHED]
+        for job in done[: max(0, len(done) - int(settings.job_history))]:
+            self._jobs.pop(job.id, None)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def list(self) -> List[Job]:
+        return list(self._jobs.values())
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        job = self._jobs.get(job_id)
+        if job is None or job.status in FINISHED:
+            return job
+        if job._task is None:
+            # still queued; the worker skips it
+            job.finish("cancelled")
+        elif job.progress.get("stage") != "writing":
+            # once writing has started the job runs to completion so the document stays consistent
+            job._task.cancel()
+        return job
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                if job.status in FINISHED:
+                    continue
+                job.started_at = time.time()
+                job.update(status="running")
+                job._task = asyncio.create_task(job._run(job))
+                try:
+                    result = await job._task
+                    job.finish("done", result=result)
+                except asyncio.CancelledError:
+                    if asyncio.current_task().cancelling():
+                        job._task.cancel()
+                        job.finish("cancelled", error="Server shutting down")
+                        raise
+                    job.finish("cancelled")
+                except Exception as e:
+                    logging.exception(f"Ingestion job {job.id} failed")
+                    job.finish("failed", error=str(e))
+            finally:
+                self._queue.task_done()
+
+    async def shutdown(self):
+        for w in self._workers:
+            w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+        # jobs still queued never run; finish them so their on_finish cleanup happens
+        for job in self._jobs.values():
+            if job.status not in FINISHED:
+                job.finish("cancelled", error="Server shutting down")
+
+
+manager = JobManager()
@@ -0,0 +1,205 @@
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+import asyncio
+import logging
+
+import httpx
+from openai import AsyncOpenAI
+
+from .config import settings
+from . import metrics
+
+# Shared async client for the chat model. One AsyncOpenAI per (base URL, key, event loop)
+# keeps its pooled connections alive across requests. At most chat_concurrency calls run
+# upstream at once; up to chat_queue_max more wait (chat_queue_timeout_seconds at most)
+# and the rest are rejected with ChatBusy, so a burst can't pile unbounded work onto the
+# local model. Which API the server speaks - chat.completions, or legacy completions
+# with a flattened prompt - is remembered per base URL after the first call, so the
+# fallback does not cost a failed request every time.
+
+
+class ChatBusy(Exception):
+    pass
+
+
+_client: Optional[AsyncOpenAI] = None
+_client_key: Optional[Tuple[str, str, asyncio.AbstractEventLoop]] = None
+_slots: Optional[asyncio.Semaphore] = None
+_slots_key: Optional[Tuple[int, asyncio.AbstractEventLoop]] = None
+_waiting = 0
+_active = 0
+_api_mode: Dict[str, str] = {}  # base URL -> "chat" | "completions"
+counters: Dict[str, int] = {"requests": 0, "rejected": 0, "fallbacks": 0, "cancelled": 0}
+
+
+def _get_client() -> AsyncOpenAI:
+    global _client, _client_key
+    loop = asyncio.get_running_loop()
+    key = (settings.openai_base_url, settings.openai_api_key, loop)
+    if _client is None or _client_key != key:
+        limits = httpx.Limits(
+            max_connections=int(settings.chat_max_connections),
+            max_keepalive_connections=int(settings.chat_max_connections),
+        )
+        http = httpx.AsyncClient(timeout=float(settings.chat_timeout_seconds), limits=limits)
+        # retries are left to the caller; a silent retry doubles a slow generation
+        _client = AsyncOpenAI(base_url=settings.openai_base_url, api_key=settings.openai_api_key,
+                              http_client=http, max_retries=0)
+        _client_key = key
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None and _client_key is not None and _client_key[2] is asyncio.get_running_loop():
+        await _client.close()
+    _client = None
+
+
+def _get_slots() -> asyncio.Semaphore:
+    global _slots, _slots_key
+    key = (max(1, int(settings.chat_concurrency)), asyncio.get_running_loop())
+    if _slots is None or _slots_key != key:
+        _slots = asyncio.Semaphore(key[0])
+        _slots_key = key
+    return _slots
+
+
+class _Slot:
+    """Upstream concurrency slot with a bounded wait queue."""
+
+    async def __aenter__(self):
+        global _waiting, _active
+        slots = _get_slots()
+        # counted here, not from the semaphore: a burst reaches this line before any acquire runs
+        if _active + _waiting >= _slots_key[0] + int(settings.chat_queue_max):
+            counters["rejected"] += 1
+            raise ChatBusy(f"Chat model is busy ({_waiting} requests waiting)")
+        _waiting += 1
+        try:
+            await asyncio.wait_for(slots.acquire(), float(settings.chat_queue_timeout_seconds))
+        except asyncio.TimeoutError:
+            counters["rejected"] += 1
+            raise ChatBusy("Timed out waiting for the chat model")
+        finally:
+            _waiting -= 1
+        _active += 1
+        self._slots = slots
+        counters["requests"] += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        global _active
+        if exc_type is asyncio.CancelledError:
+            counters["cancelled"] += 1
+        _active -= 1
+        self._slots.release()
+
+
+def _prompt(messages: List[Dict]) -> str:
+    lines = []
+    for m in messages:
+        role = (m.get("role") or "").lower()
+        if role == "system": prefix = "SYSTEM"
+        elif role == "user": prefix = "USER"
+        elif role == "assistant": prefix = "ASSISTANT"
+        else: prefix = role.upper() or "USER"
+        lines.append(f"{prefix}: {m.get('content', '')}")
+    # Optional: prime the assistant role
+    lines.append("ASSISTANT:")
+    return "\n".join(lines)
+
+
+def _remember(base: str, mode: str):
+    if _api_mode.get(base) != mode:
+        logging.info(f"Chat API for {base}: {mode}")
+    _api_mode[base] = mode
+
+
+async def complete(messages: List[Dict], max_tokens: Optional[int] = None, temperature: float = 0.2) -> str:
+    """One non-streaming completion from the chat model."""
+    async with _Slot():
+        client = _get_client()
+        base = settings.openai_base_url
+        if _api_mode.get(base) != "completions":
+            try:
+                resp = await client.chat.completions.create(
+                    model=settings.chat_model, messages=messages, temperature=temperature, max_tokens=max_tokens,
+                )
+                reply = resp.choices[0].message.content if getattr(resp, "choices", None) else ""
+                if reply:
+                    _remember(base, "chat")
+                    return reply
+            except Exception:
+                metrics.upstream_errors.inc(api="chat")
+                if _api_mode.get(base) == "chat":
+                    raise  # known to work: a real error, not a missing API
+            counters["fallbacks"] += 1
+        # Fallback to legacy completions with prompt
+        try:
+            resp = await client.completions.create(
+                model=settings.chat_model, prompt=_prompt(messages), temperature=temperature, max_tokens=max_tokens,
+            )
+        except Exception:
+            metrics.upstream_errors.inc(api="completions")
+            raise
+        reply = resp.choices[0].text if getattr(resp, "choices", None) else ""
+        if reply:
+            _remember(base, "completions")
+        return reply or ""
+
+
+async def stream(messages: List[Dict], temperature: float = 0.2) -> AsyncIterator[str]:
+    """Token deltas from the chat model; closing the iterator closes the upstream response."""
+    async with _Slot():
+        client = _get_client()
+        base = settings.openai_base_url
+        if _api_mode.get(base) != "completions":
+            started = False
+            try:
+                upstream = await client.chat.completions.create(
+                    model=settings.chat_model, messages=messages, temperature=temperature, stream=True,
+                )
+                try:
+                    async for chunk in upstream:
+                        try:
+                            delta = getattr(chunk.choices[0].delta, "content", None)
+                        except Exception:
+                            delta = None
+                        if delta:
+                            if not started:
+                                _remember(base, "chat")
+                                started = True
+                            yield delta
+                finally:
+                    await upstream.close()
+                if started:
+                    return
+            except Exception:
+                metrics.upstream_errors.inc(api="chat")
+                # once tokens went out the answer can't be restarted on the other API
+                if started or _api_mode.get(base) == "chat":
+                    raise
+            counters["fallbacks"] += 1
+        # Fallback: legacy /completions streaming with synthesized prompt
+        try:
+            upstream = await client.completions.create(
+                model=settings.chat_model, prompt=_prompt(messages), temperature=temperature, stream=True,
+            )
+            try:
+                async for chunk in upstream:
+                    try:
+                        delta = chunk.choices[0].text
+                    except Exception:
+                        delta = None
+                    if delta:
+                        _remember(base, "completions")
+                        yield delta
+            finally:
+                await upstream.close()
+        except Exception:
+            metrics.upstream_errors.inc(api="completions")
+            raise
+
+
+def stats() -> Dict:
+    return {**counters, "active": _active, "waiting": _waiting, "api_mode": dict(_api_mode)}
@@ -0,0 +1,189 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import threading
+import time
+
+from .config import settings
+
+# Lightweight metrics in the Prometheus text format, without the client library:
+#   counters and histograms updated in place (thread-safe: searches run on pool threads),
+#   collectors that report the modules' own counter dicts (caches, chat, jobs) at scrape time,
+#   and span(stage) - times one stage of a request into steve_stage_seconds{stage} and, while
+#   a request is being served, into that request's timings (Server-Timing header, and the
+#   "timings" field of /search when asked for).
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+Sample = Tuple[str, str, str, Dict[str, str], float]  # name, type, help, labels, value
+
+_lock = threading.Lock()
+_metrics: List["_Metric"] = []
+_collectors: List[Callable[[], Iterable[Sample]]] = []
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("steve_timings", default=None)
+
+
+def _labels(labels: LabelKey) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        with _lock:
+            _metrics.append(self)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with _lock:
+            values = list(self._values.items())
+        return self.header() + [f"{self.name}{_labels(k)} {v:g}" for k, v in values]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[LabelKey, List[float]] = {}  # per-bucket counts, then sum and count
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+                    break
+            row[-2] += value
+            row[-1] += 1
+
+    def render(self) -> List[str]:
+        with _lock:
+            values = [(k, list(v)) for k, v in self._values.items()]
+        lines = self.header()
+        for key, row in values:
+            running = 0.0
+            for bound, n in zip(self.buckets, row):
+                running += n
+                lines.append(f"{self.name}_bucket{_labels(key + (('le', f'{bound:g}'),))} {running:g}")
+            lines.append(f"{self.name}_bucket{_labels(key + (('le', '+Inf'),))} {row[-1]:g}")
+            lines.append(f"{self.name}_sum{_labels(key)} {row[-2]:g}")
+            lines.append(f"{self.name}_count{_labels(key)} {row[-1]:g}")
+        return lines
+
+
+def register_collector(fn: Callable[[], Iterable[Sample]]):
+    with _lock:
+        _collectors.append(fn)
+
+
+requests_seconds = Histogram("steve_request_seconds", "HTTP request latency by route.")
+requests_total = Counter("steve_requests_total", "HTTP requests by route and status.")
+stage_seconds = Histogram("steve_stage_seconds", "Time spent in each request stage.")
+rows_scanned = Counter("steve_rows_scanned_total", "Rows scored or read per retrieval stage.")
+embedding_requests = Histogram("steve_embedding_request_seconds", "Latency of upstream embedding requests.")
+embedding_retries = Counter("steve_embedding_retries_total", "Embedding requests retried after an error.")
+embedding_errors = Counter("steve_embedding_errors_total", "Embedding batches that failed after all retries.")
+upstream_errors = Counter("steve_upstream_errors_total", "Failed calls to the model server by API.")
+
+
+@contextmanager
+def span(stage: str):
+    """Time a stage of the current request."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        stage_seconds.observe(elapsed, stage=stage)
+        timings = _timings.get()
+        if timings is not None:
+            # the same stage may run more than once (e.g. several SQL fetches)
+            timings[stage] = timings.get(stage, 0.0) + elapsed * 1000
+
+
+def timings() -> Optional[Dict[str, float]]:
+    """Milliseconds per stage of the request being served, if any."""
+    current = _timings.get()
+    return None if current is None else {k: round(v, 3) for k, v in current.items()}
+
+
+def render() -> str:
+    with _lock:
+        metrics, collectors = list(_metrics), list(_collectors)
+    lines: List[str] = []
+    for metric in metrics:
+        lines += metric.render()
+    seen = set()
+    for collect in collectors:
+        for name, kind, help, labels, value in collect():
+            if name not in seen:
+                seen.add(name)
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            lines.append(f"{name}{_labels(tuple(sorted(labels.items())))} {float(value):g}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """Request latency and status per route, per-request stage timings and the Server-Timing header.
+
+    Plain ASGI (not BaseHTTPMiddleware) so streaming responses and disconnect handling
+    pass through untouched.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timings: Dict[str, float] = {}
+        token = _timings.set(timings)
+        status = {"code": 500}
+        t0 = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                if timings and settings.server_timing:
+                    value = ", ".join(f"{k};dur={v:.2f}" for k, v in timings.items())
+                    message = {**message, "headers": list(message.get("headers", [])) + [(b"server-timing", value.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _timings.reset(token)
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            requests_seconds.observe(time.perf_counter() - t0, route=path, method=scope["method"])
+            requests_total.inc(route=path, method=scope["method"], status=str(status["code"]))
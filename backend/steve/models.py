@@ -1,5 +1,6 @@
+from datetime import datetime
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 
 class KBCreate(BaseModel):
     name: str
@@ -13,12 +14,34 @@ class IngestURL(BaseModel):
     kb_id: int
     url: str
 
+class SearchFilters(BaseModel):
+    """Restricts retrieval to matching documents; all given conditions must hold."""
+    types: Optional[List[str]] = None  # document types, e.g. ["pdf", "docx"]
+    document_ids: Optional[List[int]] = None
+    source_prefix: Optional[str] = None  # file path or URL prefix
+    created_after: Optional[datetime] = None  # inclusive; naive times are UTC
+    created_before: Optional[datetime] = None  # exclusive
+    meta: Optional[Dict[str, Any]] = None  # key -> value (or list of accepted values)
+
 class SearchQuery(BaseModel):
     kb_ids: List[int]
     query: str
     top_k: int = 5
     hybrid: bool = True
     alpha: float = 0.6  # weight for semantic score
+    fusion: Optional[str] = None  # "rrf" | "normalized"; defaults to settings.fusion_mode
+    timings: bool = False  # include per-stage milliseconds in the response
+    filters: Optional[SearchFilters] = None
+
+class SearchBatch(BaseModel):
+    kb_ids: List[int]
+    queries: List[str]
+    top_k: int = 5
+    hybrid: bool = True
+    alpha: float = 0.6
+    fusion: Optional[str] = None
+    timings: bool = False
+    filters: Optional[SearchFilters] = None
 
 class ChatMessage(BaseModel):
     role: str
@@ -28,6 +51,8 @@ class ChatRequest(BaseModel):
     kb_ids: List[int]
     messages: List[ChatMessage]
     top_k: int = 5
+    conversation_id: Optional[str] = None  # lets the server reuse summaries of earlier turns
+    filters: Optional[SearchFilters] = None
 
 class ChatResponse(BaseModel):
     reply: str
@@ -0,0 +1,75 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Optional
+import asyncio
+import contextvars
+import functools
+import threading
+
+from .config import settings
+
+# Where blocking work runs, so async handlers never stall the event loop:
+#   db_read  - SQLite reads and searches on a bounded thread pool (db_read_threads, one per
+#              core by default); each thread keeps its own read connection and WAL lets
+#              them run side by side. With 0 threads reads run on the loop;
+#   db_write - writes on one thread: SQLite has a single writer, and queueing writes there
+#              keeps them from tying up read threads while they wait for the write lock;
+#   parse    - CPU-heavy parsing (PDF/Office extraction, HTML) in a process pool of
+#              job_parse_workers processes (a thread when it is 0).
+
+_read_pool: Optional[ThreadPoolExecutor] = None
+_write_pool: Optional[ThreadPoolExecutor] = None
+_parse_pool: Optional[ProcessPoolExecutor] = None
+_lock = threading.Lock()
+counters: Dict[str, int] = {"reads": 0, "writes": 0, "parses": 0}
+
+
+def _pools():
+    global _read_pool, _write_pool
+    with _lock:
+        if _read_pool is None:
+            _read_pool = ThreadPoolExecutor(max_workers=max(1, int(settings.db_read_threads)), thread_name_prefix="db-read")
+            _write_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        return _read_pool, _write_pool
+
+
+async def db_read(fn, *args, **kwargs):
+    counters["reads"] += 1
+    if int(settings.db_read_threads) <= 0:
+        return fn(*args, **kwargs)
+    # the context carries the request's stage timings into the worker thread
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(_pools()[0], functools.partial(ctx.run, fn, *args, **kwargs))
+
+
+async def db_write(fn, *args, **kwargs):
+    counters["writes"] += 1
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(_pools()[1], functools.partial(ctx.run, fn, *args, **kwargs))
+
+
+async def parse(fn, *args):
+    """fn(*args) in a worker process; fn and its arguments must be picklable."""
+    global _parse_pool
+    counters["parses"] += 1
+    if int(settings.job_parse_workers) <= 0:
+        return await asyncio.to_thread(fn, *args)
+    with _lock:
+        if _parse_pool is None:
+            _parse_pool = ProcessPoolExecutor(max_workers=int(settings.job_parse_workers))
+    return await asyncio.get_running_loop().run_in_executor(_parse_pool, fn, *args)
+
+
+def shutdown():
+    global _read_pool, _write_pool, _parse_pool
+    with _lock:
+        if _read_pool is not None:
+            _read_pool.shutdown(wait=True)
+            _write_pool.shutdown(wait=True)
+            _read_pool = _write_pool = None
+        if _parse_pool is not None:
+            _parse_pool.shutdown(wait=False, cancel_futures=True)
+            _parse_pool = None
+
+
+def stats() -> Dict:
+    return {**counters, "read_threads": int(settings.db_read_threads), "parse_workers": int(settings.job_parse_workers)}
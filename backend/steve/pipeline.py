@@ -0,0 +1,367 @@
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+import asyncio
+import hashlib
+import itertools
+import os
+import time
+import numpy as np
+
+from .config import settings
+from .db import get_conn
+from . import ingest
+from .chunking import Chunk, get_chunker
+from .embedding import embed_texts
+from .service import (
+    add_document, chunk_counts, delete_document, document_chunks, embedding_vectors, find_document,
+    iter_document_chunks, truncate_chunks, update_document, upsert_embeddings,
+)
+
+# run_db(fn, *args) -> awaitable result; lets callers move DB work off the event loop
+RunDB = Callable[..., Awaitable[Any]]
+Progress = Callable[..., None]
+
+
+async def _inline(fn, *args, **kwargs):
+    return fn(*args, **kwargs)
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+
+def _write_document(existing: Optional[Dict], kb_id: int, source: str, key: str, title: str, type_: str, text: str,
+                    meta: Optional[dict], digest: str, chunks: List[str], spans: List[Tuple[int, int]],
+                    changed: List[int], vectors: Dict[str, List[float]]) -> Dict[str, int]:
+    if existing:
+        doc_id = existing["id"]
+        update_document(doc_id, title, type_, text, meta=meta, content_hash=digest)
+    else:
+        doc_id = add_document(kb_id, source, title, type_, text, meta=meta, source_key=key, content_hash=digest)
+    if changed:
+        upsert_embeddings(doc_id, [chunks[i] for i in changed], [vectors[chunks[i]] for i in changed], indices=changed,
+                          spans=[spans[i] for i in changed])
+    removed = truncate_chunks(doc_id, len(chunks)) if existing else 0
+    return {"document_id": doc_id, "removed": removed}
+
+
+def _stored_chunks(doc_id: int) -> List[Tuple[int, str, List[float], Tuple]]:
+    # vectors are decoded here, in run_db, rather than on the event loop; chunks whose
+    # embedding failed are left out so they are embedded again
+    return [(idx, text, np.frombuffer(blob, dtype=np.float32).tolist(), span)
+            for idx, text, blob, span in document_chunks(doc_id, embedded_only=True)]
+
+
+async def _plan(kb_id: int, source: str, title: str, type_: str, text: str, meta: Optional[dict],
+                source_key: Optional[str], run_db: RunDB) -> Dict:
+    """Read phase: diff the new text against the stored version of the same source."""
+    key = source_key or source
+    digest = await asyncio.to_thread(content_hash, text)
+    existing = await run_db(find_document, kb_id, key)
+    plan = {"kb_id": kb_id, "source": source, "key": key, "title": title, "type": type_, "text": text,
+            "meta": meta, "digest": digest, "existing": existing}
+    if existing and existing["content_hash"] == digest:
+        n, failed = await run_db(chunk_counts, existing["id"])
+        if not failed:
+            plan["result"] = {"document_id": existing["id"], "chunks": n, "reused": n, "embedded": 0, "removed": 0,
+                              "unchanged": True}
+            return plan
+    # tokenizing a whole page takes a while; keep it off the event loop
+    pieces = await asyncio.to_thread(get_chunker().chunk, text)
+    chunks = [c.text for c in pieces]
+    spans = [(c.start, c.end) for c in pieces]
+    old_at: Dict[int, Tuple[str, Tuple]] = {}
+    vectors: Dict[str, List[float]] = {}
+    if existing:
+        for idx, old_text, vec, old_span in await run_db(_stored_chunks, existing["id"]):
+            old_at[idx] = (old_text, old_span)
+            vectors.setdefault(old_text, vec)
+    # positions whose text (or span) changed; of those, embed only text not stored anywhere
+    # in the old version
+    changed = [i for i, c in enumerate(chunks) if old_at.get(i) != (c, spans[i])]
+    plan.update(chunks=chunks, spans=spans, changed=changed, vectors=vectors,
+                fresh=list(dict.fromkeys(chunks[i] for i in changed if chunks[i] not in vectors)))
+    return plan
+
+
+def _write_plan(plan: Dict) -> Dict:
+    written = _write_document(plan["existing"], plan["kb_id"], plan["source"], plan["key"], plan["title"],
+                              plan["type"], plan["text"], plan["meta"], plan["digest"], plan["chunks"],
+                              plan["spans"], plan["changed"], plan["vectors"])
+    chunks, changed = plan["chunks"], plan["changed"]
+    fresh_set = set(plan["fresh"])
+    embedded = sum(1 for i in changed if chunks[i] in fresh_set)
+    return {
+        "document_id": written["document_id"],
+        "chunks": len(chunks),
+        "reused": len(chunks) - embedded,
+        "embedded": embedded,
+        "removed": written["removed"],
+        "unchanged": False,
+    }
+
+
+def _write_plans(plans: List[Dict]) -> List[Dict]:
+    # one transaction for the whole group; the vector index and caches follow at commit
+    with get_conn():
+        return [_write_plan(p) for p in plans]
+
+
+async def ingest_text(kb_id: int, source: str, title: str, type_: str, text: str,
+                      meta: Optional[dict] = None, source_key: Optional[str] = None,
+                      run_db: Optional[RunDB] = None, progress: Optional[Progress] = None) -> Dict:
+    """Store a parsed document, re-embedding only chunks that changed since the last ingest.
+
+    A source is identified by ``source_key`` (file path or URL, default ``source``). If the
+    KB already holds it, the same document row is updated in place: unchanged chunks are left
+    alone, moved/duplicated chunks reuse their stored vectors, and only new text is embedded.
+    Nothing is written until every embedding is available, so cancelling the coroutine
+    before then leaves the KB untouched.
+    """
+    run_db = run_db or _inline
+    report = progress or (lambda **info: None)
+    report(stage="chunking")
+    plan = await _plan(kb_id, source, title, type_, text, meta, source_key, run_db)
+    if "result" in plan:
+        return plan["result"]
+    fresh, vectors = plan["fresh"], plan["vectors"]
+    report(stage="embedding", chunks_total=len(plan["chunks"]), to_embed=len(fresh), embedded=0)
+    # embed in slices so progress is visible on big documents
+    step = max(1, int(settings.embedding_batch_size) * max(1, int(settings.embedding_concurrency)))
+    for start in range(0, len(fresh), step):
+        part = fresh[start:start + step]
+        for c, vec in zip(part, await embed_texts(part)):
+            vectors[c] = vec
+        report(stage="embedding", embedded=start + len(part))
+    report(stage="writing")
+    # one transaction, so a failed write leaves the old hash and chunks together
+    return (await run_db(_write_plans, [plan]))[0]
+
+
+def _chunk_digest(text: str) -> bytes:
+    return hashlib.sha1(text.encode("utf-8", errors="surrogatepass")).digest()
+
+
+def _old_chunk_digests(doc_id: int) -> Dict[int, Tuple[bytes, int, Tuple]]:
+    # chunk_index -> (digest of text, embedding id, span); the texts themselves are not kept
+    # (chunks whose embedding failed are left out, so they count as changed)
+    return {idx: (_chunk_digest(text), eid, span)
+            for idx, eid, text, span in iter_document_chunks(doc_id, embedded_only=True)}
+
+
+def _decoded_vectors(ids: List[int]) -> Dict[int, List[float]]:
+    return {eid: np.frombuffer(blob, dtype=np.float32).tolist() for eid, blob in embedding_vectors(ids).items()}
+
+
+def _take(chunks: Iterator, n: int) -> list:
+    return list(itertools.islice(chunks, n))
+
+
+def _read_text(path: str) -> str:
+    with open(path, encoding="utf-8", errors="surrogatepass", newline="") as f:
+        return f.read()
+
+
+def _write_window(doc_id: Optional[int], first: bool, kb_id: int, source: str, key: str, title: str, type_: str,
+                  meta: Optional[dict], chunks: List[str], vectors: List[List[float]], indices: List[int],
+                  spans: List[Tuple]) -> int:
+    with get_conn() as conn:
+        if doc_id is None:
+            doc_id = add_document(kb_id, source, title, type_, "", meta, key, None)
+        elif first:
+            # from here until _finish_document the chunks no longer match the stored content;
+            # without a hash an interrupted ingest is redone rather than reported unchanged
+            conn.execute("UPDATE document SET content_hash=NULL WHERE id=?", (doc_id,))
+        upsert_embeddings(doc_id, chunks, vectors, indices, spans)
+    return doc_id
+
+
+def _finish_document(doc_id: Optional[int], existing: Optional[Dict], kb_id: int, source: str, key: str, title: str,
+                     type_: str, meta: Optional[dict], count: int, text_path: str, digest: str, index_fts: bool):
+    with get_conn():
+        if doc_id is None:
+            doc_id = add_document(kb_id, source, title, type_, "", meta, key, None)
+        removed = truncate_chunks(doc_id, count) if existing else 0
+        update_document(doc_id, title, type_, _read_text(text_path), meta=meta, content_hash=digest,
+                        index_fts=index_fts)
+    return doc_id, removed
+
+
+async def ingest_stream(kb_id: int, source: str, title: str, type_: str, text_path: str, digest: str,
+                        meta: Optional[dict] = None, source_key: Optional[str] = None,
+                        run_db: Optional[RunDB] = None, progress: Optional[Progress] = None) -> Dict:
+    """ingest_text for a document spooled to disk by ingest.extract_to_file.
+
+    Chunks are read from the file incrementally, then embedded and written in windows of
+    about ``ingest_memory_mb``, so memory does not grow with the document. Windows are
+    committed as they complete. The stored hash is cleared with the first of them and the
+    content and hash go last, so an interrupted ingest is simply redone by the next one. A
+    new document is deleted again if its ingest fails or is cancelled.
+    """
+    run_db = run_db or _inline
+    report = progress or (lambda **info: None)
+    key = source_key or source
+    existing = await run_db(find_document, kb_id, key)
+    if existing and existing["content_hash"] == digest:
+        n, failed = await run_db(chunk_counts, existing["id"])
+        if not failed:
+            return {"document_id": existing["id"], "chunks": n, "reused": n, "embedded": 0, "removed": 0,
+                    "unchanged": True}
+    old = await run_db(_old_chunk_digests, existing["id"]) if existing else {}
+    # a new document row is created with the first window written; content and hash are
+    # filled in once every chunk is stored
+    doc_id = existing["id"] if existing else None
+    first = True
+    old_ids = {d: eid for d, eid, _ in old.values()}
+
+    budget = int(settings.ingest_memory_mb) * 1024 * 1024
+    dim = 1024  # until the first vectors arrive
+    counts = {"chunks": 0, "reused": 0, "embedded": 0}
+    window: List[Tuple[int, Chunk]] = []
+    window_bytes = 0
+
+    async def flush():
+        nonlocal window, window_bytes, dim, doc_id, first
+        changed = []
+        for i, chunk in window:
+            d = _chunk_digest(chunk.text)
+            if old.get(i, (None, None, None))[::2] != (d, (chunk.start, chunk.end)):
+                changed.append((i, chunk.text, d, (chunk.start, chunk.end)))
+        window, window_bytes = [], 0
+        if not changed:
+            return
+        vectors: Dict[str, List[float]] = {}
+        # moved/duplicated chunks reuse their stored vectors
+        reuse = {c: old_ids[d] for _, c, d, _ in changed if d in old_ids}
+        if reuse:
+            stored = await run_db(_decoded_vectors, list(set(reuse.values())))
+            for c, eid in reuse.items():
+                if eid in stored:
+                    vectors[c] = stored[eid]
+        fresh = list(dict.fromkeys(c for _, c, _, _ in changed if c not in vectors))
+        report(stage="embedding", **counts)
+        for c, vec in zip(fresh, await embed_texts(fresh)):
+            vectors[c] = vec
+            dim = len(vec) or dim
+        fresh_set = set(fresh)
+        counts["embedded"] += sum(1 for _, c, _, _ in changed if c in fresh_set)
+        report(stage="writing", **counts)
+        doc_id = await run_db(_write_window, doc_id, first, kb_id, source, key, title, type_, meta,
+                              [c for _, c, _, _ in changed], [vectors[c] for _, c, _, _ in changed],
+                              [i for i, _, _, _ in changed], [span for _, _, _, span in changed])
+        first = False
+        report(stage="chunking", **counts)
+
+    try:
+        report(stage="chunking")
+        # the file is read and tokenized in a worker thread, a few hundred chunks at a time
+        chunks = enumerate(get_chunker().iter_chunks(ingest.iter_text_file(text_path)))
+        while True:
+            batch = await asyncio.to_thread(_take, chunks, 256)
+            if not batch:
+                break
+            for idx, chunk in batch:
+                window.append((idx, chunk))
+                # rough footprint: the text and its vector as a Python float list, plus the
+                # copies made while writing
+                window_bytes += 4 * len(chunk.text) + 64 * dim
+                counts["chunks"] = idx + 1
+                if window_bytes >= budget:
+                    await flush()
+        await flush()
+        counts["reused"] = counts["chunks"] - counts["embedded"]
+
+        report(stage="writing", **counts)
+        # the stored document text is the one full-size copy; indexing it as a single doc_fts
+        # row would take several times that, so past the budget only chunk_fts covers it
+        small = os.path.getsize(text_path) * 4 <= budget
+        doc_id, removed = await run_db(_finish_document, doc_id, existing, kb_id, source, key, title, type_, meta,
+                                       counts["chunks"], text_path, digest, small)
+    except BaseException:
+        if not existing and doc_id is not None:
+            # don't leave a half-written new document (with empty content) behind
+            try:
+                await asyncio.shield(run_db(delete_document, doc_id))
+            except BaseException:
+                pass
+        raise
+    return {"document_id": doc_id, **counts, "removed": removed, "unchanged": False}
+
+
+async def ingest_batch(kb_id: int, docs: AsyncIterator[Dict], run_db: Optional[RunDB] = None,
+                       progress: Optional[Progress] = None) -> Dict:
+    """Ingest many parsed documents, pooling their chunks into shared embedding calls.
+
+    ``docs`` yields dicts with ``source``, ``title``, ``type``, ``meta``/``source_key`` and either
+    ``text`` or a spooled ``text_path`` (with ``digest`` and ``chars``, see ingest.extract_to_file),
+    or ``error`` for a file that could not be parsed. Documents are grouped until about
+    ``ingest_batch_chunks`` new chunks are pending; each group is embedded in one call and
+    written in one transaction. Spooled documents too big for the memory budget go through
+    ingest_stream on their own.
+    """
+    run_db = run_db or _inline
+    report = progress or (lambda **info: None)
+    t0 = time.perf_counter()
+    totals = {"documents": 0, "unchanged": 0, "failed": 0, "chunks": 0, "embedded": 0}
+    results: List[Dict] = []
+    pending: List[Dict] = []
+    pending_chunks = 0
+
+    def rates() -> Dict:
+        elapsed = max(time.perf_counter() - t0, 1e-9)
+        return {"elapsed_seconds": round(elapsed, 3),
+                "docs_per_sec": round((totals["documents"] + totals["unchanged"]) / elapsed, 2),
+                "chunks_per_sec": round(totals["chunks"] / elapsed, 2)}
+
+    async def flush():
+        nonlocal pending, pending_chunks
+        if not pending:
+            return
+        # identical text in several documents is embedded once
+        texts = list(dict.fromkeys(t for p in pending for t in p["fresh"]))
+        report(stage="embedding", **totals, **rates())
+        vectors = dict(zip(texts, await embed_texts(texts))) if texts else {}
+        for p in pending:
+            for t in p["fresh"]:
+                p["vectors"][t] = vectors[t]
+        report(stage="writing", **totals, **rates())
+        for p, res in zip(pending, await run_db(_write_plans, pending)):
+            results.append({"source": p["key"], **res})
+            totals["documents"] += 1
+            totals["chunks"] += res["chunks"]
+            totals["embedded"] += res["embedded"]
+        pending, pending_chunks = [], 0
+        report(stage="parsing", **totals, **rates())
+
+    async for doc in docs:
+        if doc.get("error"):
+            totals["failed"] += 1
+            results.append({"source": doc.get("source_key") or doc.get("source"), "error": doc["error"]})
+            continue
+        key = doc.get("source_key") or doc["source"]
+        title = doc.get("title") or doc["source"]
+        if any(p["key"] == key for p in pending):
+            # same source twice in one group: write the first so the second diffs against it
+            await flush()
+        text = doc.get("text")
+        if text is None:
+            if 2 * doc["chars"] > int(settings.ingest_memory_mb) * 1024 * 1024 // 8:
+                await flush()
+                res = await ingest_stream(kb_id, doc["source"], title, doc["type"], doc["text_path"], doc["digest"],
+                                          doc.get("meta"), key, run_db)
+                results.append({"source": key, **res})
+                totals["unchanged" if res["unchanged"] else "documents"] += 1
+                totals["chunks"] += 0 if res["unchanged"] else res["chunks"]
+                totals["embedded"] += res["embedded"]
+                continue
+            text = _read_text(doc["text_path"])
+        plan = await _plan(kb_id, doc["source"], title, doc["type"], text, doc.get("meta"), key, run_db)
+        if "result" in plan:
+            totals["unchanged"] += 1
+            results.append({"source": key, **plan["result"]})
+            continue
+        pending.append(plan)
+        pending_chunks += len(plan["fresh"])
+        if pending_chunks >= int(settings.ingest_batch_chunks):
+            await flush()
+    await flush()
+    return {**totals, **rates(), "results": results}
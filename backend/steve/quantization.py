@@ -0,0 +1,109 @@
+from typing import Tuple
+import numpy as np
+
+# Vector codecs for the resident index. Codes are only used to pick candidates;
+# the final ranking is recomputed from full-precision vectors.
+
+_BLOCK = 65536
+
+
+def int8_encode(mat: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric per-row scalar quantization: row ~= codes * scale."""
+    mat = np.asarray(mat, dtype=np.float32)
+    scales = np.abs(mat).max(axis=1) / 127.0
+    safe = np.where(scales > 0, scales, 1.0)
+    codes = np.clip(np.rint(mat / safe[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def int8_decode(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    return codes.astype(np.float32) * scales[:, None]
+
+
+def int8_scores(codes: np.ndarray, scales: np.ndarray, query: np.ndarray) -> np.ndarray:
+    out = np.empty(codes.shape[0], dtype=np.float32)
+    for start in range(0, codes.shape[0], _BLOCK):
+        part = codes[start:start + _BLOCK].astype(np.float32)
+        out[start:start + _BLOCK] = (part @ query) * scales[start:start + _BLOCK]
+    return out
+
+
+def int8_to_blob(codes: np.ndarray, scale: float) -> bytes:
+    # stored layout in embedding.code: float32 scale followed by `dim` int8 codes
+    return np.float32(scale).tobytes() + codes.tobytes()
+
+
+def int8_from_blob(blob: bytes) -> Tuple[np.ndarray, float]:
+    return np.frombuffer(blob, dtype=np.int8, offset=4), float(np.frombuffer(blob[:4], dtype=np.float32)[0])
+
+
+def pq_subvectors(dim: int, requested: int = 0) -> int:
+    """Number of PQ sub-quantizers: ``requested`` (or dim/8) rounded down to a divisor of dim."""
+    m = max(1, min(dim, requested or dim // 8 or 1))
+    while dim % m:
+        m -= 1
+    return m
+
+
+def _kmeans_l2(data: np.ndarray, k: int, iters: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = data[rng.choice(data.shape[0], size=k, replace=False)].copy()
+    for _ in range(iters):
+        # argmin ||x - c||^2 == argmax (x.c - |c|^2 / 2)
+        assign = np.argmax(data @ centroids.T - 0.5 * (centroids ** 2).sum(axis=1), axis=1)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, data)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+
+class ProductQuantizer:
+    """Splits vectors into ``m`` sub-vectors, each encoded as one byte (256 centroids).
+
+    Inner products are approximated with a per-query lookup table (asymmetric distance):
+    score(x) = sum_j <q_j, codebook_j[code_j]>.
+    """
+
+    def __init__(self, dim: int, m: int):
+        self.dim = dim
+        self.m = m
+        self.sub = dim // m
+        self.codebooks = np.zeros((m, 0, self.sub), dtype=np.float32)
+
+    def train(self, data: np.ndarray, iters: int = 8, seed: int = 0, max_points: int = 256 * 16) -> "ProductQuantizer":
+        rng = np.random.default_rng(seed)
+        data = np.asarray(data, dtype=np.float32)
+        if data.shape[0] > max_points:
+            data = data[rng.choice(data.shape[0], size=max_points, replace=False)]
+        k = min(256, data.shape[0])
+        parts = data.reshape(data.shape[0], self.m, self.sub)
+        self.codebooks = np.stack([_kmeans_l2(parts[:, j], k, iters, rng) for j in range(self.m)])
+        return self
+
+    def encode(self, mat: np.ndarray) -> np.ndarray:
+        mat = np.asarray(mat, dtype=np.float32)
+        codes = np.empty((mat.shape[0], self.m), dtype=np.uint8)
+        half_norms = 0.5 * (self.codebooks ** 2).sum(axis=2)
+        for start in range(0, mat.shape[0], _BLOCK):
+            parts = mat[start:start + _BLOCK].reshape(-1, self.m, self.sub)
+            for j in range(self.m):
+                codes[start:start + _BLOCK, j] = np.argmax(parts[:, j] @ self.codebooks[j].T - half_norms[j], axis=1)
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        out = np.empty((codes.shape[0], self.m, self.sub), dtype=np.float32)
+        for j in range(self.m):
+            out[:, j] = self.codebooks[j][codes[:, j]]
+        return out.reshape(codes.shape[0], self.dim)
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        # lut[j, c] = <q_j, codebook_j[c]>
+        lut = np.einsum("jcs,js->jc", self.codebooks, query.reshape(self.m, self.sub))
+        out = np.zeros(codes.shape[0], dtype=np.float32)
+        for start in range(0, codes.shape[0], _BLOCK):
+            part = codes[start:start + _BLOCK]
+            acc = out[start:start + _BLOCK]
+            for j in range(self.m):
+                acc += lut[j, part[:, j]]
+        return out
@@ -0,0 +1,173 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+
+import numpy as np
+
+from .config import settings
+from .embedding import _get_client
+
+# Optional second stage between retrieval and the prompt: a cross-encoder scores each
+# (query, chunk) pair and the best top_k go to the model. Backends:
+#
+#   "onnx":     a local cross-encoder (e.g. ms-marco-MiniLM) exported to ONNX, run on the
+#               CPU; rerank_onnx_path is a folder with model.onnx and tokenizer.json.
+#               Needs the optional onnxruntime and tokenizers packages.
+#   "endpoint": POST {base}/rerank on the OpenAI-compatible server (the llama.cpp / vLLM /
+#               Jina style: {model, query, documents} -> results[{index, relevance_score}]).
+#
+# Candidates are scored in batches within rerank_budget_ms; if the budget runs out or the
+# backend fails, the fused retrieval order is kept. Scores are cached per (model, query,
+# chunk text), so batches that finished late still help the next identical request.
+
+_scores: "OrderedDict[bytes, float]" = OrderedDict()
+_lock = threading.Lock()
+counters: Dict[str, int] = {"requests": 0, "reranked": 0, "fallbacks": 0, "cache_hits": 0, "scored": 0}
+
+
+def enabled() -> bool:
+    return settings.reranker in ("onnx", "endpoint")
+
+
+def _model_id() -> str:
+    if settings.reranker == "onnx":
+        return f"onnx:{settings.rerank_onnx_path}"
+    return f"endpoint:{settings.rerank_model}"
+
+
+def _key(model: str, query: str, text: str) -> bytes:
+    return hashlib.sha1("\0".join((model, query, text)).encode("utf-8", errors="surrogatepass")).digest()
+
+
+def _cache_put(pairs: List[Tuple[bytes, float]]):
+    limit = int(settings.rerank_cache_items)
+    with _lock:
+        for key, score in pairs:
+            _scores[key] = score
+            _scores.move_to_end(key)
+        while len(_scores) > limit:
+            _scores.popitem(last=False)
+
+
+class _OnnxCrossEncoder:
+    def __init__(self, path: str):
+        import onnxruntime  # optional dependency
+        from tokenizers import Tokenizer  # optional dependency
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(path, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=512)
+        self.tokenizer.enable_padding()
+        opts = onnxruntime.SessionOptions()
+        opts.intra_op_num_threads = max(1, (os.cpu_count() or 2) // 2)
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(path, "model.onnx"), opts, providers=["CPUExecutionProvider"]
+        )
+        self.inputs = {i.name for i in self.session.get_inputs()}
+        self.lock = threading.Lock()
+
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        enc = self.tokenizer.encode_batch([(query, t) for t in texts])
+        feed = {
+            "input_ids": np.array([e.ids for e in enc], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in enc], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in enc], dtype=np.int64),
+        }
+        with self.lock:
+            logits = self.session.run(None, {k: v for k, v in feed.items() if k in self.inputs})[0]
+        logits = np.asarray(logits, dtype=np.float32).reshape(len(texts), -1)
+        # single relevance logit, or the positive class of a two-way classifier
+        return logits[:, -1].tolist()
+
+
+_onnx: Optional[_OnnxCrossEncoder] = None
+_onnx_path: Optional[str] = None
+_onnx_lock = threading.Lock()
+
+
+def _onnx_model() -> _OnnxCrossEncoder:
+    global _onnx, _onnx_path
+    with _onnx_lock:
+        if _onnx is None or _onnx_path != settings.rerank_onnx_path:
+            _onnx = _OnnxCrossEncoder(settings.rerank_onnx_path)
+            _onnx_path = settings.rerank_onnx_path
+        return _onnx
+
+
+async def _score_endpoint(query: str, texts: List[str]) -> List[float]:
+    base = (settings.openai_base_url or "").rstrip("/")
+    if not base.endswith("/v1"):
+        base += "/v1"
+    resp = await _get_client().post(
+        f"{base}/rerank",
+        headers={"Authorization": f"Bearer {settings.openai_api_key}"},
+        json={"model": settings.rerank_model, "query": query, "documents": texts},
+    )
+    resp.raise_for_status()
+    scores: List[Optional[float]] = [None] * len(texts)
+    for item in resp.json().get("results") or []:
+        scores[int(item["index"])] = float(item.get("relevance_score", item.get("score", 0.0)))
+    if any(s is None for s in scores):
+        raise ValueError("rerank response does not cover every document")
+    return scores
+
+
+def _scored(keys: List[bytes], scores: List[float]) -> List[Tuple[bytes, float]]:
+    scored = list(zip(keys, scores))
+    _cache_put(scored)
+    counters["scored"] += len(scored)
+    return scored
+
+
+async def _score_batch(query: str, texts: List[str], keys: List[bytes]) -> List[Tuple[bytes, float]]:
+    if settings.reranker == "onnx":
+        # cached from the worker thread, which keeps going if the request gives up on it
+        return await asyncio.to_thread(lambda: _scored(keys, _onnx_model().score(query, texts)))
+    return _scored(keys, await _score_endpoint(query, texts))
+
+
+async def rerank(query: str, contexts: List[Dict], top_k: int) -> List[Dict]:
+    """Best top_k of contexts by cross-encoder score (with "rerank_score"); fused order on fallback."""
+    if not enabled() or len(contexts) <= 1:
+        return contexts[:top_k]
+    counters["requests"] += 1
+    model = _model_id()
+    keys = [_key(model, query, c["text"]) for c in contexts]
+    with _lock:
+        known = {k: _scores[k] for k in keys if k in _scores}
+        for k in known:
+            _scores.move_to_end(k)
+    counters["cache_hits"] += len(known)
+    todo = list(dict.fromkeys(k for k in keys if k not in known))
+    if todo:
+        text_of = {k: c["text"] for k, c in zip(keys, contexts)}
+        size = max(1, int(settings.rerank_batch_size))
+        tasks = [
+            asyncio.create_task(_score_batch(query, [text_of[k] for k in todo[i:i + size]], todo[i:i + size]))
+            for i in range(0, len(todo), size)
+        ]
+        done, pending = await asyncio.wait(tasks, timeout=max(0.0, float(settings.rerank_budget_ms)) / 1000)
+        failed = [t.exception() for t in done if t.exception() is not None]
+        if pending or failed:
+            # ONNX batches already in a thread finish in the background and still fill the cache
+            for t in pending:
+                t.cancel()
+            if failed:
+                logging.warning(f"Rerank failed, keeping retrieval order: {failed[0]}")
+            counters["fallbacks"] += 1
+            return contexts[:top_k]
+        for t in done:
+            known.update(t.result())
+    counters["reranked"] += 1
+    ranked = [{**c, "rerank_score": known[k]} for c, k in zip(contexts, keys)]
+    # stable: ties keep the fused order
+    ranked.sort(key=lambda c: c["rerank_score"], reverse=True)
+    return ranked[:top_k]
+
+
+def stats() -> Dict:
+    with _lock:
+        return {**counters, "backend": settings.reranker, "cached_scores": len(_scores)}
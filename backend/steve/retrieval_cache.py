@@ -0,0 +1,111 @@
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+import re
+import threading
+import time
+
+from .config import settings
+
+# Results of recent /search and /chat retrievals, keyed by (kb_ids, normalized query,
+# top_k, alpha, embedding model, retrieval variant), so a repeated question skips both the query embedding
+# and the search. Entries expire after retrieval_cache_ttl seconds and the least recently
+# used are evicted past retrieval_cache_items. Every KB has a generation number that is
+# bumped whenever its contents change, plus a global one bumped by invalidate(None); an
+# entry stamped with older generations is stale.
+
+Key = Tuple[Tuple[int, ...], str, int, Optional[float], str, str]
+
+_entries: "OrderedDict[Key, Tuple[float, Tuple[int, ...], List[Dict]]]" = OrderedDict()
+_generations: Dict[int, int] = {}
+_global_generation = 0
+_lock = threading.Lock()
+counters: Dict[str, int] = {"hits": 0, "misses": 0, "expired": 0, "stale": 0, "evicted": 0, "invalidations": 0}
+
+
+def normalize_query(query: str) -> str:
+    return re.sub(r"\s+", " ", query or "").strip().lower()
+
+
+def make_key(kb_ids: Iterable[int], query: str, top_k: int, alpha: Optional[float], model: str,
+             variant: str = "") -> Key:
+    """alpha is None for semantic-only retrieval; variant covers other settings (fusion mode, depths)."""
+    return (
+        tuple(sorted(set(int(k) for k in kb_ids))),
+        normalize_query(query),
+        int(top_k),
+        None if alpha is None else round(float(alpha), 4),
+        model,
+        variant,
+    )
+
+
+def _current(kb_ids: Tuple[int, ...]) -> Tuple[int, ...]:
+    return (_global_generation,) + tuple(_generations.get(k, 0) for k in kb_ids)
+
+
+def stamp(kb_ids: Tuple[int, ...]) -> Tuple[int, ...]:
+    """Current generations of the KBs; take it before searching and pass it to put()."""
+    with _lock:
+        return _current(kb_ids)
+
+
+def get(key: Key) -> Optional[List[Dict]]:
+    if int(settings.retrieval_cache_items) <= 0:
+        return None
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            counters["misses"] += 1
+            return None
+        expires, gens, results = entry
+        expired = expires < time.monotonic()
+        if expired or gens != _current(key[0]):
+            del _entries[key]
+            counters["expired" if expired else "stale"] += 1
+            counters["misses"] += 1
+            return None
+        _entries.move_to_end(key)
+        counters["hits"] += 1
+    # callers may annotate results; hand out copies
+    return [dict(r) for r in results]
+
+
+def put(key: Key, gens: Tuple[int, ...], results: List[Dict]):
+    limit = int(settings.retrieval_cache_items)
+    if limit <= 0:
+        return
+    with _lock:
+        if gens != _current(key[0]):
+            return  # a KB changed while the search ran
+        _entries[key] = (time.monotonic() + float(settings.retrieval_cache_ttl), gens, [dict(r) for r in results])
+        _entries.move_to_end(key)
+        while len(_entries) > limit:
+            _entries.popitem(last=False)
+            counters["evicted"] += 1
+
+
+def invalidate(kb_id: Optional[int]):
+    """Drop cached results that include kb_id (all results when kb_id is None)."""
+    global _global_generation
+    with _lock:
+        counters["invalidations"] += 1
+        if kb_id is None:
+            # searches already running must not cache what they found either
+            _global_generation += 1
+            _entries.clear()
+            return
+        _generations[kb_id] = _generations.get(kb_id, 0) + 1
+        for key in [k for k in _entries if kb_id in k[0]]:
+            del _entries[key]
+
+
+def stats() -> Dict:
+    with _lock:
+        lookups = counters["hits"] + counters["misses"]
+        return {
+            **counters,
+            "items": len(_entries),
+            "max_items": int(settings.retrieval_cache_items),
+            "ttl_seconds": float(settings.retrieval_cache_ttl),
+            "hit_rate": round(counters["hits"] / lookups, 4) if lookups else 0.0,
+        }
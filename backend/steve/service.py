@@ -1,11 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import contextvars
+import functools
 import sqlite3
-from typing import List, Tuple, Optional, Dict
+from typing import Iterator, List, Tuple, Optional, Dict
 import json
 import numpy as np
 import re
 
-from .db import get_conn
+from .db import after_commit, get_conn, read_conn
 from .config import settings
+from . import doc_cache, fusion, metrics, retrieval_cache, vector_index
+from .quantization import int8_encode, int8_to_blob
+
+
+# semantic search runs here while the calling thread does the keyword search; numpy and
+# SQLite both release the GIL, so the two overlap
+_retrieval_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="retrieval")
 
 
 def create_kb(name: str) -> int:
@@ -15,109 +26,368 @@ def create_kb(name: str) -> int:
 
 
 def list_kb() -> List[Tuple[int, str]]:
-    with get_conn() as conn:
+    with read_conn() as conn:
         rows = conn.execute("SELECT id, name FROM knowledgebase ORDER BY created_at DESC").fetchall()
         return [(r["id"], r["name"]) for r in rows]
 
 
-def add_document(kb_id: int, source: str, title: str, type_: str, content: str, meta: Optional[dict] = None) -> int:
+def add_document(kb_id: int, source: str, title: str, type_: str, content: str, meta: Optional[dict] = None,
+                 source_key: Optional[str] = None, content_hash: Optional[str] = None) -> int:
     with get_conn() as conn:
         cur = conn.execute(
-            "INSERT INTO document(kb_id, source, title, type, content, meta) VALUES(?,?,?,?,?,?)",
-            (kb_id, source, title, type_, content, json.dumps(meta or {})),
+            "INSERT INTO document(kb_id, source, title, type, content, meta, source_key, content_hash) VALUES(?,?,?,?,?,?,?,?)",
+            (kb_id, source, title, type_, content, json.dumps(meta or {}), source_key or source, content_hash),
         )
         doc_id = cur.lastrowid
         # also insert into document-level FTS for quick lookup
         conn.execute("INSERT INTO doc_fts(content, document_id) VALUES(?,?)", (content, doc_id))
-        return doc_id
+        after_commit(lambda: retrieval_cache.invalidate(kb_id))
+    return doc_id
+
+
+def find_document(kb_id: int, source_key: str) -> Optional[Dict]:
+    """Latest document in a KB ingested from the same file path / URL."""
+    with read_conn() as conn:
+        r = conn.execute(
+            "SELECT id, content_hash FROM document WHERE kb_id=? AND source_key=? ORDER BY id DESC LIMIT 1",
+            (kb_id, source_key),
+        ).fetchone()
+        return {"id": r["id"], "content_hash": r["content_hash"]} if r else None
 
 
-def upsert_embeddings(document_id: int, chunks: List[str], vectors: List[List[float]]):
+def update_document(doc_id: int, title: str, type_: str, content: str, meta: Optional[dict] = None,
+                    content_hash: Optional[str] = None, index_fts: bool = True):
     with get_conn() as conn:
-        for idx, (text, vec) in enumerate(zip(chunks, vectors)):
-            arr = np.asarray(vec, dtype=np.float32)
-            dim = int(arr.shape[0]) if arr.ndim == 1 else 0
-            # Normalize once and store; cosine becomes dot product at query time
-            norm = float(np.linalg.norm(arr))
-            if norm > 0:
-                arr = arr / norm
-                is_norm = 1
-            else:
-                is_norm = 0
-            # UPSERT by document_id + chunk_index
-            conn.execute(
-                """
-                INSERT INTO embedding(document_id, chunk_index, vector, text, model, dim, is_normalized)
-                VALUES(?,?,?,?,?,?,?)
-                ON CONFLICT(document_id, chunk_index) DO UPDATE SET
-                    vector=excluded.vector,
-                    text=excluded.text,
-                    model=excluded.model,
-                    dim=excluded.dim,
-                    is_normalized=excluded.is_normalized
-                """,
-                (document_id, idx, arr.tobytes(), text, settings.embedding_model, dim, is_norm),
-            )
-            # Insert/update chunk-level FTS for hybrid alignment (delete-then-insert to emulate upsert)
-            conn.execute("DELETE FROM chunk_fts WHERE document_id=? AND chunk_index=?", (document_id, idx))
-            conn.execute(
-                "INSERT INTO chunk_fts(content, document_id, chunk_index) VALUES(?,?,?)",
-                (text, document_id, idx)
+        conn.execute(
+            "UPDATE document SET title=?, type=?, content=?, meta=?, content_hash=? WHERE id=?",
+            (title, type_, content, json.dumps(meta or {}), content_hash, doc_id),
+        )
+        conn.execute("DELETE FROM doc_fts WHERE document_id=?", (doc_id,))
+        # very large documents are searchable through chunk_fts only
+        if index_fts:
+            conn.execute("INSERT INTO doc_fts(content, document_id) VALUES(?,?)", (content, doc_id))
+        kb = conn.execute("SELECT kb_id FROM document WHERE id=?", (doc_id,)).fetchone()
+        after_commit(lambda: doc_cache.invalidate(doc_id))
+        if kb is not None:
+            after_commit(lambda: retrieval_cache.invalidate(kb["kb_id"]))
+
+
+def document_chunks(doc_id: int, embedded_only: bool = False) -> List[Tuple[int, str, bytes, Tuple[Optional[int], Optional[int]]]]:
+    """(chunk_index, text, stored unit vector bytes, (char_start, char_end)) for a document, in order.
+
+    ``embedded_only`` skips chunks whose embedding failed (stored as a zero, unnormalized vector).
+    """
+    with read_conn() as conn:
+        rows = conn.execute(
+            "SELECT chunk_index, text, vector, char_start, char_end FROM embedding WHERE document_id=?"
+            + (" AND is_normalized=1" if embedded_only else "") + " ORDER BY chunk_index",
+            (doc_id,),
+        ).fetchall()
+        return [(r["chunk_index"], r["text"], r["vector"], (r["char_start"], r["char_end"])) for r in rows]
+
+
+def iter_document_chunks(doc_id: int, embedded_only: bool = False) -> Iterator[Tuple[int, int, str, Tuple[Optional[int], Optional[int]]]]:
+    """(chunk_index, embedding id, text, (char_start, char_end)) for a document, streamed from a cursor."""
+    with read_conn() as conn:
+        cur = conn.execute("SELECT chunk_index, id, text, char_start, char_end FROM embedding WHERE document_id=?"
+                           + (" AND is_normalized=1" if embedded_only else ""), (doc_id,))
+        while True:
+            rows = cur.fetchmany(1000)
+            if not rows:
+                break
+            for r in rows:
+                yield r["chunk_index"], r["id"], r["text"], (r["char_start"], r["char_end"])
+
+
+def chunk_counts(doc_id: int) -> Tuple[int, int]:
+    """(chunks, chunks whose embedding failed) for a document."""
+    with read_conn() as conn:
+        r = conn.execute("SELECT COUNT(*), COALESCE(SUM(is_normalized=0), 0) FROM embedding WHERE document_id=?",
+                         (doc_id,)).fetchone()
+        return int(r[0]), int(r[1])
+
+
+def embedding_vectors(ids: List[int]) -> Dict[int, bytes]:
+    """Stored unit vector bytes by embedding id."""
+    out: Dict[int, bytes] = {}
+    with read_conn() as conn:
+        for start in range(0, len(ids), 900):
+            part = ids[start:start + 900]
+            qmarks = ",".join(["?"] * len(part))
+            for r in conn.execute(f"SELECT id, vector FROM embedding WHERE id IN ({qmarks})", part):
+                out[r["id"]] = r["vector"]
+    return out
+
+
+def truncate_chunks(doc_id: int, count: int) -> int:
+    """Drop chunks with chunk_index >= count (left over after a shorter re-ingest)."""
+    with get_conn() as conn:
+        rows = conn.execute(
+            "SELECT id, kb_id FROM embedding WHERE document_id=? AND chunk_index>=?", (doc_id, count)
+        ).fetchall()
+        if not rows:
+            return 0
+        conn.executemany("DELETE FROM chunk_fts WHERE rowid=?", [(r["id"],) for r in rows])
+        conn.execute("DELETE FROM embedding WHERE document_id=? AND chunk_index>=?", (doc_id, count))
+        kb_id = rows[0]["kb_id"]
+        # the resident index and caches change only once the rows are committed
+        after_commit(lambda: vector_index.remove(kb_id, [r["id"] for r in rows]))
+        after_commit(lambda: retrieval_cache.invalidate(kb_id))
+    return len(rows)
+
+
+_UPSERT_SQL = """
+INSERT INTO embedding(document_id, kb_id, chunk_index, vector, text, model, dim, is_normalized, codec, code, char_start, char_end)
+VALUES(?,?,?,?,?,?,?,?,?,?,?,?)
+ON CONFLICT(document_id, chunk_index) DO UPDATE SET
+    vector=excluded.vector,
+    text=excluded.text,
+    model=excluded.model,
+    dim=excluded.dim,
+    is_normalized=excluded.is_normalized,
+    codec=excluded.codec,
+    code=excluded.code,
+    char_start=excluded.char_start,
+    char_end=excluded.char_end
+"""
+
+
+def _normalized(vectors: List[List[float]]) -> List[Tuple[np.ndarray, int]]:
+    """(unit vector, is_normalized) per input; rows of the same length are normalized as one matrix."""
+    out: List[Optional[Tuple[np.ndarray, int]]] = [None] * len(vectors)
+    by_dim: Dict[int, List[int]] = {}
+    for i, vec in enumerate(vectors):
+        by_dim.setdefault(len(vec), []).append(i)
+    for dim, rows in by_dim.items():
+        mat = np.asarray([vectors[i] for i in rows], dtype=np.float32).reshape(len(rows), dim)
+        norms = np.linalg.norm(mat, axis=1) if dim else np.zeros(len(rows), dtype=np.float32)
+        nz = norms > 0
+        mat[nz] /= norms[nz, None]
+        for k, i in enumerate(rows):
+            out[i] = (mat[k], int(nz[k]))
+    return out
+
+
+def upsert_embeddings(document_id: int, chunks: List[str], vectors: List[List[float]],
+                      indices: Optional[List[int]] = None, spans: Optional[List[Tuple[int, int]]] = None):
+    """Write chunks at positions ``indices`` (default 0..n-1), replacing existing rows.
+
+    ``spans`` are the chunks' (char_start, char_end) in the document text, when known.
+
+    Rows are written with executemany in one transaction, committed every
+    ``upsert_commit_rows`` rows on very large documents. chunk_fts rows use the
+    embedding id as rowid, so replacing a chunk deletes its FTS row by key.
+    """
+    model = settings.embedding_model
+    if indices is None:
+        indices = list(range(len(chunks)))
+    # writer connection: the document row may belong to the caller's open transaction
+    with get_conn() as conn:
+        kb = conn.execute("SELECT kb_id FROM document WHERE id=?", (document_id,)).fetchone()
+    kb_id = kb["kb_id"] if kb else None
+    # Normalize once and store; cosine becomes dot product at query time
+    units = _normalized(vectors)
+    step = int(settings.upsert_commit_rows) or len(chunks) or 1
+    for start in range(0, len(chunks), step):
+        part = range(start, min(len(chunks), start + step))
+        rows = []
+        for k in part:
+            arr, is_norm = units[k]
+            dim = int(arr.shape[0])
+            span = spans[k] if spans else (None, None)
+            rows.append([document_id, kb_id, indices[k], arr.tobytes(), chunks[k], model, dim, is_norm, None, None, *span])
+        # Compact int8 codes let a quantized index load without the float32 BLOBs
+        if settings.vector_codec == "int8":
+            coded = [j for j, k in enumerate(part) if units[k][0].shape[0]]
+            for dim in {units[part[j]][0].shape[0] for j in coded}:
+                same = [j for j in coded if units[part[j]][0].shape[0] == dim]
+                codes, scales = int8_encode(np.stack([units[part[j]][0] for j in same]))
+                for c, j in enumerate(same):
+                    rows[j][8:10] = ["int8", int8_to_blob(codes[c], scales[c])]
+        with get_conn() as conn:
+            conn.executemany(_UPSERT_SQL, rows)
+            lo, hi = min(indices[k] for k in part), max(indices[k] for k in part)
+            want = {indices[k] for k in part}
+            id_by_chunk = {
+                r["chunk_index"]: r["id"]
+                for r in conn.execute(
+                    "SELECT id, chunk_index FROM embedding WHERE document_id=? AND chunk_index BETWEEN ? AND ?",
+                    (document_id, lo, hi),
+                )
+                if r["chunk_index"] in want
+            }
+            ids = [id_by_chunk[indices[k]] for k in part]
+            # chunk-level FTS for hybrid alignment, keyed by embedding id (delete-then-insert to emulate upsert)
+            conn.executemany("DELETE FROM chunk_fts WHERE rowid=?", [(eid,) for eid in ids])
+            conn.executemany(
+                "INSERT INTO chunk_fts(rowid, content, document_id, chunk_index, kb_id) VALUES(?,?,?,?,?)",
+                [(eid, chunks[k], document_id, indices[k], kb_id) for eid, k in zip(ids, part)],
             )
+            if kb_id is None:
+                continue
+            after_commit(functools.partial(retrieval_cache.invalidate, kb_id))
+            # Keep the resident vector index in step with the committed rows: applied when
+            # the outermost transaction (possibly the caller's) commits, dropped on rollback
+            written = [(eid, units[k][0]) for eid, k in zip(ids, part) if units[k][0].shape[0]]
+            if not written:
+                continue
+            dim = written[0][1].shape[0]
+            written = [(eid, arr) for eid, arr in written if arr.shape[0] == dim]
+            after_commit(functools.partial(
+                vector_index.upsert,
+                kb_id,
+                model,
+                [eid for eid, _ in written],
+                [document_id] * len(written),
+                np.stack([arr for _, arr in written]),
+            ))
 
 
 def kb_docs(kb_ids: List[int]) -> List[int]:
     if not kb_ids:
         return []
-    with get_conn() as conn:
+    with read_conn() as conn:
         qmarks = ",".join(["?"] * len(kb_ids))
         rows = conn.execute(f"SELECT id FROM document WHERE kb_id IN ({qmarks})", kb_ids).fetchall()
         return [r["id"] for r in rows]
 
 
-def semantic_search(kb_ids: List[int], query_vec: List[float], top_k: int = 5) -> List[Dict]:
-    # brute-force cosine search over selected docs' embeddings
-    doc_ids = kb_docs(kb_ids)
-    if not doc_ids:
-        return []
-    qmarks = ",".join(["?"] * len(doc_ids))
-    with get_conn() as conn:
-        rows = conn.execute(
-            f"SELECT e.document_id, e.chunk_index, e.vector, e.text, e.dim, d.source, d.title, d.kb_id, d.meta FROM embedding e JOIN document d ON e.document_id=d.id WHERE e.document_id IN ({qmarks})",
-            doc_ids,
-        ).fetchall()
-    q = np.asarray(query_vec, dtype=np.float32)
-    # Normalize query to match stored normalized vectors
-    qn = q / np.linalg.norm(q) if np.linalg.norm(q) != 0 else q
-    scored = []
-    for r in rows:
-        v = np.frombuffer(r["vector"], dtype=np.float32)
-        # Skip if dimensions don't match (can happen if model changed and old rows lack dim)
-        if v.shape[0] != q.shape[0]:
-            continue
-        # Stored vectors may be normalized; use dot if both are normalized, else fallback to cosine
-        if float(np.linalg.norm(v)) in (0.0, 1.0):
-            sim = float(np.dot(qn, v))
+def _sql_time(value) -> str:
+    # document.created_at is CURRENT_TIMESTAMP text, i.e. UTC "YYYY-MM-DD HH:MM:SS"
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _filter_sql(filters: Optional[Dict], alias: str = "d") -> Tuple[str, list]:
+    """(" AND ..." predicates on the document table, params) for search filters (see SearchFilters)."""
+    if not filters:
+        return "", []
+    preds, params = [], []
+    if filters.get("types"):
+        preds.append(f"{alias}.type IN ({','.join(['?'] * len(filters['types']))})")
+        params += list(filters["types"])
+    if filters.get("document_ids"):
+        preds.append(f"{alias}.id IN ({','.join(['?'] * len(filters['document_ids']))})")
+        params += [int(i) for i in filters["document_ids"]]
+    if filters.get("source_prefix"):
+        # a range rather than LIKE, so the (kb_id, source_key) index serves it
+        preds.append(f"{alias}.source_key >= ? AND {alias}.source_key < ?")
+        params += [filters["source_prefix"], filters["source_prefix"] + "\U0010ffff"]
+    if filters.get("created_after") is not None:
+        preds.append(f"{alias}.created_at >= ?")
+        params.append(_sql_time(filters["created_after"]))
+    if filters.get("created_before") is not None:
+        preds.append(f"{alias}.created_at < ?")
+        params.append(_sql_time(filters["created_before"]))
+    for key, value in (filters.get("meta") or {}).items():
+        values = value if isinstance(value, list) else [value]
+        preds.append(f"json_extract({alias}.meta, ?) IN ({','.join(['?'] * len(values))})")
+        params += ['$."' + str(key).replace('"', '\\"') + '"', *values]
+    return "".join(f" AND {p}" for p in preds), params
+
+
+def filter_documents(kb_ids: List[int], filters: Optional[Dict]) -> Optional[np.ndarray]:
+    """Ids of the KBs' documents that pass the filters; None when nothing is filtered."""
+    where, params = _filter_sql(filters)
+    if not where:
+        return None
+    if not kb_ids:
+        return np.zeros(0, dtype=np.int64)
+    qmarks = ",".join(["?"] * len(kb_ids))
+    with metrics.span("filter"), read_conn() as conn:
+        rows = conn.execute(f"SELECT d.id FROM document d WHERE d.kb_id IN ({qmarks}){where}", (*kb_ids, *params)).fetchall()
+    return np.array([r["id"] for r in rows], dtype=np.int64)
+
+
+def semantic_search(kb_ids: List[int], query_vec: List[float], top_k: int = 5, filters: Optional[Dict] = None) -> List[Dict]:
+    # score against the resident per-KB vector index, then fetch details for the hits only
+    return hydrate(_semantic_hits(kb_ids, [query_vec], top_k, filters)[0])
+
+
+def semantic_search_many(kb_ids: List[int], query_vecs: List[List[float]], top_k: int = 5,
+                         filters: Optional[Dict] = None) -> List[List[Dict]]:
+    """semantic_search for several query vectors: one scoring pass and one fetch for all of them."""
+    return hydrate_many(_semantic_hits(kb_ids, query_vecs, top_k, filters))
+
+
+# Retrieval runs in two phases. Scoring works on ids only: each hit is
+# {"id": embedding id, "document_id", "chunk_index", "score"}, enough to fuse on. Hydration
+# then adds chunk text and document fields for the results that survive to the response.
+
+def _semantic_hits(kb_ids: List[int], query_vecs: List[List[float]], top_k: int,
+                   filters: Optional[Dict] = None) -> List[List[Dict]]:
+    doc_ids = filter_documents(kb_ids, filters)
+    if doc_ids is not None and not doc_ids.size:
+        return [[] for _ in query_vecs]
+    with metrics.span("vector_score"):
+        if len(query_vecs) == 1:
+            hits = [vector_index.search(kb_ids, query_vecs[0], top_k, doc_ids)]
         else:
-            denom = (np.linalg.norm(q) * np.linalg.norm(v))
-            sim = float(np.dot(q, v) / denom) if denom != 0 else 0.0
-        meta = {}
-        try:
-            meta = json.loads(r["meta"]) if r["meta"] else {}
-        except Exception:
-            meta = {}
-        scored.append({
-            "document_id": r["document_id"],
-            "chunk_index": r["chunk_index"],
-            "text": r["text"],
-            "source": r["source"],
-            "title": r["title"],
-            "score": sim,
-            "kb_id": r["kb_id"],
-            "file_path": meta.get("file_path"),
-        })
-    scored.sort(key=lambda x: x["score"], reverse=True)
-    return scored[:top_k]
+            hits = vector_index.search_many(kb_ids, query_vecs, top_k, doc_ids)
+    # chunk positions for fusion; these columns precede the vector and text in each row
+    wanted = list({eid for per_query in hits for eid, _ in per_query})
+    where = {}
+    with metrics.span("candidates"), read_conn() as conn:
+        for start in range(0, len(wanted), 900):
+            part = wanted[start:start + 900]
+            qmarks = ",".join(["?"] * len(part))
+            for r in conn.execute(f"SELECT id, document_id, chunk_index FROM embedding WHERE id IN ({qmarks})", part):
+                where[r["id"]] = (r["document_id"], r["chunk_index"])
+    return [
+        [{"id": eid, "document_id": where[eid][0], "chunk_index": where[eid][1], "score": sim} for eid, sim in per_query if eid in where]
+        for per_query in hits
+    ]
+
+
+def hydrate(hits: List[Dict]) -> List[Dict]:
+    return hydrate_many([hits])[0]
+
+
+def hydrate_many(hit_lists: List[List[Dict]]) -> List[List[Dict]]:
+    """Full results (text, span, source, title, file_path) for scored hits, in one chunk fetch.
+
+    Hits that already carry their text (document-level keyword matches) are kept as they
+    are; hits whose chunk or document has been deleted since scoring are dropped.
+    """
+    wanted = list({h["id"] for hits in hit_lists for h in hits if "text" not in h})
+    chunks = {}
+    if wanted:
+        with metrics.span("hydrate"), read_conn() as conn:
+            for start in range(0, len(wanted), 900):
+                part = wanted[start:start + 900]
+                qmarks = ",".join(["?"] * len(part))
+                for r in conn.execute(f"SELECT id, text, char_start, char_end FROM embedding WHERE id IN ({qmarks})", part):
+                    chunks[r["id"]] = r
+        metrics.rows_scanned.inc(len(chunks), stage="hydrate")
+    docs = doc_cache.fields(h["document_id"] for hits in hit_lists for h in hits)
+    out = []
+    for hits in hit_lists:
+        results = []
+        for h in hits:
+            doc = docs.get(h["document_id"])
+            chunk = h if "text" in h else chunks.get(h["id"])
+            if doc is None or chunk is None:
+                continue
+            result = {
+                "document_id": h["document_id"],
+                "chunk_index": h["chunk_index"],
+                "char_start": chunk["char_start"],
+                "char_end": chunk["char_end"],
+                "text": chunk["text"],
+                "source": doc["source"],
+                "title": doc["title"],
+                "score": h["score"],
+                "kb_id": doc["kb_id"],
+                "file_path": doc["file_path"],
+            }
+            # per-retriever scores and ranks from fusion
+            result.update((k, v) for k, v in h.items() if k not in result and k != "id")
+            results.append(result)
+        out.append(results)
+    return out
 
 def _sanitize_fts_query(q: str) -> str:
     # Keep alphanumerics/underscore, space-separate tokens for FTS MATCH
@@ -125,74 +395,88 @@ def _sanitize_fts_query(q: str) -> str:
     return " ".join(toks)
 
 
-def keyword_search(kb_ids: List[int], query: str, top_k: int = 20) -> List[Dict]:
-    doc_ids = kb_docs(kb_ids)
-    if not doc_ids:
+def keyword_search(kb_ids: List[int], query: str, top_k: int = 20, filters: Optional[Dict] = None) -> List[Dict]:
+    return hydrate(_keyword_hits(kb_ids, query, top_k, filters))
+
+
+def _keyword_hits(kb_ids: List[int], query: str, top_k: int = 20, filters: Optional[Dict] = None) -> List[Dict]:
+    if not kb_ids:
         return []
-    qmarks = ",".join(["?"] * len(doc_ids))
     safe = _sanitize_fts_query(query)
     if not safe:
         return []
-    # Prefer chunk-level FTS if available for better hybrid alignment
+    # KB scoping and filters are predicates in the same statement; no per-document IN list
+    kbq = ",".join(["?"] * len(kb_ids))
+    where, params = _filter_sql(filters)
+    join = " JOIN document d ON d.id=f.document_id" if where else ""
+    # Prefer chunk-level FTS if available for better hybrid alignment; its rowid is the embedding id
     try:
-        with get_conn() as conn:
+        with metrics.span("fts"), read_conn() as conn:
             rows = conn.execute(
-                f"SELECT f.document_id, f.chunk_index, f.content, d.source, d.title, d.kb_id, d.meta, bm25(chunk_fts) AS rank FROM chunk_fts f JOIN document d ON d.id=f.document_id WHERE f.document_id IN ({qmarks}) AND chunk_fts MATCH ? ORDER BY rank LIMIT ?",
-                (*doc_ids, safe, top_k)
+                f"SELECT f.rowid AS id, f.document_id, f.chunk_index, bm25(chunk_fts) AS rank FROM chunk_fts f{join} WHERE chunk_fts MATCH ? AND f.kb_id IN ({kbq}){where} ORDER BY rank LIMIT ?",
+                (safe, *kb_ids, *params, top_k)
             ).fetchall()
     except sqlite3.OperationalError:
-        # Fallback to document-level FTS
+        # Fallback to document-level FTS; these hits carry the document text themselves
         try:
-            with get_conn() as conn:
+            with read_conn() as conn:
                 rows = conn.execute(
-                    f"SELECT f.document_id, 0 as chunk_index, f.content, d.source, d.title, d.kb_id, d.meta, bm25(doc_fts) AS rank FROM doc_fts f JOIN document d ON d.id=f.document_id WHERE f.document_id IN ({qmarks}) AND doc_fts MATCH ? ORDER BY rank LIMIT ?",
-                    (*doc_ids, safe, top_k)
+                    f"SELECT NULL AS id, f.document_id, 0 as chunk_index, f.content AS text, NULL AS char_start, NULL AS char_end, bm25(doc_fts) AS rank FROM doc_fts f JOIN document d ON d.id=f.document_id WHERE doc_fts MATCH ? AND d.kb_id IN ({kbq}){where} ORDER BY rank LIMIT ?",
+                    (safe, *kb_ids, *params, top_k)
                 ).fetchall()
         except sqlite3.OperationalError:
             rows = []
+    metrics.rows_scanned.inc(len(rows), stage="fts")
     out: List[Dict] = []
     for r in rows:
-        # lower bm25 is better; convert to score-ish
-        score = 1.0 / (1.0 + float(r["rank"]))
-        meta = {}
-        try:
-            meta = json.loads(r.get("meta")) if isinstance(r, dict) and r.get("meta") else json.loads(r["meta"]) if r["meta"] else {}
-        except Exception:
-            meta = {}
-        out.append({
-            "document_id": r["document_id"],
-            "chunk_index": r["chunk_index"],
-            "text": r["content"],
-            "source": r["source"],
-            "title": r["title"],
-            "score": score,
-            "kb_id": r["kb_id"],
-            "file_path": meta.get("file_path"),
-        })
+        hit = {k: r[k] for k in r.keys() if k != "rank"}
+        # bm25() is negative, lower is better; its negation is the BM25 relevance (>= 0)
+        hit["score"] = -float(r["rank"])
+        out.append(hit)
     return out
 
-def hybrid_search(kb_ids: List[int], query: str, query_vec: List[float], top_k: int = 10, alpha: float = 0.6) -> List[Dict]:
-    sem = semantic_search(kb_ids, query_vec, top_k=top_k)
-    kw = keyword_search(kb_ids, query, top_k=max(20, top_k * 2))
-    # index by (document_id, chunk_index) to blend per chunk
-    merged: Dict[Tuple[int, int], Dict] = {}
-    for item in sem:
-        merged[(item["document_id"], item["chunk_index"])] = {**item, "sem": item["score"], "kw": 0.0}
-    for item in kw:
-        key = (item["document_id"], item["chunk_index"])
-        if key in merged:
-            merged[key]["kw"] = max(merged[key].get("kw", 0.0), item["score"])  # take best kw score
-        else:
-            merged[key] = {**item, "sem": 0.0, "kw": item["score"]}
-    results = []
-    for v in merged.values():
-        v["score"] = alpha * v.get("sem", 0.0) + (1 - alpha) * v.get("kw", 0.0)
-        results.append(v)
-    results.sort(key=lambda x: x["score"], reverse=True)
-    return results[:top_k]
+def hybrid_search(kb_ids: List[int], query: str, query_vec: List[float], top_k: int = 10, alpha: float = 0.6,
+                  mode: Optional[str] = None, filters: Optional[Dict] = None) -> List[Dict]:
+    """Semantic and keyword candidates fused per chunk (see fusion.py); alpha weights semantic.
+
+    Both retrievers run at once, each fetching up to its candidate depth so good chunks
+    just outside one retriever's top_k can still surface. Only the fused top_k are hydrated.
+    """
+    sem_k = max(top_k, int(settings.semantic_candidates))
+    kw_k = max(top_k, int(settings.keyword_candidates))
+    sem_future = _retrieval_pool.submit(contextvars.copy_context().run, _semantic_hits, kb_ids, [query_vec], sem_k, filters)
+    kw = _keyword_hits(kb_ids, query, kw_k, filters)
+    sem = sem_future.result()[0]
+    weights = {"sem": alpha, "kw": 1 - alpha}
+    with metrics.span("fusion"):
+        results = fusion.fuse(mode or settings.fusion_mode, [("sem", sem), ("kw", kw)], weights, int(settings.rrf_k))
+    return hydrate(results[:top_k])
+
+
+def search_many(kb_ids: List[int], queries: List[str], query_vecs: List[List[float]], top_k: int = 10,
+                alpha: Optional[float] = 0.6, mode: Optional[str] = None, filters: Optional[Dict] = None) -> List[List[Dict]]:
+    """hybrid_search (semantic_search when alpha is None) for many queries at once.
+
+    The semantic side scores every query in one pass over the vectors; keyword searches
+    run side by side on the retrieval pool meanwhile.
+    """
+    if alpha is None:
+        return semantic_search_many(kb_ids, query_vecs, top_k, filters)
+    sem_k = max(top_k, int(settings.semantic_candidates))
+    kw_k = max(top_k, int(settings.keyword_candidates))
+    kw_futures = [_retrieval_pool.submit(contextvars.copy_context().run, _keyword_hits, kb_ids, q, kw_k, filters) for q in queries]
+    sem = _semantic_hits(kb_ids, query_vecs, sem_k, filters)
+    kw = [future.result() for future in kw_futures]
+    weights = {"sem": alpha, "kw": 1 - alpha}
+    fused = []
+    with metrics.span("fusion"):
+        for sem_hits, kw_hits in zip(sem, kw):
+            fused.append(fusion.fuse(mode or settings.fusion_mode, [("sem", sem_hits), ("kw", kw_hits)], weights, int(settings.rrf_k))[:top_k])
+    return hydrate_many(fused)
+
 
 def list_documents(kb_id: int) -> List[Dict]:
-    with get_conn() as conn:
+    with read_conn() as conn:
         rows = conn.execute(
             "SELECT id, source, title, type, created_at FROM document WHERE kb_id=? ORDER BY created_at DESC",
             (kb_id,)
@@ -201,25 +485,29 @@ def list_documents(kb_id: int) -> List[Dict]:
 
 def delete_document(doc_id: int):
     with get_conn() as conn:
+        kb = conn.execute("SELECT kb_id FROM document WHERE id=?", (doc_id,)).fetchone()
+        conn.execute("DELETE FROM chunk_fts WHERE rowid IN (SELECT id FROM embedding WHERE document_id=?)", (doc_id,))
         conn.execute("DELETE FROM embedding WHERE document_id=?", (doc_id,))
         conn.execute("DELETE FROM doc_fts WHERE document_id=?", (doc_id,))
-        conn.execute("DELETE FROM chunk_fts WHERE document_id=?", (doc_id,))
         conn.execute("DELETE FROM document WHERE id=?", (doc_id,))
+        after_commit(lambda: doc_cache.invalidate(doc_id))
+        if kb is not None:
+            after_commit(lambda: vector_index.remove_document(kb["kb_id"], doc_id))
+            after_commit(lambda: retrieval_cache.invalidate(kb["kb_id"]))
 
 def delete_kb(kb_id: int):
     with get_conn() as conn:
-        rows = conn.execute("SELECT id FROM document WHERE kb_id=?", (kb_id,)).fetchall()
-        doc_ids = [r["id"] for r in rows]
-        if doc_ids:
-            qmarks = ",".join(["?"] * len(doc_ids))
-            conn.execute(f"DELETE FROM embedding WHERE document_id IN ({qmarks})", doc_ids)
-            conn.execute(f"DELETE FROM doc_fts WHERE document_id IN ({qmarks})", doc_ids)
-            conn.execute(f"DELETE FROM chunk_fts WHERE document_id IN ({qmarks})", doc_ids)
-            conn.execute(f"DELETE FROM document WHERE id IN ({qmarks})", doc_ids)
+        conn.execute("DELETE FROM embedding WHERE kb_id=?", (kb_id,))
+        conn.execute("DELETE FROM doc_fts WHERE document_id IN (SELECT id FROM document WHERE kb_id=?)", (kb_id,))
+        conn.execute("DELETE FROM chunk_fts WHERE kb_id=?", (kb_id,))
+        conn.execute("DELETE FROM document WHERE kb_id=?", (kb_id,))
         conn.execute("DELETE FROM knowledgebase WHERE id=?", (kb_id,))
+        after_commit(lambda: vector_index.drop_kb(kb_id))
+        after_commit(doc_cache.invalidate)
+        after_commit(lambda: retrieval_cache.invalidate(kb_id))
 
 def get_document(doc_id: int) -> Optional[Dict]:
-    with get_conn() as conn:
+    with read_conn() as conn:
         r = conn.execute(
             "SELECT id, kb_id, source, title, type, content, meta FROM document WHERE id=?",
             (doc_id,)
@@ -245,7 +533,7 @@ def get_documents_by_ids(doc_ids: List[int]) -> Dict[int, Dict]:
         return {}
     qmarks = ",".join(["?"] * len(doc_ids))
     out: Dict[int, Dict] = {}
-    with get_conn() as conn:
+    with read_conn() as conn:
         rows = conn.execute(
             f"SELECT id, kb_id, source, title, type, content, meta FROM document WHERE id IN ({qmarks})",
             doc_ids
@@ -0,0 +1,676 @@
+from typing import Dict, List, Optional, Tuple
+import threading
+import numpy as np
+
+from .db import read_conn
+from .config import settings
+from . import metrics, vector_store
+from .vector_store import VectorStore, _normalize_rows
+from .quantization import ProductQuantizer, int8_decode, int8_encode, int8_from_blob, int8_scores, pq_subvectors
+
+
+def _kmeans(data: np.ndarray, k: int, iters: int = 10, seed: int = 0) -> np.ndarray:
+    # Spherical k-means on unit vectors; good enough to partition for IVF probing
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(data.shape[0], size=k, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(data @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, data)
+        empty = np.bincount(assign, minlength=k) == 0
+        # re-seed empty clusters from random points
+        if empty.any():
+            sums[empty] = data[rng.choice(data.shape[0], size=int(empty.sum()), replace=False)]
+        centroids = _normalize_rows(sums)
+    return centroids
+
+
+class VectorIndex:
+    """Resident vectors for one KB and embedding model.
+
+    Rows live in a contiguous float32 matrix of unit vectors with parallel arrays of
+    embedding ids and document ids, so a query is one matrix-vector product. With
+    ``settings.vector_index_mode == "ivf"`` rows are also partitioned into clusters and
+    only the ``ivf_nprobe`` closest clusters are scored (more probes = better recall).
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self._n = 0
+        self._vecs = np.zeros((0, dim), dtype=np.float32)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._docs = np.zeros(0, dtype=np.int64)
+        self._pos: Dict[int, int] = {}
+        self._lock = threading.RLock()
+        # IVF state (None until trained)
+        self._centroids: Optional[np.ndarray] = None
+        self._assign = np.zeros(0, dtype=np.int32)
+        self._trained_rows = 0
+
+    # per-row arrays kept aligned by _reserve/_remove_rows
+    _columns: Tuple[str, ...] = ("_vecs", "_ids", "_docs", "_assign")
+
+    def __len__(self) -> int:
+        return self._n
+
+    def _reserve(self, extra: int):
+        need = self._n + extra
+        cap = self._ids.shape[0]
+        if need <= cap:
+            return
+        new_cap = max(need, cap * 2, 1024)
+        for name in self._columns:
+            old = getattr(self, name)
+            arr = np.zeros((new_cap,) + old.shape[1:], dtype=old.dtype)
+            arr[: self._n] = old[: self._n]
+            setattr(self, name, arr)
+
+    def _write_rows(self, rows: np.ndarray, vectors: np.ndarray):
+        self._vecs[rows] = vectors
+
+    def _rows_f32(self, sel) -> np.ndarray:
+        return self._vecs[sel].astype(np.float32, copy=False)
+
+    def add(self, ids: List[int], doc_ids: List[int], vectors: np.ndarray):
+        """Insert or replace rows keyed by embedding id."""
+        if not len(ids):
+            return
+        vectors = _normalize_rows(np.array(vectors, dtype=np.float32, copy=True).reshape(len(ids), self.dim))
+        with self._lock:
+            rows = self._place(ids, doc_ids)
+            self._write_rows(rows, vectors)
+            if self._centroids is not None:
+                self._assign[rows] = np.argmax(vectors @ self._centroids.T, axis=1)
+            self._maybe_train()
+
+    def _place(self, ids: List[int], doc_ids: List[int]) -> np.ndarray:
+        # row positions for ids: existing rows are reused, new ones appended
+        self._reserve(len(ids))
+        rows = np.empty(len(ids), dtype=np.int64)
+        for i, eid in enumerate(ids):
+            pos = self._pos.get(int(eid))
+            if pos is None:
+                pos = self._n
+                self._pos[int(eid)] = pos
+                self._n += 1
+            rows[i] = pos
+        self._ids[rows] = ids
+        self._docs[rows] = doc_ids
+        return rows
+
+    def _remove_rows(self, rows: np.ndarray):
+        # Swap-remove: fill holes with surviving rows from the tail to stay contiguous
+        n = self._n
+        rm = np.unique(rows)
+        if not rm.size:
+            return
+        new_n = n - rm.size
+        tail = np.arange(new_n, n)
+        movers = tail[~np.isin(tail, rm)]
+        holes = rm[rm < new_n]
+        for eid in self._ids[rm].tolist():
+            self._pos.pop(int(eid), None)
+        if holes.size:
+            for name in self._columns:
+                arr = getattr(self, name)
+                arr[holes] = arr[movers]
+            for pos, eid in zip(holes.tolist(), self._ids[holes].tolist()):
+                self._pos[int(eid)] = pos
+        self._n = new_n
+
+    def remove(self, ids: List[int]):
+        with self._lock:
+            rows = [self._pos[int(i)] for i in ids if int(i) in self._pos]
+            self._remove_rows(np.asarray(rows, dtype=np.int64))
+
+    def remove_documents(self, doc_ids: List[int]):
+        with self._lock:
+            rows = np.flatnonzero(np.isin(self._docs[: self._n], np.asarray(doc_ids, dtype=np.int64)))
+            self._remove_rows(rows)
+
+    def _maybe_train(self):
+        if settings.vector_index_mode != "ivf" or len(self) < int(settings.ivf_min_rows):
+            return
+        # (re)train on first crossing of the threshold and whenever the index doubles
+        if self._centroids is not None and len(self) < 2 * self._trained_rows:
+            return
+        live = self._live_rows()
+        nlist = int(settings.ivf_nlist) or max(1, int(np.sqrt(live.size)))
+        nlist = min(nlist, live.size)
+        sample_size = min(live.size, nlist * 64)
+        if sample_size < live.size:
+            live = np.sort(np.random.default_rng(0).choice(live, size=sample_size, replace=False))
+        self._centroids = _kmeans(self._rows_f32(live).astype(np.float32), nlist)
+        block = 65536
+        for start in range(0, self._n, block):
+            part = self._rows_f32(slice(start, start + block))
+            self._assign[start:start + block] = np.argmax(part @ self._centroids.T, axis=1)
+        self._trained_rows = len(self)
+
+    def _live_rows(self) -> np.ndarray:
+        return np.arange(self._n)
+
+    def _scores(self, query: np.ndarray, rows: Optional[np.ndarray]) -> np.ndarray:
+        if rows is None:
+            return self._vecs[: self._n] @ query
+        return self._vecs[rows] @ query
+
+    def _filter_rows(self, doc_ids: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        # rows of the allowed documents (None = all rows), found with a mask over the doc id column
+        if doc_ids is None:
+            return None
+        return np.flatnonzero(np.isin(self._docs[: self._n], doc_ids))
+
+    def search(self, query: np.ndarray, top_k: int, nprobe: Optional[int] = None,
+               doc_ids: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (embedding_ids, scores) of the best ``top_k`` rows, best first.
+
+        With ``doc_ids`` only rows of those documents are scored.
+        """
+        with self._lock:
+            n = self._n
+            if n == 0 or top_k <= 0:
+                return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+            rows = self._filter_rows(doc_ids)
+            if rows is not None and not rows.size:
+                return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+            if self._centroids is not None and settings.vector_index_mode == "ivf":
+                nlist = self._centroids.shape[0]
+                probes = min(nlist, max(1, int(nprobe or settings.ivf_nprobe)))
+                # a filter that leaves fewer rows than the probed clusters hold is scored exactly
+                if probes < nlist and (rows is None or rows.size * nlist > n * probes):
+                    csc = self._centroids @ query
+                    probe = np.argpartition(-csc, probes - 1)[:probes]
+                    mask = np.zeros(nlist, dtype=bool)
+                    mask[probe] = True
+                    rows = np.flatnonzero(mask[self._assign[:n]]) if rows is None else rows[mask[self._assign[rows]]]
+            scores = self._scores(query, rows)
+            metrics.rows_scanned.inc(int(scores.shape[0]), stage="vector")
+            ids = self._ids[:n] if rows is None else self._ids[rows]
+            k = min(top_k, scores.shape[0])
+            if k == 0:
+                return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            # deleted rows of a mapped index score -inf
+            top = top[np.isfinite(scores[top])]
+            return np.array(ids[top], dtype=np.int64), scores[top]
+
+    def _block_scores(self, sel, queries: np.ndarray) -> np.ndarray:
+        # (queries, rows) scores for a block of rows (a slice or row numbers); each query's scores stay
+        # contiguous, which keeps the per-query top-k selection cheap
+        return queries @ self._vecs[sel].T
+
+    def search_many(self, queries: np.ndarray, top_k: int, nprobe: Optional[int] = None,
+                    doc_ids: Optional[np.ndarray] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """search() for each row of ``queries``, scoring all of them in one matrix product per block.
+
+        With IVF probing each query visits different clusters, so those fall back to one
+        search() per query.
+        """
+        with self._lock:
+            n = self._n
+            probing = (self._centroids is not None and settings.vector_index_mode == "ivf"
+                       and min(self._centroids.shape[0], max(1, int(nprobe or settings.ivf_nprobe))) < self._centroids.shape[0])
+            if n == 0 or top_k <= 0 or len(queries) <= 1 or probing:
+                return [self.search(q, top_k, nprobe, doc_ids) for q in queries]
+            allowed = self._filter_rows(doc_ids)
+            total = n if allowed is None else allowed.size
+            if not total:
+                return [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)) for _ in queries]
+            cand_rows, cand_scores = [], []
+            block = 16384
+            for start in range(0, total, block):
+                sel = slice(start, min(n, start + block)) if allowed is None else allowed[start:start + block]
+                scores = self._block_scores(sel, queries)
+                k = min(top_k, scores.shape[1])
+                # best k rows of this block for every query: (queries, k)
+                top = np.argpartition(scores, scores.shape[1] - k, axis=1)[:, -k:]
+                cand_rows.append(top + start if allowed is None else sel[top])
+                cand_scores.append(np.take_along_axis(scores, top, axis=1))
+            metrics.rows_scanned.inc(total * len(queries), stage="vector")
+            rows, scores = np.concatenate(cand_rows, axis=1), np.concatenate(cand_scores, axis=1)
+            out = []
+            for j in range(len(queries)):
+                order = np.argsort(-scores[j], kind="stable")[:top_k]
+                order = order[np.isfinite(scores[j, order])]
+                out.append((np.array(self._ids[rows[j, order]], dtype=np.int64), scores[j, order]))
+            return out
+
+
+class MappedVectorIndex(VectorIndex):
+    """VectorIndex over a memory-mapped sidecar file instead of a resident matrix.
+
+    Rows are never moved: upserts append to the store and tombstone the previous row,
+    deletes only tombstone. Scoring reads the mapped rows in blocks, so a cold start
+    opens the file without copying vectors into Python memory.
+    """
+
+    def __init__(self, store: VectorStore):
+        super().__init__(store.dim)
+        self.store = store
+        self._dead = np.zeros(0, dtype=bool)
+        self._dead_count = 0
+        self._remap()
+        ids = np.asarray(self._ids)
+        for pos in np.flatnonzero(~self._dead).tolist():
+            self._pos[int(ids[pos])] = pos
+
+    def __len__(self) -> int:
+        return self._n - self._dead_count
+
+    def _remap(self):
+        vecs, ids, docs, tomb = self.store.arrays()
+        old_n = self._n
+        self._vecs, self._ids, self._docs = vecs, ids, docs
+        self._n = len(ids)
+        dead = np.zeros(self._n, dtype=bool)
+        dead[:old_n] = self._dead[:old_n]
+        dead[old_n:] = np.asarray(tomb[old_n:]) != 0
+        self._dead = dead
+        self._dead_count = int(dead.sum())
+        assign = np.zeros(self._n, dtype=np.int32)
+        assign[:old_n] = self._assign[:old_n]
+        self._assign = assign
+
+    def add(self, ids: List[int], doc_ids: List[int], vectors: np.ndarray):
+        if not len(ids):
+            return
+        vectors = _normalize_rows(np.array(vectors, dtype=np.float32, copy=True).reshape(len(ids), self.dim))
+        with self._lock:
+            # rows already stored with identical values (e.g. just rebuilt from SQLite) are kept as-is
+            old = np.asarray([self._pos.get(int(i), -1) for i in ids], dtype=np.int64)
+            known = old >= 0
+            if known.any():
+                same = np.all(self._vecs[old[known]] == vectors[known].astype(self.store.dtype), axis=1)
+                unchanged = np.zeros(len(ids), dtype=bool)
+                unchanged[np.flatnonzero(known)[same]] = True
+                if unchanged.all():
+                    return
+                self._remove_rows(old[known & ~unchanged])
+                keep = np.flatnonzero(~unchanged)
+                ids = [ids[i] for i in keep]
+                doc_ids = [doc_ids[i] for i in keep]
+                vectors = vectors[keep]
+            start = self._n
+            self.store.append(ids, doc_ids, vectors)
+            self._remap()
+            for offset, eid in enumerate(ids):
+                self._pos[int(eid)] = start + offset
+            if self._centroids is not None:
+                self._assign[start:] = np.argmax(vectors @ self._centroids.T, axis=1)
+            self._maybe_train()
+
+    def _remove_rows(self, rows: np.ndarray):
+        rows = np.unique(rows)
+        rows = rows[~self._dead[rows]]
+        if not rows.size:
+            return
+        self.store.tombstone(rows)
+        self._dead[rows] = True
+        self._dead_count += int(rows.size)
+        for eid in np.asarray(self._ids[rows]).tolist():
+            self._pos.pop(int(eid), None)
+
+    def _live_rows(self) -> np.ndarray:
+        return np.flatnonzero(~self._dead[: self._n])
+
+    def _scores(self, query: np.ndarray, rows: Optional[np.ndarray]) -> np.ndarray:
+        if rows is None:
+            rows_n = self._n
+            scores = np.empty(rows_n, dtype=np.float32)
+            block = 65536
+            for start in range(0, rows_n, block):
+                part = self._vecs[start:start + block].astype(np.float32, copy=False)
+                scores[start:start + block] = part @ query
+            scores[self._dead[:rows_n]] = -np.inf
+            return scores
+        scores = self._vecs[rows].astype(np.float32, copy=False) @ query
+        scores[self._dead[rows]] = -np.inf
+        return scores
+
+    def _block_scores(self, sel, queries: np.ndarray) -> np.ndarray:
+        scores = queries @ self._vecs[sel].astype(np.float32, copy=False).T
+        scores[:, self._dead[sel]] = -np.inf
+        return scores
+
+
+def _fetch_vectors(ids: List[int], dim: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Full-precision unit vectors for embedding ids from SQLite, plus a found mask."""
+    out = np.zeros((len(ids), dim), dtype=np.float32)
+    found = np.zeros(len(ids), dtype=bool)
+    where = {int(eid): i for i, eid in enumerate(ids)}
+    with read_conn() as conn:
+        for start in range(0, len(ids), 900):
+            part = ids[start:start + 900]
+            qmarks = ",".join(["?"] * len(part))
+            for r in conn.execute(f"SELECT id, vector FROM embedding WHERE id IN ({qmarks})", [int(i) for i in part]):
+                if len(r["vector"]) == dim * 4:
+                    i = where[r["id"]]
+                    out[i] = np.frombuffer(r["vector"], dtype=np.float32)
+                    found[i] = True
+    return _normalize_rows(out), found
+
+
+class QuantizedVectorIndex(VectorIndex):
+    """VectorIndex that keeps only int8 or product-quantized codes resident.
+
+    Codes select ``quant_rerank_factor * top_k`` candidates, which are then re-scored
+    with their full-precision vectors read back from the embedding table.
+    """
+
+    def __init__(self, dim: int, codec: str):
+        super().__init__(dim)
+        self.codec = codec
+        self._vecs = None
+        self._pq: Optional[ProductQuantizer] = None
+        self._pq_rows = 0
+        if codec == "pq":
+            self._codes = np.zeros((0, pq_subvectors(dim, int(settings.pq_subvectors))), dtype=np.uint8)
+            self._columns = ("_codes", "_ids", "_docs", "_assign")
+        else:
+            self._codes = np.zeros((0, dim), dtype=np.int8)
+            self._scales = np.zeros(0, dtype=np.float32)
+            self._columns = ("_codes", "_scales", "_ids", "_docs", "_assign")
+
+    def _write_rows(self, rows: np.ndarray, vectors: np.ndarray):
+        if self.codec == "pq":
+            if self._pq is None:
+                self._pq = ProductQuantizer(self.dim, self._codes.shape[1]).train(vectors)
+                self._pq_rows = len(vectors)
+            self._codes[rows] = self._pq.encode(vectors)
+        else:
+            self._codes[rows], self._scales[rows] = int8_encode(vectors)
+
+    def add_int8(self, ids: List[int], doc_ids: List[int], codes: np.ndarray, scales: np.ndarray):
+        """Insert rows from int8 codes already stored in embedding.code."""
+        if not len(ids):
+            return
+        with self._lock:
+            rows = self._place(ids, doc_ids)
+            self._codes[rows] = codes
+            self._scales[rows] = scales
+            if self._centroids is not None:
+                self._assign[rows] = np.argmax(int8_decode(codes, scales) @ self._centroids.T, axis=1)
+            self._maybe_train()
+
+    def _rows_f32(self, sel) -> np.ndarray:
+        if self.codec == "pq":
+            return self._pq.decode(self._codes[sel])
+        return int8_decode(self._codes[sel], self._scales[sel])
+
+    def _maybe_train(self):
+        if self.codec == "pq" and self._pq is not None and len(self) >= max(2 * self._pq_rows, 512):
+            # codebooks trained on a small index fit poorly once it grows; retrain from SQLite
+            n = self._n
+            ids = self._ids[:n].tolist()
+            sample = np.random.default_rng(0).choice(n, size=min(n, 256 * 16), replace=False)
+            vecs, found = _fetch_vectors([ids[i] for i in sample], self.dim)
+            self._pq = ProductQuantizer(self.dim, self._codes.shape[1]).train(vecs[found])
+            self._pq_rows = n
+            for start in range(0, n, 8192):
+                vecs, _ = _fetch_vectors(ids[start:start + 8192], self.dim)
+                self._codes[start:start + len(vecs)] = self._pq.encode(vecs)
+        super()._maybe_train()
+
+    def _scores(self, query: np.ndarray, rows: Optional[np.ndarray]) -> np.ndarray:
+        sel = slice(0, self._n) if rows is None else rows
+        if self.codec == "pq":
+            return self._pq.scores(self._codes[sel], query)
+        return int8_scores(self._codes[sel], self._scales[sel], query)
+
+    def _block_scores(self, sel, queries: np.ndarray) -> np.ndarray:
+        if self.codec == "pq":
+            return np.stack([self._pq.scores(self._codes[sel], q) for q in queries])
+        return (queries @ self._codes[sel].astype(np.float32).T) * self._scales[sel]
+
+    def search(self, query: np.ndarray, top_k: int, nprobe: Optional[int] = None,
+               doc_ids: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        pool = max(top_k, top_k * int(settings.quant_rerank_factor))
+        ids, _ = super().search(query, pool, nprobe, doc_ids)
+        if not ids.size:
+            return ids, np.zeros(0, dtype=np.float32)
+        vecs, found = _fetch_vectors(ids.tolist(), self.dim)
+        ids, exact = ids[found], vecs[found] @ query
+        order = np.argsort(-exact)[:top_k]
+        return ids[order], exact[order]
+
+    def search_many(self, queries: np.ndarray, top_k: int, nprobe: Optional[int] = None,
+                    doc_ids: Optional[np.ndarray] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        pool = max(top_k, top_k * int(settings.quant_rerank_factor))
+        found = super().search_many(queries, pool, nprobe, doc_ids)
+        # one read of the full-precision vectors for every query's candidates
+        union = np.unique(np.concatenate([ids for ids, _ in found])) if found else np.zeros(0, dtype=np.int64)
+        if not union.size:
+            return [(ids, np.zeros(0, dtype=np.float32)) for ids, _ in found]
+        vecs, ok = _fetch_vectors(union.tolist(), self.dim)
+        out = []
+        for (ids, _), q in zip(found, queries):
+            pos = np.searchsorted(union, ids)
+            keep = ok[pos]
+            ids, exact = ids[keep], vecs[pos[keep]] @ q
+            order = np.argsort(-exact)[:top_k]
+            out.append((ids[order], exact[order]))
+        return out
+
+
+# kb_id -> {model -> VectorIndex}; a KB is loaded from SQLite on first use
+_indexes: Dict[int, Dict[str, VectorIndex]] = {}
+_registry_lock = threading.Lock()
+# per-KB locks held while that KB loads (and by writes to it), so a cold KB does not
+# block searches of the others; always taken before _registry_lock
+_kb_locks: Dict[int, threading.Lock] = {}
+
+
+def _kb_lock(kb_id: int) -> threading.Lock:
+    with _registry_lock:
+        return _kb_locks.setdefault(kb_id, threading.Lock())
+
+
+def _load_mapped(kb_id: int) -> Dict[str, VectorIndex]:
+    stores = vector_store.kb_stores(kb_id)
+    if stores:
+        # rows a store would hold, per model and byte length; failed (empty) embeddings
+        # and stragglers of another dimension are never written to a sidecar
+        with read_conn() as conn:
+            counts: Dict[str, Dict[int, int]] = {}
+            for r in conn.execute(
+                "SELECT COALESCE(e.model, '') AS model, length(e.vector) AS n, COUNT(*) AS c FROM embedding e "
+                "WHERE e.kb_id=? AND length(e.vector) > 0 GROUP BY 1, 2",
+                (kb_id,),
+            ):
+                counts.setdefault(r["model"], {})[r["n"]] = r["c"]
+        out = {model: MappedVectorIndex(store) for model, store in stores.items()}
+        if set(counts) <= set(out) and all(
+            len(index) == counts.get(model, {}).get(index.dim * 4, 0) for model, index in out.items()
+        ):
+            return out
+        # sidecar drifted from the embedding table (e.g. written while the store was off)
+        out.clear()
+    return {model: MappedVectorIndex(store) for model, store in vector_store.rebuild_kb(kb_id).items()}
+
+
+def _new_index(kb_id: int, model: str, dim: int) -> VectorIndex:
+    if settings.vector_codec != "none":
+        return QuantizedVectorIndex(dim, settings.vector_codec)
+    if settings.vector_store != "off":
+        return MappedVectorIndex(VectorStore.create(kb_id, model, dim))
+    return VectorIndex(dim)
+
+
+def _load_kb(kb_id: int) -> Dict[str, VectorIndex]:
+    if settings.vector_codec == "none" and settings.vector_store != "off":
+        return _load_mapped(kb_id)
+    # int8 rows are read from their stored codes; everything else from the float32 BLOB
+    use_codes = settings.vector_codec == "int8"
+    groups: Dict[str, Tuple[List[int], List[int], List[bytes], List[bool]]] = {}
+    with read_conn() as conn:
+        cur = conn.execute(
+            "SELECT e.id, e.document_id, e.model, e.codec, e.code, CASE WHEN e.codec='int8' AND ? THEN NULL ELSE e.vector END AS vector FROM embedding e WHERE e.kb_id=?",
+            (int(use_codes), kb_id),
+        )
+        for r in cur:
+            ids, docs, blobs, coded = groups.setdefault(r["model"] or "", ([], [], [], []))
+            ids.append(r["id"])
+            docs.append(r["document_id"])
+            is_code = r["vector"] is None
+            blobs.append(r["code"] if is_code else r["vector"])
+            coded.append(is_code)
+    out: Dict[str, VectorIndex] = {}
+    for model, (ids, docs, blobs, coded) in groups.items():
+        # failed embeddings are stored empty; the first non-empty row sets the dimension
+        dims = ((len(b) - 4) if c else len(b) // 4 for b, c in zip(blobs, coded))
+        dim = next((d for d in dims if d > 0), 0)
+        if dim <= 0:
+            continue
+        index = _new_index(kb_id, model, dim)
+        # a model should only ever produce one dimension; drop stragglers
+        keep = [i for i, b in enumerate(blobs) if not coded[i] and len(b) == dim * 4]
+        if keep:
+            mat = np.frombuffer(b"".join(blobs[i] for i in keep), dtype=np.float32).reshape(len(keep), dim)
+            index.add([ids[i] for i in keep], [docs[i] for i in keep], mat)
+        keep = [i for i, b in enumerate(blobs) if coded[i] and len(b) == dim + 4]
+        if keep:
+            decoded = [int8_from_blob(blobs[i]) for i in keep]
+            index.add_int8(
+                [ids[i] for i in keep],
+                [docs[i] for i in keep],
+                np.stack([c for c, _ in decoded]),
+                np.asarray([sc for _, sc in decoded], dtype=np.float32),
+            )
+        out[model] = index
+    return out
+
+
+def kb_indexes(kb_id: int) -> Dict[str, VectorIndex]:
+    with _registry_lock:
+        loaded = _indexes.get(kb_id)
+    if loaded is not None:
+        return loaded
+    with _kb_lock(kb_id):
+        with _registry_lock:
+            loaded = _indexes.get(kb_id)
+        if loaded is None:
+            loaded = _load_kb(kb_id)
+            with _registry_lock:
+                _indexes[kb_id] = loaded
+        return loaded
+
+
+def search(kb_ids: List[int], query_vec: List[float], top_k: int, doc_ids: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+    """Top-k (embedding_id, cosine score) across the given KBs for vectors matching the query dim.
+
+    ``doc_ids`` (from service.filter_documents) restricts scoring to those documents' rows.
+    """
+    q = np.asarray(query_vec, dtype=np.float32)
+    if q.ndim != 1 or q.shape[0] == 0:
+        return []
+    norm = float(np.linalg.norm(q))
+    if norm > 0:
+        q = q / norm
+    ids_parts, score_parts = [], []
+    for kb_id in kb_ids:
+        for index in kb_indexes(kb_id).values():
+            # Skip if dimensions don't match (model changed since these rows were embedded)
+            if index.dim != q.shape[0]:
+                continue
+            ids, scores = index.search(q, top_k, doc_ids=doc_ids)
+            ids_parts.append(ids)
+            score_parts.append(scores)
+    if not ids_parts:
+        return []
+    ids = np.concatenate(ids_parts)
+    scores = np.concatenate(score_parts)
+    order = np.argsort(-scores, kind="stable")[:top_k]
+    return [(int(ids[i]), float(scores[i])) for i in order]
+
+
+def search_many(kb_ids: List[int], query_vecs: List[List[float]], top_k: int,
+                doc_ids: Optional[np.ndarray] = None) -> List[List[Tuple[int, float]]]:
+    """search() for several query vectors of one dimension, each index scoring them together."""
+    if not query_vecs:
+        return []
+    try:
+        q = np.asarray(query_vecs, dtype=np.float32)
+    except ValueError:
+        q = None
+    if q is None or q.ndim != 2 or q.shape[1] == 0:
+        return [search(kb_ids, v, top_k, doc_ids) for v in query_vecs]
+    norms = np.linalg.norm(q, axis=1, keepdims=True)
+    q = q / np.where(norms > 0, norms, 1)
+    parts: List[Tuple[List[np.ndarray], List[np.ndarray]]] = [([], []) for _ in range(q.shape[0])]
+    for kb_id in kb_ids:
+        for index in kb_indexes(kb_id).values():
+            if index.dim != q.shape[1]:
+                continue
+            for (ids_parts, score_parts), (ids, scores) in zip(parts, index.search_many(q, top_k, doc_ids=doc_ids)):
+                ids_parts.append(ids)
+                score_parts.append(scores)
+    out = []
+    for ids_parts, score_parts in parts:
+        if not ids_parts:
+            out.append([])
+            continue
+        ids = np.concatenate(ids_parts)
+        scores = np.concatenate(score_parts)
+        order = np.argsort(-scores, kind="stable")[:top_k]
+        out.append([(int(ids[i]), float(scores[i])) for i in order])
+    return out
+
+
+def upsert(kb_id: int, model: str, ids: List[int], doc_ids: List[int], vectors: np.ndarray):
+    if settings.vector_codec == "none" and settings.vector_store != "off":
+        # sidecar files must see every write, so open them even if nothing searched yet
+        kb_indexes(kb_id)
+    # waits for a load of this KB in progress, which may have read SQLite before these rows
+    with _kb_lock(kb_id), _registry_lock:
+        loaded = _indexes.get(kb_id)
+        if loaded is None:
+            # not resident yet; the first search will load these rows from SQLite
+            return
+        index = loaded.get(model or "")
+        if index is None:
+            index = loaded[model or ""] = _new_index(kb_id, model or "", vectors.shape[1])
+    if vectors.shape[1] != index.dim:
+        index.remove(ids)
+        return
+    index.add(ids, doc_ids, vectors)
+
+
+def remove(kb_id: int, ids: List[int]):
+    with _kb_lock(kb_id), _registry_lock:
+        loaded = _indexes.get(kb_id)
+    if loaded:
+        for index in loaded.values():
+            index.remove(ids)
+
+
+def remove_document(kb_id: int, doc_id: int):
+    with _kb_lock(kb_id), _registry_lock:
+        loaded = _indexes.get(kb_id)
+    if loaded:
+        for index in loaded.values():
+            index.remove_documents([doc_id])
+
+
+def drop_kb(kb_id: int):
+    with _kb_lock(kb_id), _registry_lock:
+        _indexes.pop(kb_id, None)
+        vector_store.delete_kb(kb_id)
+
+
+def compact(kb_id: int) -> int:
+    """Drop tombstoned rows from a KB's sidecar files; returns rows reclaimed."""
+    with _kb_lock(kb_id):
+        # release the mappings first; Windows cannot replace a mapped file
+        with _registry_lock:
+            _indexes.pop(kb_id, None)
+        return sum(store.compact() for store in vector_store.kb_stores(kb_id).values())
+
+
+def rebuild(kb_id: int) -> int:
+    """Regenerate a KB's sidecar files from SQLite; returns rows written."""
+    with _kb_lock(kb_id):
+        with _registry_lock:
+            _indexes.pop(kb_id, None)
+        return sum(len(store) for store in vector_store.rebuild_kb(kb_id).values())
@@ -0,0 +1,209 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+import glob
+import json
+import logging
+import os
+import re
+import numpy as np
+
+from .db import read_conn
+from .config import settings
+
+# Sidecar layout per KB and embedding model, next to knowledge.db:
+#   vectors/kb<ID>-<model>.json  manifest {"kb_id", "model", "dim", "dtype"}
+#   vectors/kb<ID>-<model>.vec   rows of `dim` float32/float16 values (unit vectors)
+#   vectors/kb<ID>-<model>.ids   int64 pairs (embedding id, document id) per row
+#   vectors/kb<ID>-<model>.tomb  one byte per row, 1 = deleted
+# Files are append-only; an upsert tombstones the old row and appends a new one.
+# The embedding table stays the source of truth and can always regenerate them.
+
+_ID_DTYPE = np.dtype([("id", "<i8"), ("doc", "<i8")])
+
+
+def vectors_dir() -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(settings.db_path)), "vectors")
+
+
+def _slug(model: str) -> str:
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", model or "default")[:80]
+
+
+def _normalize_rows(mat: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(mat, axis=1)
+    nz = norms > 0
+    mat[nz] /= norms[nz, None]
+    return mat
+
+
+class VectorStore:
+    """Append-only, memory-mapped vector file for one KB and embedding model."""
+
+    def __init__(self, base: str, kb_id: int, model: str, dim: int, dtype: str):
+        self.base = base
+        self.kb_id = kb_id
+        self.model = model
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self._row_bytes = self.dim * self.dtype.itemsize
+
+    @property
+    def vec_path(self) -> str:
+        return self.base + ".vec"
+
+    @property
+    def ids_path(self) -> str:
+        return self.base + ".ids"
+
+    @property
+    def tomb_path(self) -> str:
+        return self.base + ".tomb"
+
+    @property
+    def meta_path(self) -> str:
+        return self.base + ".json"
+
+    @classmethod
+    def create(cls, kb_id: int, model: str, dim: int, dtype: Optional[str] = None, base: Optional[str] = None) -> "VectorStore":
+        os.makedirs(vectors_dir(), exist_ok=True)
+        base = base or os.path.join(vectors_dir(), f"kb{kb_id}-{_slug(model)}")
+        store = cls(base, kb_id, model, dim, dtype or settings.vector_store)
+        for path in (store.vec_path, store.ids_path, store.tomb_path):
+            open(path, "wb").close()
+        with open(store.meta_path, "w", encoding="utf-8") as f:
+            json.dump({"kb_id": kb_id, "model": model, "dim": dim, "dtype": store.dtype.name}, f)
+        return store
+
+    @classmethod
+    def open(cls, meta_path: str) -> "VectorStore":
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        store = cls(meta_path[: -len(".json")], int(meta["kb_id"]), meta["model"], int(meta["dim"]), meta["dtype"])
+        store._repair()
+        return store
+
+    def __len__(self) -> int:
+        return min(
+            os.path.getsize(self.vec_path) // self._row_bytes,
+            os.path.getsize(self.ids_path) // _ID_DTYPE.itemsize,
+            os.path.getsize(self.tomb_path),
+        )
+
+    def _repair(self):
+        # Drop a partially written tail (crash mid-append) so all files agree on the row count
+        n = len(self)
+        for path, size in ((self.vec_path, n * self._row_bytes), (self.ids_path, n * _ID_DTYPE.itemsize), (self.tomb_path, n)):
+            if os.path.getsize(path) != size:
+                os.truncate(path, size)
+
+    def arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Read-only (vectors, embedding_ids, document_ids, tombstones) views over the files."""
+        n = len(self)
+        if n == 0:
+            return (np.zeros((0, self.dim), dtype=self.dtype), np.zeros(0, dtype=np.int64),
+                    np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8))
+        vecs = np.memmap(self.vec_path, dtype=self.dtype, mode="r", shape=(n, self.dim))
+        ids = np.memmap(self.ids_path, dtype=_ID_DTYPE, mode="r", shape=(n,))
+        tomb = np.memmap(self.tomb_path, dtype=np.uint8, mode="r", shape=(n,))
+        return vecs, ids["id"], ids["doc"], tomb
+
+    def append(self, ids: List[int], doc_ids: List[int], vectors: np.ndarray):
+        if not len(ids):
+            return
+        pairs = np.empty(len(ids), dtype=_ID_DTYPE)
+        pairs["id"] = ids
+        pairs["doc"] = doc_ids
+        with open(self.vec_path, "ab") as f:
+            f.write(np.ascontiguousarray(vectors, dtype=self.dtype).tobytes())
+        with open(self.ids_path, "ab") as f:
+            f.write(pairs.tobytes())
+        # the tombstone file is written last; its length commits the rows
+        with open(self.tomb_path, "ab") as f:
+            f.write(bytes(len(ids)))
+
+    def tombstone(self, rows: np.ndarray):
+        if not len(rows):
+            return
+        tomb = np.memmap(self.tomb_path, dtype=np.uint8, mode="r+", shape=(len(self),))
+        tomb[rows] = 1
+        tomb.flush()
+        del tomb
+
+    def compact(self) -> int:
+        """Rewrite only live rows; returns the number of rows dropped."""
+        vecs, ids, docs, tomb = self.arrays()
+        live = np.flatnonzero(tomb == 0)
+        dropped = len(tomb) - len(live)
+        if not dropped:
+            return 0
+        tmp = VectorStore.create(self.kb_id, self.model, self.dim, self.dtype.name, base=self.base + ".compact")
+        block = 65536
+        for start in range(0, len(live), block):
+            rows = live[start:start + block]
+            tmp.append(ids[rows], docs[rows], vecs[rows])
+        del vecs, ids, docs, tomb
+        for suffix in (".vec", ".ids", ".tomb", ".json"):
+            os.replace(tmp.base + suffix, self.base + suffix)
+        return dropped
+
+    def delete(self):
+        for path in (self.vec_path, self.ids_path, self.tomb_path, self.meta_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def kb_stores(kb_id: int) -> Dict[str, VectorStore]:
+    out: Dict[str, VectorStore] = {}
+    for meta_path in glob.glob(os.path.join(vectors_dir(), f"kb{kb_id}-*.json")):
+        try:
+            store = VectorStore.open(meta_path)
+        except Exception as e:
+            logging.error(f"Ignoring unreadable vector store {meta_path}: {e}")
+            continue
+        if store.kb_id == kb_id:
+            out[store.model] = store
+    return out
+
+
+def _iter_kb_rows(kb_id: int, batch: int = 4096) -> Iterator[List]:
+    with read_conn() as conn:
+        cur = conn.execute(
+            "SELECT e.id, e.document_id, e.vector, e.model FROM embedding e WHERE e.kb_id=? ORDER BY e.id",
+            (kb_id,),
+        )
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                break
+            yield rows
+
+
+def rebuild_kb(kb_id: int) -> Dict[str, VectorStore]:
+    """Regenerate a KB's sidecar files from the embedding table."""
+    for store in kb_stores(kb_id).values():
+        store.delete()
+    stores: Dict[str, VectorStore] = {}
+    for rows in _iter_kb_rows(kb_id):
+        groups: Dict[str, List] = {}
+        for r in rows:
+            groups.setdefault(r["model"] or "", []).append(r)
+        for model, items in groups.items():
+            store = stores.get(model)
+            if store is None:
+                # skip failed (empty) embeddings when picking the dimension
+                dim = next((len(r["vector"]) // 4 for r in items if len(r["vector"]) >= 4), 0)
+                if dim == 0:
+                    continue
+                store = stores[model] = VectorStore.create(kb_id, model, dim)
+            items = [r for r in items if len(r["vector"]) == store.dim * 4]
+            if not items:
+                continue
+            mat = np.frombuffer(b"".join(r["vector"] for r in items), dtype=np.float32).reshape(len(items), store.dim).copy()
+            store.append([r["id"] for r in items], [r["document_id"] for r in items], _normalize_rows(mat))
+    return stores
+
+
+def delete_kb(kb_id: int):
+    for store in kb_stores(kb_id).values():
+        store.delete()
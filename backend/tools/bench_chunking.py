@@ -0,0 +1,72 @@
+"""Chunking throughput (MB/s of document text) for each chunker/tokenizer combination.
+
+The corpus is synthetic structured text in the shape the readers produce: headings,
+paragraphs of varying length, the occasional very long paragraph, and page breaks.
+Tokenizers that are not installed (tiktoken) are skipped.
+
+    python tools/bench_chunking.py [--mb 20] [--max-tokens 512] [--overlap 64]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--mb", type=float, default=20)
+parser.add_argument("--max-tokens", type=int, default=512)
+parser.add_argument("--overlap", type=int, default=64)
+args = parser.parse_args()
+
+os.environ["LOCALAPPDATA"] = tempfile.mkdtemp(prefix="steve-bench-")
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from steve import chunking  # noqa: E402
+
+WORDS = [f"term{i}" for i in range(5000)] + ["the", "a", "of", "and", "to", "in"]
+rng = random.Random(0)
+
+
+def sentence():
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 30))).capitalize() + rng.choice(".!?")
+
+
+def corpus(size):
+    parts, total = [], 0
+    while total < size:
+        roll = rng.random()
+        if roll < 0.05:
+            block = f"# Section {len(parts)}"
+        elif roll < 0.08:
+            block = "\f"
+        elif roll < 0.09:
+            block = "\n".join(sentence() for _ in range(400))  # e.g. a long table or listing
+        else:
+            block = " ".join(sentence() for _ in range(rng.randint(1, 12)))
+        parts.append(block)
+        total += len(block) + 2
+    return "\n\n".join(parts)
+
+
+text = corpus(int(args.mb * 1024 * 1024))
+mb = len(text.encode("utf-8")) / (1024 * 1024)
+print(f"{mb:.1f} MB, max_tokens={args.max_tokens} overlap={args.overlap}")
+
+chunkers = [("words", chunking.WordChunker(args.max_tokens, args.overlap))]
+for spec in ("regex", "tiktoken:cl100k_base"):
+    tok = chunking.load_tokenizer(spec)
+    if spec != "regex" and tok.name == "regex":
+        print(f"  {spec}: not available, skipped")
+        continue
+    chunkers.append((f"structured/{tok.name}", chunking.StructuredChunker(args.max_tokens, args.overlap, tok)))
+
+for name, chunker in chunkers:
+    for mode in ("whole", "streamed"):
+        t0 = time.perf_counter()
+        if mode == "whole":
+            n = len(chunker.chunk(text))
+        else:
+            n = sum(1 for _ in chunker.iter_chunks(text[i:i + (1 << 20)] for i in range(0, len(text), 1 << 20)))
+        elapsed = time.perf_counter() - t0
+        print(f"  {name:28s} {mode:9s} {mb / elapsed:8.1f} MB/s  {n:8d} chunks  ({elapsed:.2f}s)")
@@ -0,0 +1,153 @@
+"""Concurrent request throughput with blocking work on the event loop vs offloaded.
+
+Seeds a synthetic KB, then starts the app with uvicorn in a child process (a
+deterministic in-process embedder stands in for the embedding server, the retrieval
+cache is off) and drives a mix of /search, /kb/{id}/docs and small /ingest/file
+uploads at several concurrency levels, while a probe pings /health to measure how long
+the event loop stalls. "inline" runs DB calls and parsing directly on the event loop -
+how every handler used to call the service layer - and "offload" uses the read pool,
+writer thread and parse processes. Read throughput scales with cores; the /health
+latency shows whether slow requests hold up everyone else.
+
+    python tools/bench_concurrency.py [--docs 1000] [--chunks 20] [--dim 384] [--requests 400] [--concurrency 1,4,16]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import numpy as np
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--docs", type=int, default=1000)
+parser.add_argument("--chunks", type=int, default=20)
+parser.add_argument("--dim", type=int, default=384)
+parser.add_argument("--requests", type=int, default=400)
+parser.add_argument("--concurrency", default="1,4,16")
+parser.add_argument("--serve", choices=("inline", "offload"), help=argparse.SUPPRESS)
+parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+if not args.serve:
+    os.environ["LOCALAPPDATA"] = tempfile.mkdtemp(prefix="steve-bench-")
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import httpx  # noqa: E402
+
+from steve.config import settings  # noqa: E402
+from steve import offload, service  # noqa: E402
+
+WORDS = [f"term{i}" for i in range(5000)]
+
+
+async def fake_embed(texts, model=None, use_cache=None):
+    return [np.random.default_rng(zlib.crc32(t.encode())).standard_normal(args.dim).astype(np.float32).tolist() for t in texts]
+
+
+async def inline(fn, *a, **kw):
+    return fn(*a, **kw)
+
+
+if args.serve:
+    import uvicorn
+    import app as server
+    from steve import pipeline
+
+    settings.retrieval_cache_items = 0
+    server.embed_texts = pipeline.embed_texts = fake_embed
+    if args.serve == "inline":
+        offload.db_read = offload.db_write = offload.parse = inline
+    uvicorn.run(server.app, host="127.0.0.1", port=args.port, log_level="warning")
+    sys.exit(0)
+
+rng = np.random.default_rng(0)
+kb_id = service.create_kb("bench")
+for d in range(args.docs):
+    chunks = [" ".join(rng.choice(WORDS, size=60)) for _ in range(args.chunks)]
+    doc_id = service.add_document(kb_id, f"doc{d}", f"doc{d}", "text", "\n\n".join(chunks))
+    service.upsert_embeddings(doc_id, chunks, rng.standard_normal((args.chunks, args.dim)).astype(np.float32).tolist())
+
+
+def start(mode: str):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", mode, "--port", str(port),
+                             "--dim", str(args.dim)], env=os.environ.copy())
+    base = f"http://127.0.0.1:{port}"
+    while True:
+        try:
+            httpx.get(f"{base}/health")
+            return proc, base
+        except httpx.TransportError:
+            time.sleep(0.1)
+
+
+def p95(values):
+    return statistics.quantiles(values, n=20)[-1] if len(values) > 1 else values[0]
+
+
+async def drive(base: str, concurrency: int):
+    qrng = np.random.default_rng(concurrency)
+    queue = list(range(args.requests))
+    latencies, probes = [], []
+    running = True
+
+    async def probe(client):
+        while running:
+            t0 = time.perf_counter()
+            (await client.get(f"{base}/health")).raise_for_status()
+            probes.append((time.perf_counter() - t0) * 1000)
+            await asyncio.sleep(0.02)
+
+    async def worker(client):
+        while queue:
+            i = queue.pop()
+            t0 = time.perf_counter()
+            if i % 10 == 9:
+                body = "\n\n".join(" ".join(qrng.choice(WORDS, size=60)) for _ in range(args.chunks)).encode()
+                # same names in every run, so uploads replace documents instead of growing the KB
+                r = await client.post(f"{base}/ingest/file", data={"kb_id": str(kb_id)},
+                                      files={"file": (f"upload{i}.txt", body)})
+            elif i % 10 in (3, 7):
+                r = await client.get(f"{base}/kb/{kb_id}/docs")
+            else:
+                query = " ".join(qrng.choice(WORDS, size=3))
+                r = await client.post(f"{base}/search", json={"kb_ids": [kb_id], "query": query, "top_k": 10})
+            r.raise_for_status()
+            latencies.append((time.perf_counter() - t0) * 1000)
+
+    limits = httpx.Limits(max_connections=concurrency + 1, max_keepalive_connections=concurrency + 1)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        pinger = asyncio.create_task(probe(client))
+        t0 = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - t0
+        running = False
+        await pinger
+    return {"rps": round(len(latencies) / elapsed, 1), "p50_ms": round(statistics.median(latencies), 2),
+            "p95_ms": round(p95(latencies), 2), "health_p95_ms": round(p95(probes), 2)}
+
+
+levels = [int(c) for c in args.concurrency.split(",")]
+report = {"docs": args.docs, "chunks": args.docs * args.chunks, "dim": args.dim, "requests": args.requests,
+          "cpus": os.cpu_count(), "read_threads": settings.db_read_threads, "results": {f"concurrency={c}": {} for c in levels}}
+for mode in ("inline", "offload"):
+    proc, base = start(mode)
+    try:
+        asyncio.run(drive(base, max(levels)))  # warm-up
+        for level in levels:
+            report["results"][f"concurrency={level}"][mode] = asyncio.run(drive(base, level))
+    finally:
+        proc.terminate()
+        proc.wait()
+for row in report["results"].values():
+    row["speedup"] = round(row["offload"]["rps"] / row["inline"]["rps"], 2) if row["inline"]["rps"] else None
+sys.stdout.write(json.dumps(report, indent=2) + "\n")
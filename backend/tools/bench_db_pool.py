@@ -0,0 +1,111 @@
+"""Requests/sec of the /search SQL pattern with per-call connections vs the pool.
+
+A /search used to open four fresh connections (kb_docs twice, the semantic fetch and
+keyword_search). This replays that statement mix against a synthetic KB, once with a
+new sqlite3.connect per block (the old get_conn) and once through steve.db's pooled,
+pragma-tuned read connections.
+
+    python tools/bench_db_pool.py [--docs 2000] [--chunks 20] [--seconds 5] [--threads 1,4]
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--docs", type=int, default=2000)
+parser.add_argument("--chunks", type=int, default=20)
+parser.add_argument("--seconds", type=float, default=5.0)
+parser.add_argument("--threads", default="1,4")
+args = parser.parse_args()
+
+os.environ["LOCALAPPDATA"] = tempfile.mkdtemp(prefix="steve-bench-")
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from steve.config import settings  # noqa: E402
+from steve.db import get_conn, read_conn  # noqa: E402
+
+WORDS = [f"term{i}" for i in range(5000)]
+rng = random.Random(0)
+
+with get_conn() as conn:
+    kb_id = conn.execute("INSERT INTO knowledgebase(name) VALUES('bench')").lastrowid
+    for d in range(args.docs):
+        doc_id = conn.execute(
+            "INSERT INTO document(kb_id, source, title, type, content, meta) VALUES(?,?,?,?,?,?)",
+            (kb_id, f"doc{d}", f"doc{d}", "text", "", "{}"),
+        ).lastrowid
+        for c in range(args.chunks):
+            text = " ".join(rng.choice(WORDS) for _ in range(60))
+            conn.execute(
+                "INSERT INTO embedding(document_id, chunk_index, vector, text) VALUES(?,?,?,?)",
+                (doc_id, c, bytes(1536), text),
+            )
+            conn.execute("INSERT INTO chunk_fts(content, document_id, chunk_index) VALUES(?,?,?)", (text, doc_id, c))
+    max_id = conn.execute("SELECT MAX(id) AS m FROM embedding").fetchone()["m"]
+
+
+@contextmanager
+def fresh_conn():
+    # the pre-pool get_conn: new connection, default pragmas, closed after each block
+    conn = sqlite3.connect(settings.db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def one_search(open_conn, r: random.Random):
+    for _ in range(2):
+        with open_conn() as conn:
+            doc_ids = [row["id"] for row in conn.execute("SELECT id FROM document WHERE kb_id=?", (kb_id,))]
+    ids = [r.randint(1, max_id) for _ in range(5)]
+    with open_conn() as conn:
+        conn.execute(
+            "SELECT e.id, e.document_id, e.chunk_index, e.text, d.source, d.title, d.kb_id, d.meta FROM embedding e JOIN document d ON e.document_id=d.id WHERE e.id IN (?,?,?,?,?)",
+            ids,
+        ).fetchall()
+    with open_conn() as conn:
+        conn.execute(
+            "SELECT f.document_id, f.chunk_index, bm25(chunk_fts) AS rank FROM chunk_fts f JOIN document d ON d.id=f.document_id WHERE d.kb_id=? AND chunk_fts MATCH ? ORDER BY rank LIMIT 20",
+            (kb_id, f"{r.choice(WORDS)} {r.choice(WORDS)}"),
+        ).fetchall()
+    return len(doc_ids)
+
+
+def run(open_conn, threads: int) -> float:
+    stop = time.perf_counter() + args.seconds
+    counts = [0] * threads
+
+    def worker(i):
+        r = random.Random(i)
+        while time.perf_counter() < stop:
+            one_search(open_conn, r)
+            counts[i] += 1
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return sum(counts) / args.seconds
+
+
+report = {"docs": args.docs, "chunks": args.docs * args.chunks, "seconds": args.seconds, "results": {}}
+for threads in [int(t) for t in args.threads.split(",")]:
+    before = run(fresh_conn, threads)
+    after = run(read_conn, threads)
+    report["results"][f"threads={threads}"] = {
+        "per_call_connect_rps": round(before, 1),
+        "pooled_rps": round(after, 1),
+        "speedup": round(after / before, 2) if before else None,
+    }
+sys.stdout.write(json.dumps(report, indent=2) + "\n")
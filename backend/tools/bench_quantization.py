@@ -0,0 +1,75 @@
+"""Recall@k and latency of the quantized vector index against exact search.
+
+Builds a throwaway knowledge base of synthetic clustered embeddings, then runs the
+same queries through the exact float32 index and the int8 / PQ codecs (with and
+without full-precision re-ranking).
+
+    python tools/bench_quantization.py [--rows 50000] [--dim 384] [--queries 200] [--k 10]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--rows", type=int, default=50000)
+parser.add_argument("--dim", type=int, default=384)
+parser.add_argument("--queries", type=int, default=200)
+parser.add_argument("--k", type=int, default=10)
+args = parser.parse_args()
+
+# keep the benchmark DB away from the user's knowledge.db
+os.environ["LOCALAPPDATA"] = tempfile.mkdtemp(prefix="steve-bench-")
+os.environ["VECTOR_CODEC"] = "int8"  # so upserts also write int8 codes
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from steve import service, vector_index  # noqa: E402
+from steve.config import settings  # noqa: E402
+
+rng = np.random.default_rng(42)
+centers = rng.normal(size=(256, args.dim)).astype(np.float32)
+data = centers[rng.integers(0, len(centers), size=args.rows)] + 0.6 * rng.normal(size=(args.rows, args.dim)).astype(np.float32)
+queries = data[rng.choice(args.rows, size=args.queries, replace=False)] + 0.3 * rng.normal(size=(args.queries, args.dim)).astype(np.float32)
+
+kb_id = service.create_kb("bench")
+per_doc = 1000
+for start in range(0, args.rows, per_doc):
+    doc_id = service.add_document(kb_id, f"doc{start}", f"doc{start}", "text", "")
+    block = data[start:start + per_doc]
+    service.upsert_embeddings(doc_id, [""] * len(block), block)
+
+
+def run(codec: str, rerank_factor: int):
+    settings.vector_codec = codec
+    settings.quant_rerank_factor = rerank_factor
+    vector_index._indexes.clear()
+    t0 = time.perf_counter()
+    vector_index.kb_indexes(kb_id)
+    load_s = time.perf_counter() - t0
+    out, lat = [], []
+    for q in queries:
+        t = time.perf_counter()
+        out.append([eid for eid, _ in vector_index.search([kb_id], q.tolist(), args.k)])
+        lat.append(time.perf_counter() - t)
+    return out, load_s, lat
+
+
+exact, _, exact_lat = run("none", 1)
+report = {"rows": args.rows, "dim": args.dim, "queries": args.queries, "k": args.k, "modes": {}}
+for codec, factor in (("none", 1), ("int8", 1), ("int8", 10), ("pq", 1), ("pq", 10)):
+    got, load_s, lat = run(codec, factor)
+    index = next(iter(vector_index.kb_indexes(kb_id).values()))
+    resident = sum(getattr(index, name)[: len(index)].nbytes for name in index._columns)
+    recall = np.mean([len(set(a) & set(b)) / max(1, len(a)) for a, b in zip(exact, got)])
+    report["modes"][f"{codec}/rerank{factor}"] = {
+        "recall_at_k": round(float(recall), 4),
+        "p50_ms": round(float(np.percentile(lat, 50)) * 1000, 3),
+        "p95_ms": round(float(np.percentile(lat, 95)) * 1000, 3),
+        "load_s": round(load_s, 3),
+        "resident_mb": round(resident / 2 ** 20, 2),
+    }
+sys.stdout.write(json.dumps(report, indent=2) + "\n")
@@ -0,0 +1,302 @@
+"""Reproducible retrieval, ingestion and chat benchmarks on synthetic KBs, written as JSON.
+
+For each --sizes entry (chunks; 10k up to millions) a fresh DB is seeded with random
+unit vectors and Zipf-distributed text, then measured in its own process:
+
+  search  - semantic_search, keyword_search and hybrid_search latency percentiles, and
+            queries/sec of --batch queries through service.search_many (/search/batch)
+            against the same queries one call at a time;
+  ingest  - chunks/sec of pipeline.ingest_text, embedding over HTTP;
+  chat    - time to the sources event and the first token of /chat/stream, end to end
+            through a uvicorn-served backend.
+
+tools/fake_openai.py stands in for the embedding and chat server, so only the backend's
+own costs are measured. --baseline prints each metric against an earlier report.
+
+    python tools/bench_suite.py [--sizes 10000,100000] [--dim 384] [--queries 200] [--out bench.json]
+    python tools/bench_suite.py --out new.json --baseline bench.json
+    python tools/bench_suite.py --sizes 1000000,5000000 --skip-chat --out large.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--sizes", default="10000,100000", help="comma-separated KB sizes in chunks")
+parser.add_argument("--dim", type=int, default=384)
+parser.add_argument("--chunks-per-doc", type=int, default=50)
+parser.add_argument("--queries", type=int, default=200)
+parser.add_argument("--top-k", type=int, default=10)
+parser.add_argument("--batch", type=int, default=64, help="queries per search_many call")
+parser.add_argument("--ingest-docs", type=int, default=50)
+parser.add_argument("--ingest-words", type=int, default=3000)
+parser.add_argument("--chat-requests", type=int, default=20)
+parser.add_argument("--skip-ingest", action="store_true")
+parser.add_argument("--skip-chat", action="store_true")
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--out", help="write the JSON report here instead of stdout")
+parser.add_argument("--baseline", help="earlier report to compare against")
+parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+parser.add_argument("--fake-url", help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+BACKEND = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+VOCAB = 20000
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(url: str, proc: subprocess.Popen, timeout: float = 120.0):
+    import httpx
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{url} exited with {proc.returncode}")
+        try:
+            httpx.get(url, timeout=2)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not start")
+
+
+def percentiles(ms) -> dict:
+    ms = sorted(ms)
+    q = statistics.quantiles(ms, n=100, method="inclusive") if len(ms) > 1 else ms * 99
+    return {"n": len(ms), "mean": round(statistics.fmean(ms), 3), "p50": round(q[49], 3), "p95": round(q[94], 3),
+            "p99": round(q[98], 3), "max": round(ms[-1], 3)}
+
+
+class Corpus:
+    """Zipf-distributed words, so common terms have long posting lists like real text."""
+
+    def __init__(self, seed: int):
+        self.rng = np.random.default_rng(seed)
+        weights = 1.0 / np.arange(1, VOCAB + 1) ** 1.07
+        self.p = weights / weights.sum()
+        self.words = np.array([f"w{i}" for i in range(VOCAB)])
+
+    def texts(self, n: int, words: int):
+        idx = self.rng.choice(VOCAB, size=(n, words), p=self.p)
+        return [" ".join(row) for row in self.words[idx]]
+
+    def query(self, text: str) -> str:
+        # two or three terms of a stored chunk (FTS5 ANDs them), skipping the stop-word-like top 50
+        terms = [w for w in dict.fromkeys(text.split()) if int(w[1:]) >= 50] or text.split()
+        n = min(len(terms), int(self.rng.integers(2, 4)))
+        return " ".join(self.rng.choice(terms, size=n, replace=False))
+
+
+def worker():
+    data_dir = tempfile.mkdtemp(prefix="steve-suite-")
+    os.environ["LOCALAPPDATA"] = data_dir
+    os.environ["OPENAI_BASE_URL"] = args.fake_url
+    sys.path.insert(0, BACKEND)
+
+    from steve.config import settings
+    from steve.db import get_conn
+    from steve import pipeline, service
+
+    size, per_doc = args.worker, args.chunks_per_doc
+    corpus = Corpus(args.seed)
+    result = {"chunks": size, "settings": {k: getattr(settings, k) for k in (
+        "vector_index_mode", "vector_codec", "vector_store", "fusion_mode", "chunker",
+        "semantic_candidates", "keyword_candidates", "db_read_threads")}}
+
+    t0 = time.perf_counter()
+    kb_id = service.create_kb("bench")
+    samples = []  # chunk texts to draw queries from
+    written = 0
+    while written < size:
+        with get_conn():  # one transaction per block of documents
+            for _ in range(20):
+                n = min(per_doc, size - written)
+                if n <= 0:
+                    break
+                chunks = corpus.texts(n, 60)
+                samples.append(chunks[0])
+                doc_id = service.add_document(kb_id, f"doc{written}", f"doc{written}", "text", "")
+                vecs = corpus.rng.standard_normal((n, args.dim), dtype=np.float32)
+                service.upsert_embeddings(doc_id, chunks, vecs)
+                written += n
+    result["seed_seconds"] = round(time.perf_counter() - t0, 2)
+
+    queries = [corpus.query(samples[int(i)]) for i in corpus.rng.integers(0, len(samples), size=args.queries)]
+    qvecs = corpus.rng.standard_normal((args.queries, args.dim), dtype=np.float32).tolist()
+    calls = {
+        "semantic": lambda q, v: service.semantic_search([kb_id], v, args.top_k),
+        "keyword": lambda q, v: service.keyword_search([kb_id], q, args.top_k),
+        "hybrid": lambda q, v: service.hybrid_search([kb_id], q, v, args.top_k, settings.retrieval_alpha),
+    }
+    result["search_ms"] = {}
+    for name, call in calls.items():
+        for q, v in zip(queries[:10], qvecs[:10]):
+            call(q, v)  # loads the resident index and warms the page cache
+        times = []
+        for q, v in zip(queries, qvecs):
+            t = time.perf_counter()
+            call(q, v)
+            times.append((time.perf_counter() - t) * 1000)
+        result["search_ms"][name] = percentiles(times)
+
+    result["search_batch"] = {"queries": args.batch}
+    for name, alpha in (("semantic", None), ("hybrid", settings.retrieval_alpha)):
+        qs, vs = queries[:args.batch], qvecs[:args.batch]
+        t = time.perf_counter()
+        for q, v in zip(qs, vs):
+            calls[name](q, v)
+        sequential = time.perf_counter() - t
+        t = time.perf_counter()
+        service.search_many([kb_id], qs, vs, args.top_k, alpha)
+        batched = time.perf_counter() - t
+        result["search_batch"][f"{name}_qps"] = round(len(qs) / batched, 1)
+        result["search_batch"][f"{name}_sequential_qps"] = round(len(qs) / sequential, 1)
+
+    if not args.skip_ingest:
+        ingest_kb = service.create_kb("ingest")
+        docs = corpus.texts(args.ingest_docs, args.ingest_words)
+
+        async def ingest():
+            counts = []
+            for i, text in enumerate(docs):
+                res = await pipeline.ingest_text(ingest_kb, f"ingest{i}", f"ingest{i}", "text", text)
+                counts.append(res.get("chunks", 0))
+            return counts
+
+        t = time.perf_counter()
+        counts = asyncio.run(ingest())
+        elapsed = time.perf_counter() - t
+        result["ingest"] = {"docs": len(docs), "chunks": sum(counts), "seconds": round(elapsed, 3),
+                            "docs_per_sec": round(len(docs) / elapsed, 2), "chunks_per_sec": round(sum(counts) / elapsed, 1)}
+
+    if not args.skip_chat:
+        result["chat"] = chat_bench(kb_id, queries)
+    return result
+
+
+def chat_bench(kb_id: int, queries) -> dict:
+    import httpx
+
+    port = free_port()
+    env = {**os.environ, "RETRIEVAL_CACHE_ITEMS": "0"}
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+                            cwd=BACKEND, env=env)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        wait_ready(f"{base}/health", proc)
+        sources, first, total = [], [], []
+        for i in range(args.chat_requests + 2):
+            body = {"kb_ids": [kb_id], "messages": [{"role": "user", "content": queries[i % len(queries)]}], "top_k": 5}
+            t = time.perf_counter()
+            got_sources = got_token = None
+            with httpx.stream("POST", f"{base}/chat/stream", json=body, timeout=120) as r:
+                r.raise_for_status()
+                for line in r.iter_lines():
+                    now = (time.perf_counter() - t) * 1000
+                    if line == "event: sources" and got_sources is None:
+                        got_sources = now
+                    elif line == "event: token" and got_token is None:
+                        got_token = now
+                    elif line == "event: error":
+                        raise RuntimeError("chat stream failed")
+            if i < 2:
+                continue  # warm-up: index load, client pools
+            sources.append(got_sources)
+            first.append(got_token)
+            total.append((time.perf_counter() - t) * 1000)
+        return {"sources_ms": percentiles(sources), "ttft_ms": percentiles(first), "total_ms": percentiles(total)}
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BACKEND, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+def metrics(result: dict) -> dict:
+    """Flat {name: value} of the headline numbers; lower is better except for rates."""
+    out = {f"search.{k}.{p}": v[p] for k, v in result.get("search_ms", {}).items() for p in ("p50", "p95")}
+    out.update({f"chat.{k}.p50": v["p50"] for k, v in result.get("chat", {}).items()})
+    if "ingest" in result:
+        out["ingest.chunks_per_sec"] = result["ingest"]["chunks_per_sec"]
+    for name in ("semantic", "hybrid"):
+        if f"{name}_qps" in result.get("search_batch", {}):
+            out[f"search_batch.{name}_qps"] = result["search_batch"][f"{name}_qps"]
+    return out
+
+
+def compare(old: dict, new: dict):
+    for size, result in new["results"].items():
+        before = metrics(old.get("results", {}).get(size, {}))
+        for name, value in metrics(result).items():
+            if name in before and before[name]:
+                change = value / before[name] - 1
+                print(f"{size:>9s} {name:28s} {before[name]:10.2f} -> {value:10.2f} {change:+7.1%}", file=sys.stderr)
+
+
+def main():
+    fake_port = free_port()
+    fake = subprocess.Popen([sys.executable, os.path.join(BACKEND, "tools", "fake_openai.py"),
+                             "--port", str(fake_port), "--dim", str(args.dim)])
+    fake_url = f"http://127.0.0.1:{fake_port}/v1"
+    report = {
+        "meta": {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "git": git_revision(), "python": platform.python_version(),
+            "platform": platform.platform(), "cpus": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("worker", "fake_url", "out", "baseline")},
+        },
+        "results": {},
+    }
+    try:
+        wait_ready(f"{fake_url}/models", fake)
+        for size in [int(s) for s in args.sizes.split(",")]:
+            with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as out:
+                path = out.name
+            cmd = [sys.executable, os.path.abspath(__file__), *sys.argv[1:], "--worker", str(size),
+                   "--fake-url", fake_url, "--out", path]
+            print(f"benchmarking {size} chunks ...", file=sys.stderr)
+            subprocess.run(cmd, check=True)
+            with open(path, encoding="utf-8") as f:
+                report["results"][str(size)] = json.load(f)
+            os.remove(path)
+    finally:
+        fake.terminate()
+        fake.wait()
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(json.load(f), report)
+    text = json.dumps(report, indent=2) + "\n"
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+
+if __name__ == "__main__":
+    if args.worker:
+        res = worker()
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(res, f)
+    else:
+        main()
@@ -0,0 +1,81 @@
+"""Chunks/sec written by upsert_embeddings, old per-row path vs the batched one.
+
+The old path ran an UPSERT, a chunk_fts DELETE by (document_id, chunk_index) - a full
+scan of the FTS table - and an INSERT per chunk, normalizing each vector in Python.
+Both paths write the same document into a KB that already holds --background chunks,
+first as a fresh insert and then as a full re-write of every chunk.
+
+    python tools/bench_upsert.py [--chunks 5000] [--dim 768] [--background 20000]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--chunks", type=int, default=5000)
+parser.add_argument("--dim", type=int, default=768)
+parser.add_argument("--background", type=int, default=20000)
+args = parser.parse_args()
+
+os.environ["LOCALAPPDATA"] = tempfile.mkdtemp(prefix="steve-bench-")
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from steve.config import settings  # noqa: E402
+from steve.db import get_conn  # noqa: E402
+from steve import service  # noqa: E402
+
+WORDS = [f"term{i}" for i in range(5000)]
+rng = random.Random(0)
+np_rng = np.random.default_rng(0)
+
+
+def texts(n):
+    return [" ".join(rng.choice(WORDS) for _ in range(60)) for _ in range(n)]
+
+
+def legacy_upsert(document_id, chunks, vectors):
+    # the pre-batching write path, statement for statement
+    model = settings.embedding_model
+    with get_conn() as conn:
+        kb_id = conn.execute("SELECT kb_id FROM document WHERE id=?", (document_id,)).fetchone()["kb_id"]
+        for idx, (text, vec) in enumerate(zip(chunks, vectors)):
+            arr = np.asarray(vec, dtype=np.float32)
+            norm = float(np.linalg.norm(arr))
+            arr = arr / norm if norm > 0 else arr
+            conn.execute(
+                """
+                INSERT INTO embedding(document_id, kb_id, chunk_index, vector, text, model, dim, is_normalized)
+                VALUES(?,?,?,?,?,?,?,?)
+                ON CONFLICT(document_id, chunk_index) DO UPDATE SET
+                    vector=excluded.vector, text=excluded.text, model=excluded.model,
+                    dim=excluded.dim, is_normalized=excluded.is_normalized
+                """,
+                (document_id, kb_id, idx, arr.tobytes(), text, model, len(arr), int(norm > 0)),
+            )
+            conn.execute("DELETE FROM chunk_fts WHERE document_id=? AND chunk_index=?", (document_id, idx))
+            conn.execute(
+                "INSERT INTO chunk_fts(content, document_id, chunk_index, kb_id) VALUES(?,?,?,?)",
+                (text, document_id, idx, kb_id),
+            )
+
+
+kb_id = service.create_kb("bench")
+print(f"seeding {args.background} background chunks ...")
+bg = service.add_document(kb_id, "background", "background", "text", "")
+service.upsert_embeddings(bg, texts(args.background), np_rng.standard_normal((args.background, args.dim)).astype(np.float32).tolist())
+
+chunks = texts(args.chunks)
+vectors = np_rng.standard_normal((args.chunks, args.dim)).astype(np.float32).tolist()
+print(f"{args.chunks} chunks x {args.dim} dims")
+for name, fn in (("per-row", legacy_upsert), ("batched", service.upsert_embeddings)):
+    doc_id = service.add_document(kb_id, name, name, "text", "")
+    for phase in ("insert", "rewrite"):
+        t0 = time.perf_counter()
+        fn(doc_id, chunks, vectors)
+        elapsed = time.perf_counter() - t0
+        print(f"  {name:8s} {phase:8s} {args.chunks / elapsed:10.0f} chunks/s  ({elapsed:.2f}s)")
@@ -0,0 +1,153 @@
+"""Offline retrieval evaluation: recall@k, MRR and latency per retrieval/fusion mode.
+
+Modes: semantic, keyword, legacy (the old alpha*sem + (1-alpha)/(1+bm25) blend over the
+semantic top_k and max(20, 2*top_k) keyword hits), rrf and normalized.
+
+By default a synthetic corpus is generated into a temporary DB with a deterministic
+embedder: words are synonyms of shared concepts, so paraphrased queries need semantic
+search while identifier lookups need keyword search. Against a real DB and the
+configured embedding endpoint, pass a KB and a JSONL file of
+{"query": ..., "relevant": [document id, source or title, ...]}:
+
+    python tools/eval_retrieval.py [--docs 3000] [--queries 300] [--top-k 10]
+    python tools/eval_retrieval.py --kb-id 1 --queries-file eval.jsonl
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import zlib
+
+import numpy as np
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--docs", type=int, default=3000)
+parser.add_argument("--queries", type=int, default=300)
+parser.add_argument("--top-k", type=int, default=10)
+parser.add_argument("--alpha", type=float, default=0.6)
+parser.add_argument("--kb-id", type=int, action="append")
+parser.add_argument("--queries-file")
+args = parser.parse_args()
+
+if not args.kb_id:
+    os.environ["LOCALAPPDATA"] = tempfile.mkdtemp(prefix="steve-eval-")
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from steve.config import settings  # noqa: E402
+from steve import fusion, service  # noqa: E402
+
+DIM = 64
+
+
+class SyntheticEmbedder:
+    """Each concept has three synonyms; a text embeds as the mean of its word vectors."""
+
+    def __init__(self, concepts: int, rng: np.random.Generator):
+        self.concepts = concepts
+        base = rng.standard_normal((concepts, DIM))
+        self.vectors = {}
+        for c in range(concepts):
+            for s in "abc":
+                self.vectors[f"c{c}{s}"] = base[c] + 0.35 * rng.standard_normal(DIM)
+
+    def word(self, w):
+        if w not in self.vectors:
+            # identifiers and other rare terms carry little meaning of their own
+            self.vectors[w] = 0.3 * np.random.default_rng(zlib.crc32(w.encode())).standard_normal(DIM)
+        return self.vectors[w]
+
+    def embed(self, text):
+        vec = np.mean([self.word(w) for w in text.split()], axis=0)
+        return (vec / (np.linalg.norm(vec) or 1.0)).astype(np.float32).tolist()
+
+
+def synthetic():
+    rng = np.random.default_rng(0)
+    emb = SyntheticEmbedder(max(50, args.docs // 6), rng)
+    kb_id = service.create_kb("eval")
+    docs = []
+    for d in range(args.docs):
+        topic = rng.choice(emb.concepts, size=6, replace=False)
+        words = [f"c{c}{rng.choice(list('abc'))}" for c in rng.choice(topic, size=40)]
+        words.insert(int(rng.integers(0, 40)), f"id{d:05d}")
+        text = " ".join(words)
+        doc_id = service.add_document(kb_id, f"doc{d}", f"doc{d}", "text", text)
+        service.upsert_embeddings(doc_id, [text], [emb.embed(text)])
+        docs.append((doc_id, topic, words))
+    queries = []
+    for q in range(args.queries):
+        doc_id, topic, words = docs[int(rng.integers(0, len(docs)))]
+        used = set(words)
+        if q % 2 == 0:
+            # paraphrase: the document's concepts, preferring synonyms it does not contain
+            terms = []
+            for c in rng.choice(topic, size=4, replace=False):
+                unused = [f"c{c}{s}" for s in "abc" if f"c{c}{s}" not in used]
+                terms.append(unused[0] if unused else f"c{c}a")
+        else:
+            # lookup by identifier plus one topical word
+            terms = [w for w in words if w.startswith("id")] + [f"c{topic[0]}a"]
+        queries.append({"query": " ".join(terms), "relevant": [doc_id]})
+    return [kb_id], queries, lambda text: emb.embed(text)
+
+
+def real():
+    from steve.embedding import embed_texts
+
+    with open(args.queries_file, encoding="utf-8") as f:
+        queries = [json.loads(line) for line in f if line.strip()]
+    return args.kb_id, queries, lambda text: asyncio.run(embed_texts([text]))[0]
+
+
+def legacy(kb_ids, query, qvec, k):
+    sem = service.semantic_search(kb_ids, qvec, top_k=k)
+    kw = service.keyword_search(kb_ids, query, top_k=max(20, k * 2))
+    merged = {}
+    for item in sem:
+        merged[(item["document_id"], item["chunk_index"])] = {**item, "sem": item["score"], "kw": 0.0}
+    for item in kw:
+        key = (item["document_id"], item["chunk_index"])
+        squashed = 1.0 / (1.0 - item["score"])  # the old 1/(1+bm25)
+        entry = merged.setdefault(key, {**item, "sem": 0.0, "kw": 0.0})
+        entry["kw"] = max(entry["kw"], squashed)
+    for v in merged.values():
+        v["score"] = args.alpha * v["sem"] + (1 - args.alpha) * v["kw"]
+    return sorted(merged.values(), key=lambda v: v["score"], reverse=True)[:k]
+
+
+MODES = {
+    "semantic": lambda kb, q, v, k: service.semantic_search(kb, v, k),
+    "keyword": lambda kb, q, v, k: service.keyword_search(kb, q, k),
+    "legacy": legacy,
+    **{m: (lambda mode: lambda kb, q, v, k: service.hybrid_search(kb, q, v, k, args.alpha, mode))(m) for m in fusion.FUSION_MODES},
+}
+
+
+def relevant(result, wanted):
+    return any(w in (result["document_id"], result["source"], result["title"]) for w in wanted)
+
+
+kb_ids, queries, embed = real() if args.kb_id else synthetic()
+vectors = [embed(q["query"]) for q in queries]
+ks = sorted({1, 5, args.top_k})
+print(f"{len(queries)} queries, top_k={args.top_k}, alpha={args.alpha}, "
+      f"candidates sem={settings.semantic_candidates} kw={settings.keyword_candidates}, rrf_k={settings.rrf_k}")
+print(f"  {'mode':11s} " + " ".join(f"{'R@' + str(k):>6s}" for k in ks) + f" {'MRR':>6s} {'p50 ms':>7s} {'p95 ms':>7s}")
+for name, fn in MODES.items():
+    hits = {k: 0 for k in ks}
+    rr, times = 0.0, []
+    for q, qvec in zip(queries, vectors):
+        t0 = time.perf_counter()
+        results = fn(kb_ids, q["query"], qvec, args.top_k)
+        times.append((time.perf_counter() - t0) * 1000)
+        ranks = [i for i, r in enumerate(results, start=1) if relevant(r, q["relevant"])]
+        for k in ks:
+            hits[k] += bool(ranks and ranks[0] <= k)
+        rr += 1.0 / ranks[0] if ranks else 0.0
+    p95 = statistics.quantiles(times, n=20)[-1] if len(times) > 1 else times[0]
+    print(f"  {name:11s} " + " ".join(f"{hits[k] / len(queries):6.3f}" for k in ks)
+          + f" {rr / len(queries):6.3f} {statistics.median(times):7.2f} {p95:7.2f}")
@@ -0,0 +1,88 @@
+"""Stand-in for LM Studio: OpenAI-compatible embeddings and chat with fixed, tunable costs.
+
+Embeddings are deterministic unit vectors seeded from each input text, so repeated
+runs produce identical KBs. Chat replies are --tokens words; streaming sends the first
+one after --ttft-ms and the rest --token-ms apart. Used by tools/bench_suite.py, or on
+its own to run the backend without a model server:
+
+    python tools/fake_openai.py [--port 1235] [--dim 384] [--embed-ms 0] [--ttft-ms 50] [--token-ms 5] [--tokens 64]
+"""
+import argparse
+import asyncio
+import json
+import time
+import zlib
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=1235)
+parser.add_argument("--dim", type=int, default=384)
+parser.add_argument("--embed-ms", type=float, default=0.0, help="latency added to every /embeddings request")
+parser.add_argument("--ttft-ms", type=float, default=50.0)
+parser.add_argument("--token-ms", type=float, default=5.0)
+parser.add_argument("--tokens", type=int, default=64)
+args = parser.parse_args()
+
+app = FastAPI(title="fake-openai")
+
+
+def embed(text: str) -> list:
+    vec = np.random.default_rng(zlib.crc32(text.encode("utf-8", errors="surrogatepass"))).standard_normal(args.dim)
+    return (vec / np.linalg.norm(vec)).astype(np.float32).tolist()
+
+
+@app.get("/v1/models")
+async def models():
+    return {"object": "list", "data": [{"id": "fake-embed", "object": "model"}, {"id": "fake-chat", "object": "model"}]}
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    inputs = body.get("input") or []
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    if args.embed_ms:
+        await asyncio.sleep(args.embed_ms / 1000)
+    return {
+        "object": "list",
+        "model": body.get("model", "fake-embed"),
+        "data": [{"object": "embedding", "index": i, "embedding": embed(t)} for i, t in enumerate(inputs)],
+        "usage": {"prompt_tokens": sum(len(t.split()) for t in inputs), "total_tokens": sum(len(t.split()) for t in inputs)},
+    }
+
+
+def words():
+    return [f"word{i} " for i in range(args.tokens)]
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "fake-chat")
+    created = int(time.time())
+    if not body.get("stream"):
+        await asyncio.sleep((args.ttft_ms + args.token_ms * max(0, args.tokens - 1)) / 1000)
+        return {
+            "id": "chatcmpl-fake", "object": "chat.completion", "created": created, "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "".join(words())}}],
+        }
+
+    async def events():
+        for i, word in enumerate(words()):
+            await asyncio.sleep((args.ttft_ms if i == 0 else args.token_ms) / 1000)
+            chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created, "model": model,
+                     "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+            yield f"data: {json.dumps(chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
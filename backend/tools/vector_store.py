@@ -0,0 +1,27 @@
+"""Maintain the memory-mapped sidecar vector files while the backend is stopped.
+
+    python tools/vector_store.py compact [KB_ID ...]
+    python tools/vector_store.py rebuild [KB_ID ...]
+
+With no KB ids every knowledge base is processed. A running backend exposes the same
+operations as POST /kb/{kb_id}/vectors/compact and /kb/{kb_id}/vectors/rebuild.
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from steve import vector_index  # noqa: E402
+from steve.service import list_kb  # noqa: E402
+
+if len(sys.argv) < 2 or sys.argv[1] not in ("compact", "rebuild"):
+    sys.stderr.write(__doc__)
+    sys.exit(2)
+
+command = sys.argv[1]
+kb_ids = [int(a) for a in sys.argv[2:]] or [kb_id for kb_id, _ in list_kb()]
+result = {}
+for kb_id in kb_ids:
+    result[kb_id] = vector_index.compact(kb_id) if command == "compact" else vector_index.rebuild(kb_id)
+sys.stdout.write(json.dumps({"command": command, "rows": result}) + "\n")